@@ -5,11 +5,11 @@ import numpy as np
 
 
 class UCLB(gym.Env):
-    def __init__(self):
+    def __init__(self, user_num=1):
         self.name = "uclb"
         # Parameter settings
         self.last_energy = 0  # Consumed energy of last slot
-        self.user_num = 1  # Number of sensors
+        self.user_num = user_num  # Number of sensors
         self.server_num = 3 # Number of servers
         self.bandwidth = 20e6  # System bandwidth (Hz)
         self.max_power = 1  # Maximum transmit power (W)
@@ -66,26 +66,23 @@ class UCLB(gym.Env):
 
         # Load MIMO channel data
         self.channel_gain_data = np.load("mimo_channel_gain_data.npy")
+        if self.user_num > self.channel_gain_data.shape[1]:
+            raise ValueError("The channel data covers {} users, got user_num={}".format(self.channel_gain_data.shape[1], self.user_num))
 
     def decode_action(self, action):
         """
         Maps an integer action (0 ~ self.num_actions - 1) to a server selection index for each user.
 
-        :param action: Integer action from the Discrete action space
+        :param action: Integer action from the Discrete action space, e.g. built by Branching_Dueling_Net.joint_actions
         :return: An array of length self.user_num representing the selected server for each user (Range: 1 ~ self.server_num)
         """
-        server_selection = np.zeros(self.user_num, dtype=int)
-
-        # Decode the integer action using base conversion (multi-digit representation)
-        for i in range(self.user_num):
-            server_selection[i] = (action % self.server_num) + 1  # Map to range 1 ~ server_num
-            action //= self.server_num  # Integer division to decode the next digit
-
-        return server_selection
+        # Decode the integer action using base conversion (multi-digit representation), user i is digit i
+        digits = self.server_num ** np.arange(self.user_num, dtype=np.int64)
+        return (np.int64(action) // digits) % self.server_num + 1  # Map to range 1 ~ server_num
 
     def get_trans_rate(self):
         # Compute SINR for each user-server pair
-        sinr = (self.max_power * self.channel_gain_data[self.step_num,:,:]) / self.noise_power  # Shape: (user_num, server_num)
+        sinr = (self.max_power * self.channel_gain_data[self.step_num,:self.user_num,:]) / self.noise_power  # Shape: (user_num, server_num)
         # Compute transmission rate using Shannon Capacity formula
         trans_rate = (self.bandwidth / self.user_num) * np.log2(1 + sinr)  # Shape: (user_num, server_num)
 
@@ -180,3 +177,96 @@ class UCLB(gym.Env):
 
         return np.array(state_init)
 
+
+class VecUCLB(UCLB):
+    """
+    num_envs independent UCLB instances held in stacked arrays and stepped together.
+    step() takes one action per instance and returns the batched (next_states, rewards, dones).
+    Finished instances are reset right away; self.states always holds the states the next actions are chosen for.
+    """
+
+    def __init__(self, num_envs, user_num=1):
+        super(VecUCLB, self).__init__(user_num)
+        self.name = "vec_uclb"
+        self.num_envs = num_envs
+        self.delay_coff = np.random.rand(self.num_envs, self.user_num) * 10  # Each instance draws its own delay coefficients
+        self.step_nums = np.zeros(self.num_envs, dtype=int)
+        self.remain_chunk_num = np.zeros([self.num_envs, self.user_num])
+        self.server_load = np.zeros([self.num_envs, self.server_num])
+        self.aver_delay_list = np.zeros([self.num_envs, self.slot_num])
+        self.mad_list = np.zeros([self.num_envs, self.slot_num])
+        self.reward_list = np.zeros([self.num_envs, self.slot_num])
+        self.dones = np.zeros(self.num_envs, dtype=bool)
+        self.states = None
+
+    def decode_action(self, actions):
+        # Base conversion for all instances at once: (num_envs,) -> (num_envs, user_num), servers in 1 ~ server_num
+        digits = self.server_num ** np.arange(self.user_num)
+        return (np.asarray(actions)[:, None] // digits) % self.server_num + 1
+
+    def get_trans_rate(self):
+        gain = self.channel_gain_data[self.step_nums, :self.user_num, :]  # Shape: (num_envs, user_num, server_num)
+        sinr = (self.max_power * gain) / self.noise_power
+        return (self.bandwidth / self.user_num) * np.log2(1 + sinr)
+
+    def get_trans_delay(self, trans_rate, action_list):
+        rate = np.take_along_axis(trans_rate, action_list[:, :, None] - 1, axis=2)[:, :, 0]  # Rate to the selected server, (num_envs, user_num)
+        return self.chunk_size * 1e6 * 1e3 / rate
+
+    def get_load_mad(self, action_list):
+        rows = np.repeat(np.arange(self.num_envs), self.user_num)
+        np.add.at(self.server_load, (rows, action_list.ravel() - 1), self.chunk_size)  # Users of one instance may pick the same server
+        return np.mean(np.abs(self.server_load - np.mean(self.server_load, axis=1, keepdims=True)), axis=1)
+
+    def step(self, actions):
+        envs = np.arange(self.num_envs)
+        action_list = self.decode_action(actions)
+        trans_delay = self.get_trans_delay(self.get_trans_rate(), action_list)
+        aver_trans_delay = np.mean(trans_delay, axis=1)
+        mad = self.get_load_mad(action_list)
+        rewards = -(np.mean(self.delay_coff * trans_delay, axis=1) + mad)
+        self.aver_delay_list[envs, self.step_nums] = aver_trans_delay
+        self.mad_list[envs, self.step_nums] = mad
+        self.reward_list[envs, self.step_nums] = rewards
+        self.step_delay_list.extend(aver_trans_delay.tolist())
+        self.step_mad_list.extend(mad.tolist())
+        self.step_reward_list.extend(rewards.tolist())
+
+        # State change
+        self.remain_chunk_num[self.remain_chunk_num > 0] -= 1
+        next_states = np.concatenate([self.remain_chunk_num, self.server_load], axis=1)
+
+        # Stop condition
+        self.dones = np.all(self.remain_chunk_num == 0, axis=1) | (self.step_nums >= self.slot_num - 1)
+        self.step_nums += 1
+        for i in np.nonzero(self.dones)[0]:
+            self.episode_num = self.episode_num + 1
+            self.episode_aver_delay_list.append(np.sum(self.aver_delay_list[i]) / self.slot_num)
+            self.episode_mad_list.append(np.sum(self.mad_list[i]) / self.slot_num)
+            self.episode_reward_list.append(np.sum(self.reward_list[i]) / self.slot_num)
+        if self.dones.any():
+            print("Episode index:", self.episode_num, "Average reward", np.mean(self.episode_reward_list[-int(self.dones.sum()):]))
+
+        self.states = next_states.copy()
+        self.reset_envs(self.dones)
+        return next_states, rewards, self.dones.copy()
+
+    def reset_envs(self, mask):
+        # Reset the instances selected by mask, and put their initial states into self.states
+        obs_init = (self.obs_chunks_num_low + self.obs_chunks_num_high) / 2
+        load_init = (self.obs_load_low + self.obs_load_high) / 2
+        self.states[mask] = np.concatenate([obs_init, load_init])
+        self.step_nums[mask] = 0
+        self.server_load[mask] = 0
+        self.remain_chunk_num[mask] = self.chunk_num
+        self.aver_delay_list[mask] = 0
+        self.mad_list[mask] = 0
+        self.reward_list[mask] = 0
+
+    def reset(self):
+        self.states = np.zeros([self.num_envs, self.observation_space.shape[0]])
+        self.reset_envs(np.ones(self.num_envs, dtype=bool))
+        self.episode_aver_delay_list = []
+        self.episode_reward_list = []
+        self.episode_mad_list = []
+        return self.states.copy()
@@ -0,0 +1,96 @@
+import numpy as np
+
+# GF(2^8) with the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1 (0x11d)
+GF_EXP = np.zeros(512, dtype=np.uint8)
+GF_LOG = np.zeros(256, dtype=np.int64)
+x = 1
+for i in range(255):
+    GF_EXP[i] = x
+    GF_LOG[x] = i
+    x <<= 1
+    if x & 0x100:
+        x ^= 0x11d
+GF_EXP[255:510] = GF_EXP[:255]  # exp[log a + log b] without a modulo
+del x, i
+
+# GF_MUL[a] maps every byte b to a * b, so multiplying a whole shard by a is one table lookup per byte
+GF_MUL = np.zeros((256, 256), dtype=np.uint8)
+GF_MUL[1:, 1:] = GF_EXP[GF_LOG[1:, None] + GF_LOG[None, 1:]]
+
+
+def gf_inv(a):
+    return int(GF_EXP[255 - GF_LOG[a]])
+
+
+def gf_mul(a, b):
+    return int(GF_MUL[a, b])
+
+
+def gf_invert_matrix(matrix):
+    # Gauss-Jordan elimination over GF(2^8), where addition and subtraction are XOR
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col])  # StopIteration if singular, never for a Cauchy code
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(scale, v) for v in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [v ^ gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def gf_combine(coefficients, shards):
+    # sum_j coefficients[j] * shards[j] over GF(2^8), shard by shard
+    out = np.zeros_like(shards[0])
+    for c, shard in zip(coefficients, shards):
+        if c == 1:
+            out ^= shard
+        elif c:
+            out ^= GF_MUL[c].take(shard)
+    return out
+
+
+class ReedSolomon(object):
+    """
+    Systematic Reed-Solomon code over GF(2^8): data_shards shards are stored as they are, and parity_shards
+    parity shards are added so that any data_shards of the data_shards + parity_shards rebuild the data.
+    The parity rows form a Cauchy matrix, so every square submatrix of the generator [I; C] is invertible.
+    Shards are equal-length uint8 arrays; the code works byte by byte, so any byte range of the shards
+    can be rebuilt from the same range of the other shards.
+    """
+
+    def __init__(self, data_shards, parity_shards):
+        if data_shards < 1 or parity_shards < 0 or data_shards + parity_shards > 256:
+            raise ValueError("Need 1 <= data_shards and data_shards + parity_shards <= 256")
+        self.data_shards = data_shards
+        self.parity_shards = parity_shards
+        self.parity_matrix = [[gf_inv((data_shards + i) ^ j) for j in range(data_shards)] for i in range(parity_shards)]
+
+    def generator_row(self, shard_index):
+        if shard_index < self.data_shards:
+            return [int(j == shard_index) for j in range(self.data_shards)]
+        return self.parity_matrix[shard_index - self.data_shards]
+
+    def encode(self, data):
+        # data: (data_shards, length) uint8 -> parity: (parity_shards, length) uint8
+        data = np.asarray(data, dtype=np.uint8)
+        return np.stack([gf_combine(row, data) for row in self.parity_matrix]) if self.parity_shards else np.zeros((0, data.shape[1]), np.uint8)
+
+    def reconstruct(self, shards):
+        """
+        shards: {shard_index: uint8 array} with at least data_shards entries (data shards are 0..data_shards-1).
+        Returns the data shards as a (data_shards, length) array, decoding only the ones that are missing.
+        """
+        if len(shards) < self.data_shards:
+            raise ValueError("Need {} shards, got {}".format(self.data_shards, len(shards)))
+        if all(j in shards for j in range(self.data_shards)):
+            return np.stack([shards[j] for j in range(self.data_shards)])
+        # Prefer the data shards we have: they need no arithmetic
+        used = sorted(shards, key=lambda i: (i >= self.data_shards, i))[:self.data_shards]
+        decode = gf_invert_matrix([self.generator_row(i) for i in used])
+        used_shards = [np.asarray(shards[i], dtype=np.uint8) for i in used]
+        return np.stack([np.asarray(shards[j], dtype=np.uint8) if j in shards else gf_combine(decode[j], used_shards)
+                         for j in range(self.data_shards)])
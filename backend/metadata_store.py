@@ -0,0 +1,334 @@
+import os
+import json
+import contextlib
+import sqlite3
+import threading
+
+BLOB_PREFIX = "blob_"  # Content-addressed chunks are stored on the nodes as blob_<sha256>
+
+
+def chunk_name(file_id, chunk_index, sha256=None):
+    # Name of a chunk file on its node
+    return BLOB_PREFIX + sha256 if sha256 is not None else f"{file_id}_chunk_{chunk_index}"
+
+
+def parity_name(file_id, group_index, shard_index):
+    # Name of an erasure-coding parity shard on its node
+    return f"{file_id}_parity_{group_index}_{shard_index}"
+
+
+class MetadataStore(object):
+    """
+    Upload metadata in SQLite (WAL mode), mirrored by an in-memory index.
+    Reads never touch the disk; every write is a single-row statement, so its cost does not grow
+    with the number of files in flight. The index keeps the layout of the old metadata.json, with a set of uploaded chunks:
+    {file_id: {"file_name", "total_chunks", "uploaded_chunks": {...}, "chunks": {chunk_index: node_server}, "chunk_size", "size",
+    "hashes": {chunk_index: sha256}, "stored_sizes": {chunk_index: bytes}}}. chunk_size (bytes) is known once the file is planned,
+    size once the upload is completed, and stored_sizes holds the bytes a chunk takes on its node after compression, as reported by it.
+
+    Replicated chunks have their other copies in "replicas": {chunk_index: [node_server, ...]}; "chunks" holds the copy
+    the placement policy chose.
+
+    Erasure-coded files also have "data_shards" (k) and "parity_shards" (m), None otherwise, set when the file is planned, and
+    "parity": {group_index: [(node_server, stored_size), ...]}, empty until the upload is completed: chunks
+    k * group_index .. k * group_index + k - 1 are the data shards of a group, protected by its m parity shards.
+
+    Chunks with a sha256 are content-addressed: they share one blob per sha256, held by the node in self.blobs
+    ({sha256: {"node_server", "refcount", "planned", "stored_size", "replicas", "uploaded"}}), where refcount counts the uploaded
+    chunks referencing it and planned the chunks placed on it but not uploaded yet. A blob is reserved by the first plan that
+    places its content, so concurrent uploads of the same content share its nodes; uploaded tells whether the content is on them.
+    Only uploaded blobs have a row in the blobs table, planned references are counted from the chunks table on startup.
+    """
+
+    def __init__(self, path, legacy_json=None):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)  # Autocommit, transactions are explicit
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # Durable at every WAL checkpoint, safe against corruption
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "file_id TEXT PRIMARY KEY, file_name TEXT NOT NULL, total_chunks INTEGER NOT NULL, chunk_size INTEGER, size INTEGER, "
+                        "data_shards INTEGER, parity_shards INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                        "file_id TEXT NOT NULL, chunk_index INTEGER NOT NULL, node_server TEXT, uploaded INTEGER NOT NULL DEFAULT 0, sha256 TEXT, "
+                        "stored_size INTEGER, replicas TEXT, PRIMARY KEY (file_id, chunk_index))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                        "sha256 TEXT PRIMARY KEY, node_server TEXT NOT NULL, refcount INTEGER NOT NULL, stored_size INTEGER, replicas TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS parity ("
+                        "file_id TEXT NOT NULL, group_index INTEGER NOT NULL, shard_index INTEGER NOT NULL, node_server TEXT NOT NULL, "
+                        "stored_size INTEGER, PRIMARY KEY (file_id, group_index, shard_index))")
+        # Databases created before downloads were served / before content-addressed, compressed, erasure-coded or replicated chunks
+        self.add_missing_columns("files", {"chunk_size": "INTEGER", "size": "INTEGER", "data_shards": "INTEGER", "parity_shards": "INTEGER"})
+        self.add_missing_columns("chunks", {"sha256": "TEXT", "stored_size": "INTEGER", "replicas": "TEXT"})
+        self.add_missing_columns("blobs", {"stored_size": "INTEGER", "replicas": "TEXT"})
+        if legacy_json is not None and os.path.exists(legacy_json) and self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 0:
+            self.migrate(legacy_json)
+        self.index = self.load_index()
+        self.blobs = {sha256: {"node_server": node_server, "refcount": refcount, "planned": 0, "stored_size": stored_size,
+                               "replicas": json.loads(replicas or "[]"), "uploaded": True}
+                      for sha256, node_server, refcount, stored_size, replicas in self.db.execute(
+                          "SELECT sha256, node_server, refcount, stored_size, replicas FROM blobs")}
+        for meta in self.index.values():
+            for chunk_index, sha256 in meta["hashes"].items():
+                if chunk_index not in meta["uploaded_chunks"] and chunk_index in meta["chunks"]:
+                    blob = self.blobs.setdefault(sha256, {"node_server": meta["chunks"][chunk_index], "refcount": 0, "planned": 0, "stored_size": None,
+                                                          "replicas": list(meta["replicas"].get(chunk_index, [])), "uploaded": False})
+                    blob["planned"] += 1
+
+    def add_missing_columns(self, table, columns):
+        existing = [row[1] for row in self.db.execute(f"PRAGMA table_info({table})")]
+        for column, column_type in columns.items():
+            if column not in existing:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def migrate(self, legacy_json):
+        # One-off import of the old metadata.json, which is kept as metadata.json.migrated
+        try:
+            with open(legacy_json, "r") as f:
+                content = f.read().strip()
+                file_metadata = json.loads(content) if content else {}
+        except json.JSONDecodeError:
+            file_metadata = {}  # Same as the old loader: an unreadable file starts empty
+
+        with self.transaction():
+            for file_id, meta in file_metadata.items():
+                self.db.execute("INSERT INTO files (file_id, file_name, total_chunks) VALUES (?, ?, ?)", (file_id, meta["file_name"], meta["total_chunks"]))
+                for chunk_index, node_server in meta.get("chunks", {}).items():
+                    self.upsert_chunk(file_id, int(chunk_index), node_server=node_server)
+                for chunk_index in meta.get("uploaded_chunks", []):
+                    self.upsert_chunk(file_id, int(chunk_index), uploaded=True)
+        os.replace(legacy_json, legacy_json + ".migrated")
+        print(f"Migrated {len(file_metadata)} files from {legacy_json}")
+
+    def load_index(self):
+        index = {}
+        for file_id, file_name, total_chunks, chunk_size, size, data_shards, parity_shards in self.db.execute(
+                "SELECT file_id, file_name, total_chunks, chunk_size, size, data_shards, parity_shards FROM files"):
+            index[file_id] = {"file_name": file_name, "total_chunks": total_chunks, "uploaded_chunks": set(), "chunks": {},
+                              "chunk_size": chunk_size, "size": size, "hashes": {}, "stored_sizes": {}, "replicas": {},
+                              "data_shards": data_shards, "parity_shards": parity_shards, "parity": {}}
+        for file_id, chunk_index, node_server, uploaded, sha256, stored_size, replicas in self.db.execute(
+                "SELECT file_id, chunk_index, node_server, uploaded, sha256, stored_size, replicas FROM chunks"):
+            if node_server is not None:
+                index[file_id]["chunks"][chunk_index] = node_server
+            if uploaded:
+                index[file_id]["uploaded_chunks"].add(chunk_index)
+            if sha256 is not None:
+                index[file_id]["hashes"][chunk_index] = sha256
+            if stored_size is not None:
+                index[file_id]["stored_sizes"][chunk_index] = stored_size
+            if replicas:
+                index[file_id]["replicas"][chunk_index] = json.loads(replicas)
+        for file_id, group_index, node_server, stored_size in self.db.execute(
+                "SELECT file_id, group_index, node_server, stored_size FROM parity ORDER BY file_id, group_index, shard_index"):
+            index[file_id]["parity"].setdefault(group_index, []).append((node_server, stored_size))
+        return index
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def upsert_chunk(self, file_id, chunk_index, node_server=None, uploaded=False, sha256=None, stored_size=None, replicas=None):
+        self.db.execute("INSERT INTO chunks (file_id, chunk_index, node_server, uploaded, sha256, stored_size, replicas) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (file_id, chunk_index) DO UPDATE SET "
+                        "node_server = COALESCE(excluded.node_server, node_server), uploaded = MAX(uploaded, excluded.uploaded), "
+                        "sha256 = COALESCE(excluded.sha256, sha256), stored_size = COALESCE(excluded.stored_size, stored_size), "
+                        "replicas = COALESCE(excluded.replicas, replicas)",
+                        (file_id, chunk_index, node_server, int(uploaded), sha256, stored_size, json.dumps(replicas) if replicas else None))
+
+    def ref_blob(self, sha256, node_server, delta, stored_size=None, replicas=None, planned=0):
+        """
+        Inside a transaction: add delta uploaded and planned references to a blob, dropping it when it has neither;
+        returns True when it was dropped. An uploaded reference means the blob's content is on its nodes.
+        """
+        blob = self.blobs.setdefault(sha256, {"node_server": node_server, "refcount": 0, "planned": 0, "stored_size": None,
+                                              "replicas": list(replicas or []), "uploaded": False})
+        blob["refcount"] += delta
+        blob["planned"] += planned
+        blob["uploaded"] = blob["uploaded"] or delta > 0
+        if stored_size is not None:
+            blob["stored_size"] = stored_size
+        if blob["refcount"] <= 0 and blob["planned"] <= 0:
+            del self.blobs[sha256]
+            self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            return True
+        if not blob["uploaded"]:
+            return False
+        self.db.execute("INSERT OR REPLACE INTO blobs (sha256, node_server, refcount, stored_size, replicas) VALUES (?, ?, ?, ?, ?)",
+                        (sha256, blob["node_server"], blob["refcount"], blob["stored_size"], json.dumps(blob["replicas"]) if blob["replicas"] else None))
+        return False
+
+    def __contains__(self, file_id):
+        return file_id in self.index
+
+    def get(self, file_id):
+        # The live index entry, callers must not modify it
+        return self.index.get(file_id)
+
+    def chunk_name(self, file_id, chunk_index):
+        return chunk_name(file_id, chunk_index, self.index[file_id]["hashes"].get(chunk_index))
+
+    def locations(self, file_id, chunk_index):
+        # Every node holding the chunk, the policy's choice first
+        meta = self.index[file_id]
+        return [meta["chunks"][chunk_index]] + meta["replicas"].get(chunk_index, [])
+
+    def find_blob(self, sha256):
+        # The node already holding this content, or None
+        blob = self.blobs.get(sha256)
+        return blob["node_server"] if blob is not None and blob["uploaded"] else None
+
+    def blob_location(self, sha256):
+        # (node_server, [replica node_server, ...]) of the blob holding or reserved for this content, or None
+        blob = self.blobs.get(sha256)
+        return (blob["node_server"], list(blob["replicas"])) if blob is not None else None
+
+    def values(self):
+        with self.lock:
+            return list(self.index.values())
+
+    def add_file(self, file_id, file_name, total_chunks):
+        """
+        A second /upload/metadata for the same file_id starts it over, like the old dict assignment: the old chunks
+        release their blobs in the same transaction. Returns the chunks nothing refers to anymore, as delete_file does.
+        """
+        with self.lock:
+            meta = self.index.get(file_id)
+            with self.transaction():
+                unreferenced = self.release_chunks(file_id, meta) if meta is not None else []
+                self.db.execute("INSERT OR REPLACE INTO files (file_id, file_name, total_chunks) VALUES (?, ?, ?)", (file_id, file_name, total_chunks))
+            self.index[file_id] = {"file_name": file_name, "total_chunks": total_chunks, "uploaded_chunks": set(), "chunks": {},
+                                   "chunk_size": None, "size": None, "hashes": {}, "stored_sizes": {}, "replicas": {},
+                                   "data_shards": None, "parity_shards": None, "parity": {}}
+            return unreferenced
+
+    def assign_chunk(self, file_id, chunk_index, node_server):
+        # Returns the node the chunk was assigned to before, or None
+        with self.lock:
+            chunks = self.index[file_id]["chunks"]  # KeyError before any write for an unknown file
+            self.upsert_chunk(file_id, chunk_index, node_server=node_server)
+            old_server = chunks.get(chunk_index)
+            chunks[chunk_index] = node_server
+            return old_server
+
+    def assign_chunks(self, file_id, assignments, hashes=None, chunk_size=None, replicas=None, data_shards=None, parity_shards=None):
+        """
+        A whole placement plan {chunk_index: node_server} in one transaction, with the chunks' sha256 if content-addressed,
+        their other copies {chunk_index: [node_server, ...]} if replicated, and the erasure-coding layout if it is erasure-coded. Content-addressed chunks take a planned
+        reference on their blob, reserving it on these nodes for the chunks of later plans with the same content.
+        """
+        hashes = hashes or {}
+        replicas = replicas or {}
+        with self.lock:
+            meta = self.index[file_id]
+            with self.transaction():
+                for chunk_index, node_server in assignments.items():
+                    self.upsert_chunk(file_id, chunk_index, node_server=node_server, sha256=hashes.get(chunk_index), replicas=replicas.get(chunk_index))
+                    if chunk_index in hashes:
+                        self.ref_blob(hashes[chunk_index], node_server, 0, replicas=replicas.get(chunk_index), planned=1)
+                if chunk_size is not None:
+                    self.db.execute("UPDATE files SET chunk_size = ? WHERE file_id = ?", (chunk_size, file_id))
+                if data_shards is not None:
+                    self.db.execute("UPDATE files SET data_shards = ?, parity_shards = ? WHERE file_id = ?", (data_shards, parity_shards, file_id))
+            if chunk_size is not None:
+                meta["chunk_size"] = chunk_size
+            if data_shards is not None:
+                meta["data_shards"], meta["parity_shards"] = data_shards, parity_shards
+            meta["chunks"].update(assignments)
+            meta["hashes"].update({chunk_index: hashes[chunk_index] for chunk_index in assignments if chunk_index in hashes})
+            meta["replicas"].update({chunk_index: list(replicas[chunk_index]) for chunk_index in assignments if replicas.get(chunk_index)})
+
+    def mark_uploaded(self, file_id, chunk_index):
+        self.mark_uploaded_many(file_id, [chunk_index])
+
+    def mark_uploaded_many(self, file_id, chunk_indices, stored_sizes=None):
+        """
+        Bulk /upload/update: one transaction for the whole batch; content-addressed chunks turn their planned reference on
+        their blob into an uploaded one.
+        stored_sizes {chunk_index: bytes} records what the chunks take on their node; chunks sharing a blob take its size.
+        Returns the newly uploaded chunks that added data to a node: every chunk without a sha256, and the first
+        reference to each new blob.
+        """
+        stored_sizes = stored_sizes or {}
+        with self.lock:
+            meta = self.index[file_id]
+            new_chunks = {chunk_index for chunk_index in chunk_indices if chunk_index not in meta["uploaded_chunks"]}
+            new_sizes = {}
+            stored = []
+            with self.transaction():
+                for chunk_index in new_chunks:
+                    sha256 = meta["hashes"].get(chunk_index)
+                    stored_size = stored_sizes.get(chunk_index)
+                    if sha256 is None or not self.blobs[sha256]["uploaded"]:
+                        stored.append(chunk_index)
+                    if sha256 is not None:
+                        self.ref_blob(sha256, meta["chunks"][chunk_index], 1, stored_size, meta["replicas"].get(chunk_index), planned=-1)
+                        stored_size = self.blobs[sha256]["stored_size"]
+                    self.upsert_chunk(file_id, chunk_index, uploaded=True, stored_size=stored_size)
+                    if stored_size is not None:
+                        new_sizes[chunk_index] = stored_size
+            meta["uploaded_chunks"].update(new_chunks)
+            meta["stored_sizes"].update(new_sizes)
+            return stored
+
+    def missing_chunks(self, file_id):
+        meta = self.index[file_id]
+        return [i for i in range(meta["total_chunks"]) if i not in meta["uploaded_chunks"]]
+
+    def complete_file(self, file_id, chunk_size, size):
+        with self.lock:
+            meta = self.index[file_id]
+            self.db.execute("UPDATE files SET chunk_size = ?, size = ? WHERE file_id = ?", (chunk_size, size, file_id))
+            meta["chunk_size"], meta["size"] = chunk_size, size
+
+    def set_parity(self, file_id, parity):
+        # Records the parity shards {group_index: [(node_server, stored_size), ...]} of an erasure-coded file, in one transaction
+        with self.lock:
+            meta = self.index[file_id]
+            with self.transaction():
+                for group_index, shards in parity.items():
+                    for shard_index, (node_server, stored_size) in enumerate(shards):
+                        self.db.execute("INSERT OR REPLACE INTO parity VALUES (?, ?, ?, ?, ?)", (file_id, group_index, shard_index, node_server, stored_size))
+            meta["parity"] = {group_index: list(shards) for group_index, shards in parity.items()}
+
+    def delete_file(self, file_id):
+        """
+        Drops the file and its references to blobs. Returns the (node_server, chunk name, stored_size) of the chunks nothing
+        refers to anymore: the file's own chunks and parity shards, and the blobs that lost their last reference,
+        which the caller deletes from the nodes. stored_size is None where the node never reported it.
+        """
+        with self.lock:
+            meta = self.index.get(file_id)
+            if meta is None:
+                return None
+            with self.transaction():
+                unreferenced = self.release_chunks(file_id, meta)
+                self.db.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+            del self.index[file_id]
+            return unreferenced
+
+    def release_chunks(self, file_id, meta):
+        # Inside a transaction: drops the file's chunk and parity rows and its blob references, returns what delete_file returns
+        unreferenced = []
+        for chunk_index, node_server in meta["chunks"].items():
+            sha256 = meta["hashes"].get(chunk_index)
+            copies = [node_server] + meta["replicas"].get(chunk_index, [])
+            if sha256 is None:
+                unreferenced += [(copy, chunk_name(file_id, chunk_index), meta["stored_sizes"].get(chunk_index)) for copy in copies]
+                continue
+            stored_size = self.blobs[sha256]["stored_size"]
+            uploaded = chunk_index in meta["uploaded_chunks"]
+            if self.ref_blob(sha256, node_server, -1 if uploaded else 0, planned=0 if uploaded else -1):
+                # Chunks sharing a blob are placed on its nodes
+                unreferenced += [(copy, chunk_name(file_id, chunk_index, sha256), stored_size) for copy in copies]
+        for group_index, shards in meta["parity"].items():
+            for shard_index, (node_server, stored_size) in enumerate(shards):
+                unreferenced.append((node_server, parity_name(file_id, group_index, shard_index), stored_size))
+        self.db.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
+        self.db.execute("DELETE FROM parity WHERE file_id = ?", (file_id,))
+        return unreferenced
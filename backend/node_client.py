@@ -0,0 +1,284 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ChunkFetchError(Exception):
+    def __init__(self, node_server, name, reason):
+        super(ChunkFetchError, self).__init__(f"Failed to fetch chunk {name} from {node_server}: {reason}")
+        self.node_server = node_server
+        self.name = name
+
+
+class NodeClient(object):
+    """
+    Keep-alive connection pools to the node servers, one requests.Session per node, shared by all coordinator requests.
+    Chunks are addressed by their file name on the node (metadata_store.chunk_name).
+    The read times of the last latency_window reads from each node set when a read of a replicated chunk is hedged:
+    after the hedge_percentile of the node's read times, or hedge_delay seconds until hedge_min_samples reads are known.
+    """
+
+    def __init__(self, node_servers, pool_size=8, timeout=30, read_size=64 * 1024,
+                 hedge_percentile=95, hedge_delay=0.05, hedge_min_samples=10, latency_window=256):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.read_size = read_size
+        self.hedge_percentile = hedge_percentile
+        self.initial_hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+        self.latencies = {}  # node_server -> deque of recent read times (seconds)
+        self.latencies_lock = threading.Lock()
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        for node_server in node_servers:
+            self.session(node_server)
+        # Shard reads of read_any() and hedged reads; the ones still running when an answer is in finish here in the background
+        self.shard_pool = ThreadPoolExecutor(max_workers=pool_size * max(len(node_servers), 1))
+
+    def session(self, node_server):
+        # Nodes that only appear in old metadata get their pool on first use
+        with self.sessions_lock:
+            if node_server not in self.sessions:
+                session = requests.Session()
+                session.mount(node_server, HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+                self.sessions[node_server] = session
+            return self.sessions[node_server]
+
+    @staticmethod
+    def chunk_url(node_server, name):
+        return f"{node_server}/uploads/chunks/{name}"
+
+    def record_latency(self, node_server, seconds):
+        with self.latencies_lock:
+            self.latencies.setdefault(node_server, deque(maxlen=self.latency_window)).append(seconds)
+
+    def latency_percentile(self, node_server, percentile):
+        # None until hedge_min_samples reads from the node are known
+        with self.latencies_lock:
+            samples = sorted(self.latencies.get(node_server, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def hedge_delay(self, node_server):
+        # How long a read from node_server may take before the same read goes to another replica
+        delay = self.latency_percentile(node_server, self.hedge_percentile)
+        return delay if delay is not None else self.initial_hedge_delay
+
+    def fetch_chunk(self, node_server, name, fd, offset):
+        # Streams one chunk into fd at offset, never holding more than read_size bytes; returns the chunk size.
+        # Compressed chunks come over the network compressed (Content-Encoding: deflate) and are inflated here
+        start = time.perf_counter()
+        try:
+            with self.session(node_server).get(self.chunk_url(node_server, name), stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    raise ChunkFetchError(node_server, name, f"HTTP {response.status_code}")
+                size = 0
+                for data in response.iter_content(self.read_size):
+                    os.pwrite(fd, data, offset + size)
+                    size += len(data)
+        except requests.RequestException as e:
+            raise ChunkFetchError(node_server, name, e)
+        self.record_latency(node_server, time.perf_counter() - start)
+        return size
+
+    def chunk_length(self, node_server, name):
+        # The uncompressed size: without Accept-Encoding: identity a compressed chunk would report its stored size
+        try:
+            response = self.session(node_server).head(self.chunk_url(node_server, name), headers={"Accept-Encoding": "identity"},
+                                                      timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ChunkFetchError(node_server, name, e)
+        if response.status_code != 200:
+            raise ChunkFetchError(node_server, name, f"HTTP {response.status_code}")
+        return int(response.headers["Content-Length"])
+
+    def read_chunk(self, node_server, name, start, end):
+        # Bytes start..end (inclusive) of one chunk, asking the node for just that range; end=None reads the whole chunk
+        headers = {"Range": f"bytes={start}-{end}"} if end is not None else {}
+        request_start = time.perf_counter()
+        try:
+            response = self.session(node_server).get(self.chunk_url(node_server, name), headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ChunkFetchError(node_server, name, e)
+        if response.status_code == 206 or (response.status_code == 200 and end is None):
+            data = response.content
+        elif response.status_code == 200:  # The node ignored the Range header
+            data = response.content[start:end + 1]
+        else:
+            raise ChunkFetchError(node_server, name, f"HTTP {response.status_code}")
+        if end is not None and len(data) != end - start + 1:
+            raise ChunkFetchError(node_server, name, f"got {len(data)} bytes, expected {end - start + 1}")
+        self.record_latency(node_server, time.perf_counter() - request_start)
+        return data
+
+    def read_hedged(self, node_servers, name, start, end):
+        """
+        Reads bytes start..end (end=None: all) of a chunk held by every node in node_servers and returns
+        (node_server, bytes) from the first node to answer. Replicas are asked in order of their recent median read time,
+        the placement's order until that is known. When the outstanding reads have not answered within the hedge delay
+        of the node asked last, the same read goes to the next replica as well; a failed read moves on at once.
+        """
+        if len(node_servers) == 1:
+            return node_servers[0], self.read_chunk(node_servers[0], name, start, end)
+        order = sorted(node_servers, key=lambda node_server: self.latency_percentile(node_server, 50) or 0)
+        futures = {}
+        pending = set()
+        errors = []
+        try:
+            for k, node_server in enumerate(order):
+                future = self.shard_pool.submit(self.read_chunk, node_server, name, start, end)
+                futures[future] = node_server
+                pending.add(future)
+                last = k == len(order) - 1
+                deadline = time.perf_counter() + self.hedge_delay(node_server)
+                while pending:
+                    done, pending = wait(pending, timeout=None if last else max(deadline - time.perf_counter(), 0), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            return futures[future], future.result()
+                        except ChunkFetchError as e:
+                            errors.append(e)
+                    if not last:
+                        break  # Timed out or failed: ask the next replica too
+        finally:
+            for future in pending:
+                future.cancel()
+        raise errors[-1]
+
+    def read_any(self, reads, count):
+        """
+        Issues reads [(node_server, name, start, end), ...] concurrently and returns {position in reads: bytes} as soon as
+        count of them have succeeded, so one slow or unreachable node does not hold the caller up.
+        Raises ChunkFetchError when fewer than count reads can succeed.
+        """
+        if count <= 0:
+            return {}
+        if len(reads) < count:
+            raise ValueError(f"{count} reads needed, only {len(reads)} given")
+        futures = {self.shard_pool.submit(self.read_chunk, *read): position for position, read in enumerate(reads)}
+        results = {}
+        errors = []
+        try:
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except ChunkFetchError as e:
+                    errors.append(e)
+                    if len(reads) - len(errors) < count:
+                        break
+                    continue
+                if len(results) >= count:
+                    return results
+        finally:
+            for future in futures:
+                future.cancel()
+        raise ChunkFetchError(errors[0].node_server, errors[0].name,
+                              f"only {len(reads) - len(errors)} of the {count} shards needed are readable ({errors[0]})")
+
+    def put_chunk(self, node_server, name, data):
+        # Stores data as chunk name on the node; returns the node's sha256, size and storedSize for it
+        try:
+            response = self.session(node_server).put(self.chunk_url(node_server, name), data=data, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ChunkFetchError(node_server, name, f"upload failed: {e}")
+        if response.status_code != 200:
+            raise ChunkFetchError(node_server, name, f"upload failed: HTTP {response.status_code}")
+        return response.json()
+
+    def delete_chunk(self, node_server, name):
+        # Returns False when the node could not be reached or refused, the chunk is then left behind
+        try:
+            response = self.session(node_server).delete(self.chunk_url(node_server, name), timeout=self.timeout)
+        except requests.RequestException:
+            return False
+        return response.status_code in (200, 404)
+
+    def node_stats(self, node_server, timeout=None):
+        # The node's GET /stats, None when it could not be reached or answered with an error
+        try:
+            response = self.session(node_server).get(f"{node_server}/stats", timeout=timeout or self.timeout)
+            return response.json() if response.status_code == 200 else None
+        except (requests.RequestException, ValueError):
+            return None
+
+    def stream_chunks(self, parts, readahead=4, read=None):
+        """
+        Yields the bytes of parts [(node_server, name, start, end), ...] in order, while up to readahead
+        later parts are fetched in the background, so at most readahead + 1 chunks are held in memory.
+        read(*part) replaces read_chunk for parts that are not a single chunk range, e.g. erasure-coded groups.
+        """
+        read = read or self.read_chunk
+        pool = ThreadPoolExecutor(max_workers=max(1, readahead))
+        pending = deque()
+        try:
+            for part in parts:
+                pending.append(pool.submit(read, *part))
+                if len(pending) > readahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:  # Also runs when the client goes away mid-download
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    def fetch_file(self, locations, path, chunk_size, max_workers=8):
+        """
+        Fetches the chunks at locations [([node_server, ...], name), ...] (in chunk order) concurrently and writes each one at
+        chunk_index * chunk_size in path as it arrives. Chunks on one node are streamed to disk; replicated chunks are
+        read with read_hedged, so a straggling node does not hold the merge up. Returns the total bytes, the wall time and,
+        per node, the chunks, bytes and throughput over the time that node was being read from.
+        """
+        node_stats = {}
+        stats_lock = threading.Lock()
+
+        def fetch(chunk_index):
+            node_servers, name = locations[chunk_index]
+            start = time.perf_counter()
+            if len(node_servers) == 1:
+                node_server = node_servers[0]
+                size = self.fetch_chunk(node_server, name, fd, chunk_index * chunk_size)
+            else:
+                node_server, data = self.read_hedged(node_servers, name, 0, None)
+                os.pwrite(fd, data, chunk_index * chunk_size)
+                size = len(data)
+            end = time.perf_counter()
+            if size != chunk_size and chunk_index != len(locations) - 1:  # Only the last chunk may be short
+                raise ChunkFetchError(node_server, name, f"got {size} bytes, expected {chunk_size}")
+            with stats_lock:
+                stats = node_stats.setdefault(node_server, {"chunks": 0, "bytes": 0, "start": start, "end": end})
+                stats["chunks"] += 1
+                stats["bytes"] += size
+                stats["start"] = min(stats["start"], start)
+                stats["end"] = max(stats["end"], end)
+            return size
+
+        start = time.perf_counter()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = [pool.submit(fetch, i) for i in range(len(locations))]
+                try:
+                    total_bytes = sum(future.result() for future in as_completed(futures))
+                except BaseException:
+                    for future in futures:  # Fail fast, the chunks not started yet are skipped
+                        future.cancel()
+                    raise
+        except BaseException:
+            os.close(fd)
+            os.remove(path)  # Never leave a partial file behind
+            raise
+        os.close(fd)
+        wall_time = time.perf_counter() - start
+
+        nodes = {node_server: {"chunks": stats["chunks"],
+                               "bytes": stats["bytes"],
+                               "throughput_MBps": stats["bytes"] / max(stats["end"] - stats["start"], 1e-9) / 1e6}
+                 for node_server, stats in node_stats.items()}
+        return {"bytes": total_bytes, "wall_time": wall_time, "nodes": nodes}
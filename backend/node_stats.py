@@ -0,0 +1,52 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class NodeStatsPoller(object):
+    """
+    Polls GET /stats of every node every ttl seconds on a background thread, so placement reads cached numbers
+    and never waits on a node. get() returns a node's latest stats together with what baseline() returned when
+    they were requested (the coordinator's own load bookkeeping at that moment), or None once the node has not
+    answered for max_age seconds.
+    """
+
+    def __init__(self, node_client, node_servers, ttl=2.0, max_age=10.0, baseline=None):
+        self.node_client = node_client
+        self.node_servers = list(node_servers)
+        self.ttl = ttl
+        self.max_age = max_age
+        self.baseline = baseline
+        self.polled = {}  # node_server -> (stats, baseline, time the stats were requested)
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max(len(self.node_servers), 1))
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while True:
+            start = time.monotonic()
+            self.poll()
+            time.sleep(max(self.ttl - (time.monotonic() - start), 0))
+
+    def poll(self):
+        # One round: all nodes at once, a node that does not answer within ttl keeps its previous stats
+        baseline = self.baseline() if self.baseline is not None else None
+        requested_at = time.monotonic()
+        results = list(self.pool.map(lambda node_server: self.node_client.node_stats(node_server, timeout=self.ttl),
+                                     self.node_servers))
+        with self.lock:
+            for node_server, stats in zip(self.node_servers, results):
+                if stats is not None:
+                    self.polled[node_server] = (stats, baseline, requested_at)
+
+    def get(self, node_server):
+        with self.lock:
+            polled = self.polled.get(node_server)
+        if polled is None or time.monotonic() - polled[2] > self.max_age:
+            return None
+        return polled
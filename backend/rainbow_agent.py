@@ -2,7 +2,7 @@ import random
 import torch
 import numpy as np
 import copy
-from rainbow_network import Dueling_Net, Net
+from rainbow_network import Branching_Dueling_Net, Dueling_Net, Net
 
 
 class DQN(object):
@@ -21,12 +21,15 @@ class DQN(object):
         self.use_lr_decay = args.use_lr_decay
         self.use_double = args.use_double
         self.use_dueling = args.use_dueling
+        self.use_branching = args.use_branching
         self.use_per = args.use_per
         self.use_n_steps = args.use_n_steps
         if self.use_n_steps:
             self.gamma = self.gamma ** args.n_steps
 
-        if self.use_dueling:  # Whether to use the 'dueling network'
+        if self.use_branching:  # Whether to use one dueling advantage branch per user
+            self.net = Branching_Dueling_Net(args)
+        elif self.use_dueling:  # Whether to use the 'dueling network'
             self.net = Dueling_Net(args)
         else:
             self.net = Net(args)
@@ -35,16 +38,29 @@ class DQN(object):
 
         self.optimizer = torch.optim.Adam(self.net.parameters(), lr=self.lr)
 
+    def greedy_actions(self, q):
+        # Joint action indices from a batch of Q-values; a branching net picks each user's server on its own branch
+        return self.net.joint_actions(q) if self.use_branching else q.argmax(dim=-1)
+
     def choose_action(self, state, epsilon):
         with torch.no_grad():
             state = torch.unsqueeze(torch.tensor(state, dtype=torch.float), 0)
             q = self.net(state)
             if np.random.uniform() > epsilon:
-                action = q.argmax(dim=-1).item()
+                action = self.greedy_actions(q).item()
             else:
                 action = np.random.randint(0, self.action_dim)
             return action
 
+    def choose_actions(self, states, epsilon):
+        # One forward pass for a batch of states, e.g. from VecUCLB; epsilon-greedy per row
+        with torch.no_grad():
+            q = self.net(torch.tensor(states, dtype=torch.float))
+            actions = self.greedy_actions(q).numpy()
+            explore = np.random.uniform(size=len(actions)) <= epsilon
+            actions[explore] = np.random.randint(0, self.action_dim, size=explore.sum())
+            return actions
+
     def choose_random_action(self, num_actions):
             action = random.randint(0, num_actions-1)
             return action
@@ -57,18 +73,29 @@ class DQN(object):
                 # Use online_net to select the action
                 a_argmax = self.net(batch['next_state']).argmax(dim=-1, keepdim=True)  # shape：(batch_size,1)
                 # Use target_net to estimate the q_target
-                q_target = batch['reward'] + self.gamma * (1 - batch['terminal']) * self.target_net(batch['next_state']).gather(-1, a_argmax).squeeze(-1)  # shape：(batch_size,)
+                q_next = self.target_net(batch['next_state']).gather(-1, a_argmax).squeeze(-1)  # shape：(batch_size,) or (batch_size,user_num)
             else:
-                q_target = batch['reward'] + self.gamma * (1 - batch['terminal']) * self.target_net(batch['next_state']).max(dim=-1)[0]  # shape：(batch_size,)
-
-        q_current = self.net(batch['state']).gather(-1, batch['action']).squeeze(-1)  # shape：(batch_size,)
-        td_errors = q_current - q_target  # shape：(batch_size,)
+                q_next = self.target_net(batch['next_state']).max(dim=-1)[0]  # shape：(batch_size,) or (batch_size,user_num)
+            if self.use_branching:  # One target shared by all branches: the mean of their next-state values
+                q_next = q_next.mean(dim=-1)
+            q_target = batch['reward'] + self.gamma * (1 - batch['terminal']) * q_next  # shape：(batch_size,)
+
+        if self.use_branching:
+            # Every branch is regressed to the shared target on the server its user took; PER uses the mean absolute TD error
+            branch_actions = self.net.branch_actions(batch['action']).unsqueeze(-1)  # shape：(batch_size,user_num,1)
+            branch_errors = self.net(batch['state']).gather(-1, branch_actions).squeeze(-1) - q_target.unsqueeze(-1)  # shape：(batch_size,user_num)
+            squared_errors = (branch_errors ** 2).mean(dim=-1)
+            td_errors = branch_errors.abs().mean(dim=-1)  # shape：(batch_size,)
+        else:
+            q_current = self.net(batch['state']).gather(-1, batch['action']).squeeze(-1)  # shape：(batch_size,)
+            td_errors = q_current - q_target  # shape：(batch_size,)
+            squared_errors = td_errors ** 2
 
         if self.use_per:
-            loss = (IS_weight * (td_errors ** 2)).mean()
+            loss = (IS_weight * squared_errors).mean()
             replay_buffer.update_batch_priorities(batch_index, td_errors.detach().numpy())
         else:
-            loss = (td_errors ** 2).mean()
+            loss = squared_errors.mean()
 
         self.optimizer.zero_grad()
         loss.backward()
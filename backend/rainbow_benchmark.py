@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import torch
+from rainbow_sum_tree import SumTree
+from env_uclb import UCLB, VecUCLB
+from rainbow_network import Dueling_Net
+from rainbow_policy import PolicyServer, EagerPolicy, FrozenPolicy
+from rainbow_export import export_policy
+from rainbow_replay_buffer import N_Steps_Prioritized_ReplayBuffer, Compact_Prioritized_ReplayBuffer, gather_batch
+
+
+def get_batch_index_scalar(sum_tree, current_size, batch_size, beta):
+    # Reference path: one Python tree walk per sample (the pre-vectorized SumTree.get_batch_index)
+    batch_index = np.zeros(batch_size, dtype=np.int64)
+    IS_weight = torch.zeros(batch_size, dtype=torch.float32)
+    segment = sum_tree.priority_sum / batch_size
+    for i in range(batch_size):
+        a = segment * i
+        b = segment * (i + 1)
+        v = np.random.uniform(a, b)
+        index, priority = sum_tree.get_index(v)
+        batch_index[i] = index
+        prob = priority / sum_tree.priority_sum
+        IS_weight[i] = (current_size * prob) ** (-beta)
+    IS_weight /= IS_weight.max()
+
+    return batch_index, IS_weight
+
+
+def timeit(fn, repeats):
+    fn()  # Warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_sum_tree_sampling(args):
+    sum_tree = SumTree(args.buffer_capacity)
+    priorities = np.random.uniform(0.01, 2.0, size=args.buffer_capacity)
+    for index, priority in enumerate(priorities):
+        sum_tree.update(data_index=index, priority=priority)
+
+    # Both paths must draw the same samples from the same random stream
+    np.random.seed(0)
+    index_scalar, weight_scalar = get_batch_index_scalar(sum_tree, args.buffer_capacity, args.batch_size, args.beta)
+    np.random.seed(0)
+    index_batched, weight_batched = sum_tree.get_batch_index(args.buffer_capacity, args.batch_size, args.beta)
+    assert np.array_equal(index_scalar, index_batched), "Batched descent selected different leaves"
+    # The scalar path normalizes by the batch max weight, the tree normalizes by the global max weight
+    assert torch.allclose(weight_scalar, weight_batched / weight_batched.max()), "Batched descent produced different IS weights"
+
+    t_scalar = timeit(lambda: get_batch_index_scalar(sum_tree, args.buffer_capacity, args.batch_size, args.beta), args.repeats)
+    t_batched = timeit(lambda: sum_tree.get_batch_index(args.buffer_capacity, args.batch_size, args.beta), args.repeats)
+    print("SumTree.get_batch_index (capacity={}, batch_size={})".format(args.buffer_capacity, args.batch_size))
+    print("  scalar : {:.3f} ms".format(t_scalar * 1e3))
+    print("  batched: {:.3f} ms  ({:.1f}x)".format(t_batched * 1e3, t_scalar / t_batched))
+
+
+def bench_sum_tree_update(args):
+    sum_tree = SumTree(args.buffer_capacity)
+    batch_index = np.random.randint(0, args.buffer_capacity, size=args.batch_size)
+    priorities = np.random.uniform(0.01, 2.0, size=args.batch_size)
+
+    def update_scalar():
+        for index, priority in zip(batch_index, priorities):
+            sum_tree.update(data_index=index, priority=priority)
+
+    t_scalar = timeit(update_scalar, args.repeats)
+    t_batched = timeit(lambda: sum_tree.update_batch(data_index=batch_index, priority=priorities), args.repeats)
+    print("SumTree.update_batch (capacity={}, batch_size={})".format(args.buffer_capacity, args.batch_size))
+    print("  scalar : {:.3f} ms".format(t_scalar * 1e3))
+    print("  batched: {:.3f} ms  ({:.1f}x)".format(t_batched * 1e3, t_scalar / t_batched))
+
+
+def sample_copy(replay_buffer, index):
+    # Reference path: fancy-index every array, then copy it again into a new tensor (the pre-allocation-free sample())
+    batch = {}
+    for key in replay_buffer.buffer.keys():
+        if key == 'action':
+            batch[key] = torch.tensor(replay_buffer.buffer[key][index], dtype=torch.long)
+        else:
+            batch[key] = torch.tensor(replay_buffer.buffer[key][index], dtype=torch.float32)
+    return batch
+
+
+def bench_replay_sample(args):
+    buffer_args = argparse.Namespace(gamma=0.99, batch_size=args.batch_size, buffer_capacity=args.buffer_capacity, state_dim=args.state_dim,
+                                     n_steps=5, use_n_steps=True, max_train_steps=int(1e6), alpha=0.6, beta_init=args.beta, buffer_dir=None)
+    classic = N_Steps_Prioritized_ReplayBuffer(buffer_args)
+    compact = Compact_Prioritized_ReplayBuffer(buffer_args)
+    for step in range(args.buffer_capacity):
+        state, next_state = np.random.rand(args.state_dim), np.random.rand(args.state_dim)
+        done = step % 8 == 7
+        classic.store_transition(state, step % 3, -1.0, next_state, done, done)
+        compact.store_transition(state, step % 3, -1.0, next_state, done, done)
+    index = np.random.randint(0, classic.current_size, size=args.batch_size)
+    compact_index = compact.sample_index()  # Slots that hold a transition
+
+    t_copy = timeit(lambda: sample_copy(classic, index), args.repeats)
+    t_classic = timeit(lambda: gather_batch(classic.buffer_tensors, index, classic.batch), args.repeats)
+    t_compact = timeit(lambda: compact.get_batch(compact_index), args.repeats)
+    print("replay batch gather (capacity={}, batch_size={}, state_dim={})".format(args.buffer_capacity, args.batch_size, args.state_dim))
+    print("  copying                   : {:.1f} us".format(t_copy * 1e6))
+    print("  preallocated              : {:.1f} us  ({:.1f}x)".format(t_classic * 1e6, t_copy / t_classic))
+    print("  preallocated, compact     : {:.1f} us  ({:.1f}x)".format(t_compact * 1e6, t_copy / t_compact))
+    t_classic = timeit(lambda: classic.sample(0), args.repeats)
+    t_compact = timeit(lambda: compact.sample(0), args.repeats)
+    print("  sample() per learner step : {:.1f} us, compact {:.1f} us".format(t_classic * 1e6, t_compact * 1e6))
+
+def bench_env_collection(args):
+    env = UCLB()
+    net_args = argparse.Namespace(state_dim=env.observation_space.shape[0], action_dim=env.action_space.n, hidden_dim=256, use_noisy=True)
+    net = Dueling_Net(net_args)
+    steps = 2000
+
+    def collect_single():
+        state = env.reset()
+        for _ in range(steps):
+            with torch.no_grad():
+                action = net(torch.unsqueeze(torch.tensor(state, dtype=torch.float), 0)).argmax(dim=-1).item()
+            state, reward, done = env.step(action)
+            if done:
+                state = env.reset()
+
+    print("UCLB data collection, policy forward pass included")
+    with contextlib.redirect_stdout(io.StringIO()):  # The envs print a summary per episode
+        t_single = timeit(collect_single, 1)
+    print("  UCLB           : {:.0f} transitions/s".format(steps / t_single))
+    for num_envs in args.num_envs:
+        vec_env = VecUCLB(num_envs)
+
+        def collect_vec():
+            states = vec_env.reset()
+            for _ in range(steps // num_envs):
+                with torch.no_grad():
+                    actions = net(torch.tensor(states, dtype=torch.float)).argmax(dim=-1).numpy()
+                vec_env.step(actions)
+                states = vec_env.states
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            t_vec = timeit(collect_vec, 1)
+        print("  VecUCLB({:>4d}) : {:.0f} transitions/s".format(num_envs, (steps // num_envs) * num_envs / t_vec))
+
+
+def bench_frozen_policy(args):
+    net_args = argparse.Namespace(state_dim=4, action_dim=3, hidden_dim=256, use_noisy=True)
+    net = Dueling_Net(net_args)
+    net.eval()
+    with tempfile.TemporaryDirectory() as tmp:
+        frozen = FrozenPolicy(export_policy(net, os.path.join(tmp, 'policy.pt'), state_dim=4, action_dim=3))
+    eager = EagerPolicy(net, state_dim=4)
+
+    def choose_action(state):  # What DQN.choose_action does per decision
+        with torch.no_grad():
+            return net(torch.unsqueeze(torch.tensor(state, dtype=torch.float), 0)).argmax(dim=-1).item()
+
+    print("policy inference (eager vs frozen TorchScript)")
+    for batch_size in (1, args.batch_size):
+        states = np.random.rand(batch_size, 4).astype(np.float32)
+        assert (eager.predict(states) == frozen.predict(states)).all()
+        if batch_size == 1:
+            t_choose = timeit(lambda: choose_action(states[0]), args.repeats * 20)
+            print("  batch {:>4d} choose_action : {:.1f} us".format(batch_size, t_choose * 1e6))
+        t_eager = timeit(lambda: eager.predict(states), args.repeats * 20)
+        t_frozen = timeit(lambda: frozen.predict(states), args.repeats * 20)
+        print("  batch {:>4d} eager         : {:.1f} us".format(batch_size, t_eager * 1e6))
+        print("  batch {:>4d} frozen        : {:.1f} us ({:.1f}x)".format(batch_size, t_frozen * 1e6, t_eager / t_frozen))
+
+
+def bench_policy_server(args):
+    net_args = argparse.Namespace(state_dim=4, action_dim=3, hidden_dim=256, use_noisy=True)
+    net = Dueling_Net(net_args)
+    net.eval()
+    policy = PolicyServer(EagerPolicy(net, state_dim=4))
+    lock = threading.Lock()
+
+    def decide_unbatched(state):  # One forward pass per request, serialized like a shared model would be
+        with lock, torch.no_grad():
+            return net(torch.tensor(state, dtype=torch.float32).unsqueeze(0)).argmax(dim=-1).item()
+
+    print("placement decision latency ({} concurrent clients x {} decisions)".format(args.clients, args.repeats))
+    for name, decide in (("per-request", decide_unbatched), ("micro-batched", policy.decide)):
+        latencies = []
+
+        def client():
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                decide(np.random.rand(4))
+                latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=client) for _ in range(args.clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print("  {:<13}: p50 {:.3f} ms, p99 {:.3f} ms, {:.0f} decisions/s".format(
+            name, np.percentile(latencies, 50) * 1e3, np.percentile(latencies, 99) * 1e3, len(latencies) / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Micro-benchmarks for the Rainbow DQN components")
+    parser.add_argument("--buffer_capacity", type=int, default=int(1e5), help="The maximum replay-buffer capacity ")
+    parser.add_argument("--batch_size", type=int, default=256, help="batch size")
+    parser.add_argument("--state_dim", type=int, default=4, help="Dimension of the stored observations")
+    parser.add_argument("--beta", type=float, default=0.4, help="Important sampling parameter in PER")
+    parser.add_argument("--num_envs", type=int, nargs='+', default=[8, 64], help="VecUCLB sizes to benchmark")
+    parser.add_argument("--clients", type=int, default=200, help="Concurrent clients for the placement benchmark")
+    parser.add_argument("--repeats", type=int, default=50, help="Timed repetitions per benchmark")
+    args = parser.parse_args()
+
+    bench_sum_tree_sampling(args)
+    bench_sum_tree_update(args)
+    bench_replay_sample(args)
+    bench_env_collection(args)
+    bench_frozen_policy(args)
+    bench_policy_server(args)
@@ -0,0 +1,207 @@
+import copy
+import queue
+import random
+from collections import deque
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from env_uclb import UCLB
+from rainbow_agent import DQN
+from rainbow_network import Branching_Dueling_Net
+from rainbow_replay_buffer import Prioritized_ReplayBuffer, ReplayBuffer, BatchPrefetcher
+
+
+def get_n_steps_transition(n_steps_deque, gamma):
+    # Same rule as N_Steps_ReplayBuffer.get_n_steps_transition, on an actor's own deque
+    state, action = n_steps_deque[0][:2]
+    next_state, terminal = n_steps_deque[-1][3:5]
+    n_steps_reward = 0
+    for i in reversed(range(len(n_steps_deque))):
+        r, s_, ter, d = n_steps_deque[i][2:]
+        n_steps_reward = r + gamma * (1 - d) * n_steps_reward
+        if d:
+            next_state, terminal = s_, ter
+
+    return state, action, n_steps_reward, next_state, terminal
+
+
+def actor_process(args, actor_id, shared_net, net_version, transition_queue, stop_event):
+    """
+    Runs its own UCLB with a local copy of the learner's network, re-synced from shared memory
+    every args.sync_freq steps. Transitions are folded into n-steps transitions here, so the learner
+    never mixes the streams of different actors, and are sent in blocks with their initial priorities.
+    """
+    torch.set_num_threads(1)  # One core per actor
+    seed = args.seed + 1000 * (actor_id + 1)
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    env = UCLB(args.user_num)
+    net = copy.deepcopy(shared_net)
+    local_version = -1
+    n_steps = args.n_steps if args.use_n_steps else 1
+    gamma = args.gamma ** n_steps
+    n_steps_deque = deque(maxlen=n_steps)
+    block = []
+    if args.use_noisy:
+        epsilon = 0
+    else:
+        epsilon = args.epsilon_init
+        epsilon_decay = (args.epsilon_init - args.epsilon_min) / args.epsilon_decay_steps
+
+    steps = 0
+    while not stop_event.is_set():
+        state = env.reset()
+        done = False
+        while not done and not stop_event.is_set():
+            if steps % args.sync_freq == 0 and net_version.value != local_version:
+                with net_version.get_lock():
+                    net.load_state_dict(shared_net.state_dict())
+                    local_version = net_version.value
+
+            with torch.no_grad():
+                q = net(torch.unsqueeze(torch.tensor(state, dtype=torch.float), 0))
+            greedy = net.joint_actions(q) if args.use_branching else q.argmax(dim=-1)
+            action = greedy.item() if np.random.uniform() > epsilon else np.random.randint(0, args.action_dim)
+            next_state, reward, done = env.step(action)
+            steps += 1
+            if not args.use_noisy:
+                epsilon = max(epsilon - epsilon_decay, args.epsilon_min)
+
+            n_steps_deque.append((state, action, reward, next_state, done, done))
+            if len(n_steps_deque) == n_steps:
+                block.append(get_n_steps_transition(n_steps_deque, args.gamma))
+            state = next_state
+
+            if len(block) == args.actor_send_size:
+                transition_queue.put(make_block(net, block, gamma, args.alpha, env))
+                block = []
+
+
+def make_block(net, block, gamma, alpha, env):
+    states, actions, rewards, next_states, terminals = (np.array(x) for x in zip(*block))
+    with torch.no_grad():  # Initial priorities from the actor's own TD errors, with its network as both online and target network
+        s = torch.tensor(states, dtype=torch.float32)
+        s_ = torch.tensor(next_states, dtype=torch.float32)
+        a = torch.tensor(actions, dtype=torch.long).unsqueeze(-1)
+        if isinstance(net, Branching_Dueling_Net):  # Same shared target and mean absolute branch error as DQN.learn
+            q_next = net(s_).max(dim=-1)[0].mean(dim=-1).numpy()
+            q = net(s).gather(-1, net.branch_actions(a).unsqueeze(-1)).squeeze(-1).numpy()  # (block, user_num)
+            td_errors = np.abs(q - (rewards + gamma * (1 - terminals) * q_next)[:, None]).mean(axis=-1)
+        else:
+            q_next = net(s_).max(dim=-1)[0].numpy()
+            q = net(s).gather(-1, a).squeeze(-1).numpy()
+            td_errors = q - (rewards + gamma * (1 - terminals) * q_next)
+    priorities = (np.abs(td_errors) + 0.01) ** alpha
+    # The env step logs travel with the block, so the learner can fill the same result matrices as Runner
+    logs = (env.step_reward_list[:], env.step_delay_list[:], env.step_mad_list[:])
+    del env.step_reward_list[:], env.step_delay_list[:], env.step_mad_list[:]
+    return states, actions, rewards, next_states, terminals, priorities, logs
+
+
+def check_actors(actors):
+    # Actors only stop when told to: raise instead of waiting on a queue nobody fills any more
+    failed = [actor.exitcode for actor in actors if actor.exitcode not in (None, 0)]
+    if failed:
+        raise RuntimeError("{} actor process(es) exited with code(s) {}".format(len(failed), failed))
+    if not any(actor.is_alive() for actor in actors):
+        raise RuntimeError("All actor processes exited")
+
+
+class DistributedRunner:
+    """
+    Learner side of the actor/learner mode: args.num_actors actor processes collect with UCLB,
+    this process owns the replay buffer and trains DQN.net, and publishes its weights every args.sync_freq learning steps.
+    Exposes the same env logs and agent as Runner, so the training script can treat both alike.
+    """
+
+    def __init__(self, args, number, seed):
+        self.args = args
+        self.number = number
+        self.seed = seed
+        self.env = UCLB(args.user_num)  # Only for the spaces and the collected step logs, the actors step their own copies
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+        self.args.seed = seed
+        self.args.state_dim = self.env.observation_space.shape[0]
+        self.args.action_dim = self.env.action_space.n
+        self.args.user_num = self.env.user_num
+        self.args.server_num = self.env.server_num
+        self.args.episode_limit = self.env.slot_num
+        print("state_dim={}".format(self.args.state_dim))
+        print("action_dim={}".format(self.args.action_dim))
+        print("num_actors={}".format(self.args.num_actors))
+
+        # n-steps transitions are folded by the actors, so the learner stores them in a 1-step buffer
+        if args.use_per:
+            self.replay_buffer = Prioritized_ReplayBuffer(args)
+        else:
+            self.replay_buffer = ReplayBuffer(args)
+        if args.prefetch_batches > 0:
+            self.replay_buffer = BatchPrefetcher(self.replay_buffer, args.prefetch_batches)
+        self.agent = DQN(args)
+        self.algorithm = 'distributed_dqn'
+        self.total_steps = 0  # Env steps the actors reported, the run stops once it reaches args.max_train_steps
+        self.blocks = 0  # Transition blocks received from the actors
+        self.learn_steps = 0
+
+    def publish(self, shared_net, net_version):
+        with net_version.get_lock():
+            shared_net.load_state_dict(self.agent.net.state_dict())
+            net_version.value += 1
+
+    def run(self, ):
+        ctx = mp.get_context('spawn')
+        shared_net = copy.deepcopy(self.agent.net).share_memory()
+        net_version = ctx.Value('i', 0)
+        transition_queue = ctx.Queue(maxsize=4 * self.args.num_actors)
+        stop_event = ctx.Event()
+        actors = [ctx.Process(target=actor_process, args=(self.args, i, shared_net, net_version, transition_queue, stop_event), daemon=True)
+                  for i in range(self.args.num_actors)]
+        for actor in actors:
+            actor.start()
+
+        max_blocks = self.args.max_blocks_per_learn or self.args.num_actors
+        try:
+            while self.total_steps < self.args.max_train_steps:
+                # Take up to max_blocks of what the actors produced, so fast actors cannot starve learn();
+                # only block when there is nothing to learn from yet
+                block_wait = self.replay_buffer.current_size < self.args.batch_size
+                try:
+                    for _ in range(max_blocks):
+                        self.store_block(transition_queue.get(block=block_wait, timeout=1.0 if block_wait else None))
+                        block_wait = False
+                except queue.Empty:
+                    check_actors(actors)
+
+                if self.replay_buffer.current_size >= self.args.batch_size:
+                    self.agent.learn(self.replay_buffer, min(self.total_steps, self.args.max_train_steps))
+                    self.learn_steps += 1
+                    if self.learn_steps % self.args.sync_freq == 0:
+                        self.publish(shared_net, net_version)
+        finally:
+            stop_event.set()
+            while any(actor.is_alive() for actor in actors):  # Drain, so actors blocked on a full queue can exit
+                try:
+                    transition_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for actor in actors:
+                actor.join()
+            if self.args.prefetch_batches > 0:
+                self.replay_buffer.close()
+
+    def store_block(self, block):
+        states, actions, rewards, next_states, terminals, priorities, logs = block
+        for i in range(len(states)):
+            if self.args.use_per:
+                self.replay_buffer.store_transition(states[i], actions[i], rewards[i], next_states[i], terminals[i], terminals[i], priority=priorities[i])
+            else:
+                self.replay_buffer.store_transition(states[i], actions[i], rewards[i], next_states[i], terminals[i], terminals[i])
+        self.blocks += 1
+        self.total_steps += len(logs[0])
+        self.env.step_reward_list.extend(logs[0])
+        self.env.step_delay_list.extend(logs[1])
+        self.env.step_mad_list.extend(logs[2])
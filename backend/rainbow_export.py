@@ -0,0 +1,60 @@
+import argparse
+import copy
+import json
+import torch
+import torch.nn as nn
+from rainbow_network import NoisyLinear
+
+
+def fold_noisy(net):
+    # Replace every NoisyLinear by a plain nn.Linear holding its mean weights, what the layer computes in eval mode
+    net = copy.deepcopy(net)
+    for parent in list(net.modules()):
+        for name, module in list(parent.named_children()):
+            if isinstance(module, NoisyLinear):
+                linear = nn.Linear(module.in_features, module.out_features)
+                linear.weight.data.copy_(module.weight_mu.data)
+                linear.bias.data.copy_(module.bias_mu.data)
+                setattr(parent, name, linear)
+    return net.eval()
+
+
+def quantize_int8(net):
+    """
+    Post-training dynamic int8 quantization of fc2 / A / V (fc3 for Net): int8 weights, activations quantized per call.
+    fc1 stays float: it sees the raw UCLB observation, whose loads span 0 to 5e8, which no int8 scale covers,
+    and its 4 x hidden_dim weights are too small to be worth quantizing.
+    """
+    return torch.ao.quantization.quantize_dynamic(fold_noisy(net), {'fc2', 'A', 'V', 'fc3'}, dtype=torch.qint8)
+
+
+def export_policy(net, path, state_dim, action_dim, quantize=False):
+    """
+    Freezes the Q-network for CPU inference: noisy layers folded to their means, optionally quantized to int8,
+    scripted with TorchScript, parameters inlined as constants and the graph optimized for inference.
+    state_dim / action_dim travel with the artifact.
+    """
+    folded = quantize_int8(net) if quantize else fold_noisy(net)
+    for param in folded.parameters():
+        param.requires_grad_(False)
+    module = torch.jit.optimize_for_inference(torch.jit.script(folded))
+    extra_files = {'policy.json': json.dumps({'state_dim': state_dim, 'action_dim': action_dim, 'quantized': quantize})}
+    torch.jit.save(module, path, _extra_files=extra_files)
+    return path
+
+
+if __name__ == '__main__':
+    from rainbow_policy import load_policy_net
+
+    parser = argparse.ArgumentParser("Export a trained Q-network as a frozen TorchScript policy")
+    parser.add_argument("--checkpoint", type=str, default="rainbow_dqn_net_1_users.pth", help="state_dict saved by rainbow_train.py")
+    parser.add_argument("--output", type=str, default="rainbow_policy_1_users.pt", help="Where to save the frozen policy")
+    parser.add_argument("--state_dim", type=int, default=4, help="UCLB observation size (user_num + server_num)")
+    parser.add_argument("--action_dim", type=int, default=3, help="UCLB action count (server_num ** user_num)")
+    parser.add_argument("--hidden_dim", type=int, default=256, help="The number of neurons in hidden layers of the neural network")
+    parser.add_argument("--quantize", type=bool, default=False, help="Whether to quantize the linear layers to int8, check it with rainbow_quant_check.py first")
+    args = parser.parse_args()
+
+    net = load_policy_net(args.checkpoint, args.state_dim, args.action_dim, args.hidden_dim)
+    export_policy(net, args.output, args.state_dim, args.action_dim, args.quantize)
+    print("frozen policy saved to", args.output)
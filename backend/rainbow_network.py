@@ -25,6 +25,47 @@ class Dueling_Net(nn.Module):
         return Q
 
 
+class Branching_Dueling_Net(nn.Module):
+    """
+    Action branching: one advantage branch per user over the server_num servers and a shared value stream,
+    instead of one output per joint action (server_num ** user_num). Q is batch_size X user_num X server_num,
+    with Q_d(s,a_d) = V(s) + A_d(s,a_d) - mean(A_d(s,a_d)) on each branch d.
+    The branches share one A layer of user_num * server_num outputs, so the head grows linearly with the users;
+    with a single user it is Dueling_Net, and its checkpoints load as one.
+    """
+
+    def __init__(self, args):
+        super(Branching_Dueling_Net, self).__init__()
+        self.num_branches = args.user_num
+        self.branch_dim = args.server_num
+        self.fc1 = nn.Linear(args.state_dim, args.hidden_dim)
+        self.fc2 = nn.Linear(args.hidden_dim, args.hidden_dim)
+        if args.use_noisy:
+            self.V = NoisyLinear(args.hidden_dim, 1)
+            self.A = NoisyLinear(args.hidden_dim, self.num_branches * self.branch_dim)
+        else:
+            self.V = nn.Linear(args.hidden_dim, 1)
+            self.A = nn.Linear(args.hidden_dim, self.num_branches * self.branch_dim)
+        # Place value of each user's server in the joint action index, the encoding UCLB.decode_action reads
+        self.register_buffer('digits', self.branch_dim ** torch.arange(self.num_branches), persistent=False)
+
+    def forward(self, s):
+        s = torch.relu(self.fc1(s))
+        s = torch.relu(self.fc2(s))
+        V = self.V(s).unsqueeze(-1)  # batch_size X 1 X 1
+        A = self.A(s).view(-1, self.num_branches, self.branch_dim)  # batch_size X user_num X server_num
+        Q = V + (A - torch.mean(A, dim=-1, keepdim=True))
+        return Q
+
+    def joint_actions(self, q):
+        # Each user's server is picked on its own branch: batch_size X user_num X server_num -> joint action indices (batch_size,)
+        return (q.argmax(dim=-1) * self.digits).sum(dim=-1)
+
+    def branch_actions(self, actions):
+        # Joint action indices (batch_size, 1) -> each user's server (batch_size, user_num)
+        return actions // self.digits % self.branch_dim
+
+
 class Net(nn.Module):
     def __init__(self, args):
         super(Net, self).__init__()
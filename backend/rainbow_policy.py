@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+import torch
+from rainbow_network import Branching_Dueling_Net, Dueling_Net, Net
+
+
+def branching_shape(state_dim, action_dim, advantage_dim):
+    # (user_num, server_num) of a branching head with advantage_dim = user_num * server_num outputs, where
+    # state_dim = user_num + server_num and action_dim = server_num ** user_num; None for a head with one output per action
+    for user_num in range(2, state_dim):
+        server_num = state_dim - user_num
+        if user_num * server_num == advantage_dim and server_num ** user_num == action_dim:
+            return user_num, server_num
+    return None
+
+
+def load_policy_net(path, state_dim, action_dim, hidden_dim=256):
+    # Rebuild the network a checkpoint was trained with, from the names and shapes of its parameters
+    state_dict = torch.load(path, map_location='cpu')
+    args = argparse.Namespace(state_dim=state_dim, action_dim=action_dim, hidden_dim=hidden_dim,
+                              use_noisy=any(key.endswith('weight_mu') for key in state_dict))
+    if 'V.bias' in state_dict or 'V.bias_mu' in state_dict:
+        advantage_dim = len(state_dict['A.bias_mu' if args.use_noisy else 'A.bias'])
+        shape = branching_shape(state_dim, action_dim, advantage_dim) if advantage_dim != action_dim else None
+        if shape is not None:
+            args.user_num, args.server_num = shape
+            net = Branching_Dueling_Net(args)
+        else:
+            net = Dueling_Net(args)
+    else:
+        net = Net(args)
+    net.load_state_dict(state_dict)
+    net.eval()  # NoisyLinear uses its mean weights
+    return net
+
+
+class EagerPolicy(object):
+    # predict() on an eager network, e.g. straight out of load_policy_net
+    def __init__(self, net, state_dim):
+        self.net = net
+        self.inputs = torch.zeros(1, state_dim)  # Reused input buffer, grown on demand
+        self.lock = threading.Lock()  # The input buffer is shared by the threads calling predict()
+
+    def predict(self, states):
+        states = np.asarray(states, dtype=np.float32).reshape(-1, self.inputs.shape[1])
+        with self.lock:
+            if len(states) > len(self.inputs):
+                self.inputs = torch.zeros(len(states), self.inputs.shape[1])
+            inputs = self.inputs[:len(states)]
+            inputs.copy_(torch.from_numpy(states))
+            with torch.inference_mode():
+                q = self.net(inputs)
+                if q.dim() == 3:  # Branching head: each user's server from its own branch, as the joint action index
+                    return (q.argmax(dim=-1) * q.shape[-1] ** torch.arange(q.shape[1])).sum(dim=-1).numpy()
+                return q.argmax(dim=-1).numpy()
+
+
+class FrozenPolicy(EagerPolicy):
+    # predict() on a frozen TorchScript policy saved by rainbow_export.export_policy
+    def __init__(self, path):
+        extra_files = {'policy.json': ''}
+        module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+        meta = json.loads(extra_files['policy.json'])
+        super(FrozenPolicy, self).__init__(module, meta['state_dim'])
+        self.action_dim = meta['action_dim']
+        self.quantized = meta.get('quantized', False)
+
+
+def load_frozen_policy(artifact, checkpoint, state_dim, action_dim, hidden_dim=256, quantize=False):
+    # Load the frozen policy, exporting it from the training checkpoint first if it does not exist yet
+    if not os.path.exists(artifact):
+        from rainbow_export import export_policy
+        export_policy(load_policy_net(checkpoint, state_dim, action_dim, hidden_dim), artifact, state_dim, action_dim, quantize)
+    policy = FrozenPolicy(artifact)
+    if policy.quantized != quantize:
+        raise ValueError("{} holds a {} policy, expected {}".format(artifact, 'int8' if policy.quantized else 'float', 'int8' if quantize else 'float'))
+    return policy
+
+
+def rollout_plan(policy, total_chunks, chunk_indices, node_load, chunk_load, room=None, spread=None):
+    """
+    Places chunk_indices of a file of total_chunks chunks in one go, following the UCLB state dynamics:
+    chunk i is placed from the state [total_chunks - i, node loads], and adds chunk_load to the node it goes to.
+    Each state depends on the previous action, so the rollout is sequential, but it runs in-process without a
+    request per chunk. room optionally holds the load each node can still take (e.g. from its free disk space):
+    a chunk the policy sends to a node without room goes to the least loaded node that has room, and stays
+    where the policy put it when none has. With spread, the chunks of each group of spread consecutive chunk indices
+    (e.g. the data shards of an erasure-coded group) go to distinct nodes: a chunk the policy sends to a node its group
+    already uses goes to the least loaded node the group does not use, preferring nodes with room.
+    Returns the actions and the node loads after the plan.
+    """
+    load = np.array(node_load, dtype=np.float32)
+    room = np.array(room, dtype=np.float64) if room is not None else None
+    state = np.empty(1 + len(load), dtype=np.float32)
+    actions = np.empty(len(chunk_indices), dtype=np.int64)
+    groups = {}
+    for k, chunk_index in enumerate(chunk_indices):
+        state[0] = total_chunks - chunk_index
+        state[1:] = load
+        action = policy.predict(state)[0]
+        allowed = np.ones(len(load), dtype=bool)
+        if spread is not None:
+            taken = groups.setdefault(chunk_index // spread, [])
+            allowed[taken] = False
+        fits = allowed & (room >= chunk_load) if room is not None else allowed
+        if not fits[action] and (fits.any() or not allowed[action]):
+            candidates = np.flatnonzero(fits if fits.any() else allowed)
+            if len(candidates):
+                action = candidates[np.argmin(load[candidates])]
+        if room is not None:
+            room[action] -= chunk_load
+        if spread is not None:
+            taken.append(action)
+        actions[k] = action
+        load[action] += chunk_load
+    return actions, load
+
+
+class PendingDecision(object):
+    def __init__(self, state):
+        self.state = state
+        self.action = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class PolicyServer(object):
+    """
+    Micro-batches concurrent placement decisions: requests arriving within max_wait seconds of the first one
+    (at most max_batch of them) are answered with a single policy.predict() call.
+    """
+
+    def __init__(self, policy, max_batch=256, max_wait=0.0005):
+        self.policy = policy
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def decide(self, state):
+        pending = PendingDecision(state)
+        self.requests.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise RuntimeError("Policy forward pass failed: {}".format(pending.error))
+        return pending.action
+
+    def serve(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                actions = self.policy.predict(np.array([pending.state for pending in batch], dtype=np.float32)).tolist()
+            except Exception as e:  # Never leave a request waiting
+                actions = [None] * len(batch)
+                for pending in batch:
+                    pending.error = e
+            for pending, action in zip(batch, actions):
+                pending.action = action
+                pending.done.set()
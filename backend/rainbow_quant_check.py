@@ -0,0 +1,98 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+from env_uclb import UCLB
+from rainbow_export import export_policy
+from rainbow_policy import EagerPolicy, FrozenPolicy, load_policy_net
+
+
+def recorded_states(buffer_dir):
+    # The states of the transitions held by a memory-mapped replay buffer (see Compact_ReplayBuffer)
+    states = np.load(os.path.join(buffer_dir, 'state.npy'), mmap_mode='r')
+    next_index = np.load(os.path.join(buffer_dir, 'next_index.npy'), mmap_mode='r')
+    return np.asarray(states[next_index >= 0], dtype=np.float32)
+
+
+def rollout_states(policy, steps):
+    # The states UCLB visits when the float policy places the chunks
+    env = UCLB()
+    states = []
+    with contextlib.redirect_stdout(io.StringIO()):  # UCLB prints a summary per episode
+        while len(states) < steps:
+            state = env.reset()
+            done = False
+            while not done:
+                states.append(state)
+                state, _, done = env.step(int(policy.predict(state)[0]))
+    return np.array(states[:steps], dtype=np.float32)
+
+
+def time_per_call(policy, states, repeats):
+    policy.predict(states)  # Warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        policy.predict(states)
+    return (time.perf_counter() - start) / repeats
+
+
+def check(args):
+    net = load_policy_net(args.checkpoint, args.state_dim, args.action_dim, args.hidden_dim)
+    with tempfile.TemporaryDirectory() as tmp:
+        float_path = export_policy(net, os.path.join(tmp, 'float.pt'), args.state_dim, args.action_dim)
+        int8_path = export_policy(net, os.path.join(tmp, 'int8.pt'), args.state_dim, args.action_dim, quantize=True)
+        sizes = os.path.getsize(float_path), os.path.getsize(int8_path)
+        float_policy, int8_policy = FrozenPolicy(float_path), FrozenPolicy(int8_path)
+
+    if args.buffer_dir is not None:
+        states = recorded_states(args.buffer_dir)
+        source = args.buffer_dir
+    else:
+        states = rollout_states(EagerPolicy(net, args.state_dim), args.rollout_steps)
+        source = "{} UCLB steps".format(args.rollout_steps)
+    if len(states) == 0:
+        raise ValueError("No recorded states in {}".format(source))
+
+    # Activations are quantized with one scale per call, so the int8 actions can depend on the rest of the batch:
+    # check one state per call (a lone placement request) and args.batch_size states per call (a busy PolicyServer)
+    float_actions = float_policy.predict(states)
+    int8_actions = np.concatenate([int8_policy.predict(state) for state in states])
+    int8_batched_actions = np.concatenate([int8_policy.predict(states[i:i + args.batch_size]) for i in range(0, len(states), args.batch_size)])
+    disagree = np.flatnonzero(float_actions != int8_actions)
+    agreement = 1 - len(disagree) / len(states)
+    batched_agreement = np.mean(float_actions == int8_batched_actions)
+    print("states              : {} from {}".format(len(states), source))
+    print("argmax agreement    : {:.4%} per state ({} disagreements), {:.4%} in batches of {}".format(
+        agreement, len(disagree), batched_agreement, args.batch_size))
+    for i in disagree[:args.show]:
+        print("  state {} float -> {} int8 -> {}".format(states[i].tolist(), float_actions[i], int8_actions[i]))
+    print("artifact size       : float {:.1f} KB, int8 {:.1f} KB".format(sizes[0] / 1024, sizes[1] / 1024))
+    for batch_size in (1, args.batch_size):
+        batch = states[:batch_size]
+        t_float = time_per_call(float_policy, batch, args.repeats)
+        t_int8 = time_per_call(int8_policy, batch, args.repeats)
+        print("batch {:>4d} predict  : float {:.1f} us, int8 {:.1f} us ({:.1f}x)".format(len(batch), t_float * 1e6, t_int8 * 1e6, t_float / t_int8))
+    return min(agreement, batched_agreement)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Check an int8 quantized policy against the float one")
+    parser.add_argument("--checkpoint", type=str, default="rainbow_dqn_net_1_users.pth", help="state_dict saved by rainbow_train.py")
+    parser.add_argument("--state_dim", type=int, default=4, help="UCLB observation size (user_num + server_num)")
+    parser.add_argument("--action_dim", type=int, default=3, help="UCLB action count (server_num ** user_num)")
+    parser.add_argument("--hidden_dim", type=int, default=256, help="The number of neurons in hidden layers of the neural network")
+    parser.add_argument("--buffer_dir", type=str, default=None, help="Replay the states recorded in this replay-buffer directory")
+    parser.add_argument("--rollout_steps", type=int, default=10000, help="Without --buffer_dir, replay the states of this many UCLB steps")
+    parser.add_argument("--min_agreement", type=float, default=0.99, help="Exit with an error below this argmax agreement")
+    parser.add_argument("--batch_size", type=int, default=256, help="Batch size of the batched check and timing")
+    parser.add_argument("--repeats", type=int, default=1000, help="Timed calls per batch size")
+    parser.add_argument("--show", type=int, default=10, help="Number of disagreeing states to print")
+    args = parser.parse_args()
+
+    agreement = check(args)
+    if agreement < args.min_agreement:
+        raise SystemExit("argmax agreement {:.4%} is below {:.4%}".format(agreement, args.min_agreement))
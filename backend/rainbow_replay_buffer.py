@@ -1,7 +1,23 @@
+import queue
+import threading
 import torch
 import numpy as np
 from collections import deque
 from rainbow_sum_tree import SumTree
+from rainbow_storage import open_array, load_state, save_state
+
+
+def get_batch_tensors(buffer_tensors, batch_size):
+    # Preallocated batch tensors, one per buffer key. They are reused by every sample(), so a batch is only valid until the next one
+    return {key: torch.empty((batch_size,) + tuple(value.shape[1:]), dtype=value.dtype) for key, value in buffer_tensors.items()}
+
+
+def gather_batch(buffer_tensors, index, batch):
+    # Gather the rows at index straight into the preallocated batch tensors, without any intermediate copy
+    index = torch.from_numpy(index)
+    for key, value in buffer_tensors.items():
+        torch.index_select(value, 0, index, out=batch[key])
+    return batch
 
 
 class ReplayBuffer(object):
@@ -10,12 +26,14 @@ class ReplayBuffer(object):
         self.buffer_capacity = args.buffer_capacity
         self.current_size = 0
         self.count = 0
-        self.buffer = {'state': np.zeros((self.buffer_capacity, args.state_dim)),
-                       'action': np.zeros((self.buffer_capacity, 1)),
-                       'reward': np.zeros(self.buffer_capacity),
-                       'next_state': np.zeros((self.buffer_capacity, args.state_dim)),
-                       'terminal': np.zeros(self.buffer_capacity),
+        self.buffer = {'state': np.zeros((self.buffer_capacity, args.state_dim), dtype=np.float32),
+                       'action': np.zeros((self.buffer_capacity, 1), dtype=np.int64),
+                       'reward': np.zeros(self.buffer_capacity, dtype=np.float32),
+                       'next_state': np.zeros((self.buffer_capacity, args.state_dim), dtype=np.float32),
+                       'terminal': np.zeros(self.buffer_capacity, dtype=np.float32),
                        }
+        self.buffer_tensors = {key: torch.from_numpy(value) for key, value in self.buffer.items()}  # Share memory with the numpy arrays
+        self.batch = get_batch_tensors(self.buffer_tensors, self.batch_size)
 
     def store_transition(self, state, action, reward, next_state, terminal, done):
         self.buffer['state'][self.count] = state
@@ -28,12 +46,7 @@ class ReplayBuffer(object):
 
     def sample(self, total_steps):
         index = np.random.randint(0, self.current_size, size=self.batch_size)
-        batch = {}
-        for key in self.buffer.keys():  # Convert numpy arrays to tensors
-            if key == 'action':
-                batch[key] = torch.tensor(self.buffer[key][index], dtype=torch.long)
-            else:
-                batch[key] = torch.tensor(self.buffer[key][index], dtype=torch.float32)
+        batch = gather_batch(self.buffer_tensors, index, self.batch)
 
         return batch, None, None
 
@@ -47,12 +60,14 @@ class N_Steps_ReplayBuffer(object):
         self.count = 0
         self.n_steps = args.n_steps
         self.n_steps_deque = deque(maxlen=self.n_steps)
-        self.buffer = {'state': np.zeros((self.buffer_capacity, args.state_dim)),
-                       'action': np.zeros((self.buffer_capacity, 1)),
-                       'reward': np.zeros(self.buffer_capacity),
-                       'next_state': np.zeros((self.buffer_capacity, args.state_dim)),
-                       'terminal': np.zeros(self.buffer_capacity),
+        self.buffer = {'state': np.zeros((self.buffer_capacity, args.state_dim), dtype=np.float32),
+                       'action': np.zeros((self.buffer_capacity, 1), dtype=np.int64),
+                       'reward': np.zeros(self.buffer_capacity, dtype=np.float32),
+                       'next_state': np.zeros((self.buffer_capacity, args.state_dim), dtype=np.float32),
+                       'terminal': np.zeros(self.buffer_capacity, dtype=np.float32),
                        }
+        self.buffer_tensors = {key: torch.from_numpy(value) for key, value in self.buffer.items()}  # Share memory with the numpy arrays
+        self.batch = get_batch_tensors(self.buffer_tensors, self.batch_size)
 
     def store_transition(self, state, action, reward, next_state, terminal, done):
         transition = (state, action, reward, next_state, terminal, done)
@@ -81,12 +96,7 @@ class N_Steps_ReplayBuffer(object):
 
     def sample(self, total_steps):
         index = np.random.randint(0, self.current_size, size=self.batch_size)
-        batch = {}
-        for key in self.buffer.keys():  # Convert numpy arrays to tensors
-            if key == 'action':
-                batch[key] = torch.tensor(self.buffer[key][index], dtype=torch.long)
-            else:
-                batch[key] = torch.tensor(self.buffer[key][index], dtype=torch.float32)
+        batch = gather_batch(self.buffer_tensors, index, self.batch)
 
         return batch, None, None
 
@@ -102,21 +112,25 @@ class Prioritized_ReplayBuffer(object):
         self.sum_tree = SumTree(self.buffer_capacity)
         self.current_size = 0
         self.count = 0
-        self.buffer = {'state': np.zeros((self.buffer_capacity, args.state_dim)),
-                       'action': np.zeros((self.buffer_capacity, 1)),
-                       'reward': np.zeros(self.buffer_capacity),
-                       'next_state': np.zeros((self.buffer_capacity, args.state_dim)),
-                       'terminal': np.zeros(self.buffer_capacity),
+        self.buffer = {'state': np.zeros((self.buffer_capacity, args.state_dim), dtype=np.float32),
+                       'action': np.zeros((self.buffer_capacity, 1), dtype=np.int64),
+                       'reward': np.zeros(self.buffer_capacity, dtype=np.float32),
+                       'next_state': np.zeros((self.buffer_capacity, args.state_dim), dtype=np.float32),
+                       'terminal': np.zeros(self.buffer_capacity, dtype=np.float32),
                        }
+        self.buffer_tensors = {key: torch.from_numpy(value) for key, value in self.buffer.items()}  # Share memory with the numpy arrays
+        self.batch = get_batch_tensors(self.buffer_tensors, self.batch_size)
 
-    def store_transition(self, state, action, reward, next_state, terminal, done):
+    def store_transition(self, state, action, reward, next_state, terminal, done, priority=None):
         self.buffer['state'][self.count] = state
         self.buffer['action'][self.count] = action
         self.buffer['reward'][self.count] = reward
         self.buffer['next_state'][self.count] = next_state
         self.buffer['terminal'][self.count] = terminal
-        # For the first experience, initialize priority to 1.0; for new experiences, assign the current maximum priority
-        priority = 1.0 if self.current_size == 0 else self.sum_tree.priority_max
+        # For the first experience, initialize priority to 1.0; for new experiences, assign the current maximum priority,
+        # unless the caller (e.g. a distributed actor) already computed one
+        if priority is None:
+            priority = 1.0 if self.current_size == 0 else self.sum_tree.priority_max
         self.sum_tree.update(data_index=self.count, priority=priority)  # Update the priority of the current experience in sum_tree
         self.count = (self.count + 1) % self.buffer_capacity  # When the 'count' reaches buffer_capacity, it will be reset to 0.
         self.current_size = min(self.current_size + 1, self.buffer_capacity)
@@ -124,19 +138,13 @@ class Prioritized_ReplayBuffer(object):
     def sample(self, total_steps):
         batch_index, IS_weight = self.sum_tree.get_batch_index(current_size=self.current_size, batch_size=self.batch_size, beta=self.beta)
         self.beta = self.beta_init + (1 - self.beta_init) * (total_steps / self.max_train_steps)  # beta: beta_init->1.0
-        batch = {}
-        for key in self.buffer.keys():  # Convert numpy arrays to tensors
-            if key == 'action':
-                batch[key] = torch.tensor(self.buffer[key][batch_index], dtype=torch.long)
-            else:
-                batch[key] = torch.tensor(self.buffer[key][batch_index], dtype=torch.float32)
+        batch = gather_batch(self.buffer_tensors, batch_index, self.batch)
 
         return batch, batch_index, IS_weight
 
     def update_batch_priorities(self, batch_index, td_errors):  # Update the priorities of the data at batch_index based on the given td_errors
         priorities = (np.abs(td_errors) + 0.01) ** self.alpha
-        for index, priority in zip(batch_index, priorities):
-            self.sum_tree.update(data_index=index, priority=priority)
+        self.sum_tree.update_batch(data_index=batch_index, priority=priorities)
 
 
 class N_Steps_Prioritized_ReplayBuffer(object):
@@ -151,12 +159,14 @@ class N_Steps_Prioritized_ReplayBuffer(object):
         self.sum_tree = SumTree(self.buffer_capacity)
         self.n_steps = args.n_steps
         self.n_steps_deque = deque(maxlen=self.n_steps)
-        self.buffer = {'state': np.zeros((self.buffer_capacity, args.state_dim)),
-                       'action': np.zeros((self.buffer_capacity, 1)),
-                       'reward': np.zeros(self.buffer_capacity),
-                       'next_state': np.zeros((self.buffer_capacity, args.state_dim)),
-                       'terminal': np.zeros(self.buffer_capacity),
+        self.buffer = {'state': np.zeros((self.buffer_capacity, args.state_dim), dtype=np.float32),
+                       'action': np.zeros((self.buffer_capacity, 1), dtype=np.int64),
+                       'reward': np.zeros(self.buffer_capacity, dtype=np.float32),
+                       'next_state': np.zeros((self.buffer_capacity, args.state_dim), dtype=np.float32),
+                       'terminal': np.zeros(self.buffer_capacity, dtype=np.float32),
                        }
+        self.buffer_tensors = {key: torch.from_numpy(value) for key, value in self.buffer.items()}  # Share memory with the numpy arrays
+        self.batch = get_batch_tensors(self.buffer_tensors, self.batch_size)
         self.current_size = 0
         self.count = 0
 
@@ -179,12 +189,7 @@ class N_Steps_Prioritized_ReplayBuffer(object):
     def sample(self, total_steps):
         batch_index, IS_weight = self.sum_tree.get_batch_index(current_size=self.current_size, batch_size=self.batch_size, beta=self.beta)
         self.beta = self.beta_init + (1 - self.beta_init) * (total_steps / self.max_train_steps)  # beta: beta_init->1.0
-        batch = {}
-        for key in self.buffer.keys():  # Convert numpy arrays to tensors
-            if key == 'action':
-                batch[key] = torch.tensor(self.buffer[key][batch_index], dtype=torch.long)
-            else:
-                batch[key] = torch.tensor(self.buffer[key][batch_index], dtype=torch.float32)
+        batch = gather_batch(self.buffer_tensors, batch_index, self.batch)
 
         return batch, batch_index, IS_weight
 
@@ -202,5 +207,270 @@ class N_Steps_Prioritized_ReplayBuffer(object):
 
     def update_batch_priorities(self, batch_index, td_errors):  # Update the priorities of the data at batch_index based on the given td_errors
         priorities = (np.abs(td_errors) + 0.01) ** self.alpha
-        for index, priority in zip(batch_index, priorities):
-            self.sum_tree.update(data_index=index, priority=priority)
+        self.sum_tree.update_batch(data_index=batch_index, priority=priorities)
+
+
+class Compact_ReplayBuffer(object):
+    """
+    Compact storage: float32 observations, integer actions and bool terminals.
+    Every observation is stored once, in the slot of the step it was observed at,
+    and each transition finds its next_state through 'next_index' instead of keeping a second copy.
+    The final next_state of an episode gets a slot of its own, which never holds a transition.
+    Works with 1-step and n-steps transitions.
+    With args.buffer_dir set, all arrays are memory-mapped files in that directory:
+    the capacity is no longer bounded by RAM, and a restarted run reopens the buffer after save().
+    """
+
+    def __init__(self, args):
+        self.gamma = args.gamma
+        self.batch_size = args.batch_size
+        self.buffer_capacity = args.buffer_capacity
+        self.buffer_dir = args.buffer_dir
+        self.current_size = 0  # Number of transitions that can be sampled
+        self.filled_size = 0  # Number of slots written so far (at most buffer_capacity)
+        self.count = 0
+        self.n_steps = args.n_steps if args.use_n_steps else 1
+        self.n_steps_deque = deque(maxlen=self.n_steps)
+        self.buffer = {'state': open_array(self.buffer_dir, 'state', (self.buffer_capacity, args.state_dim), np.float32),
+                       'action': open_array(self.buffer_dir, 'action', (self.buffer_capacity, 1), np.int32),
+                       'reward': open_array(self.buffer_dir, 'reward', (self.buffer_capacity,), np.float32),
+                       'terminal': open_array(self.buffer_dir, 'terminal', (self.buffer_capacity,), bool),
+                       'next_index': open_array(self.buffer_dir, 'next_index', (self.buffer_capacity,), np.int32, fill=-1),  # -1 means the slot holds no transition to sample
+                       }
+        self.buffer_tensors = {key: torch.from_numpy(value) for key, value in self.buffer.items()}  # Share memory with the numpy (or memory-mapped) arrays
+        self.gathered = get_batch_tensors(self.buffer_tensors, self.batch_size)  # Rows in their storage dtype
+        self.batch = {'state': self.gathered['state'],
+                      'action': torch.empty((self.batch_size, 1), dtype=torch.long),
+                      'reward': self.gathered['reward'],
+                      'next_state': torch.empty((self.batch_size, args.state_dim), dtype=torch.float32),
+                      'terminal': torch.empty(self.batch_size, dtype=torch.float32),
+                      }
+
+    def load(self):
+        # Reopen the state of a previous run in buffer_dir, if there is one
+        state = load_state(self.buffer_dir, 'replay_buffer')
+        if state is None:
+            return
+        if state['n_steps'] != self.n_steps:
+            raise ValueError("{} was filled with n_steps={}, got n_steps={}".format(self.buffer_dir, state['n_steps'], self.n_steps))
+        self.filled_size = state['filled_size']
+        # The transitions pending in the saved n_steps_deque are dropped: their slots may have been rewritten after the
+        # last save(), and the episode they belong to does not go on after the restart. The next episode starts past
+        # the slot at 'count', which may hold the next_state of a stored transition, as after a done
+        self.count = (state['count'] + 1) % self.buffer_capacity if state['n_steps_deque'] else state['count']
+        # Writes after the last save() may have linked the pending transitions and the one at 'count' to slots the next
+        # episode overwrites: none of them was stored when the buffer was saved, so they are dropped
+        stored = 1 if len(state['n_steps_deque']) == self.n_steps else 0  # The first transition in a full deque was stored
+        if state['n_steps_deque']:
+            pending = [index for index, *_ in state['n_steps_deque'][stored:]] + [state['count']]
+            self.buffer['next_index'][pending] = -1
+        self.n_steps_deque.clear()
+        self.current_size = int((self.buffer['next_index'] >= 0).sum())  # Count from the data, in case it was written after the last save()
+
+    def get_state(self):
+        return {'n_steps': self.n_steps,
+                'count': self.count,
+                'filled_size': self.filled_size,
+                'n_steps_deque': [[int(index), int(action), float(reward), int(next_index), bool(terminal), bool(done)]
+                                  for index, action, reward, next_index, terminal, done in self.n_steps_deque],
+                }
+
+    def save(self):
+        if self.buffer_dir is not None:
+            save_state(self.buffer_dir, 'replay_buffer', self.get_state(), self.buffer.values())
+
+    def store_transition(self, state, action, reward, next_state, terminal, done):
+        index = self.count
+        next_index = (index + 1) % self.buffer_capacity
+        self.write_state(index, state)
+        self.write_state(next_index, next_state)  # The next step overwrites it with the same state, unless the episode ends here
+        # At the end of an episode, skip the slot holding the final next_state so the next episode does not overwrite it
+        self.count = (next_index + 1) % self.buffer_capacity if done else next_index
+        self.n_steps_deque.append((index, action, reward, next_index, terminal, done))
+        if len(self.n_steps_deque) == self.n_steps:
+            index, action, n_steps_reward, next_index, terminal = self.get_n_steps_transition()
+            new = self.buffer['next_index'][index] < 0  # Only a slot without a transition adds one to current_size
+            self.buffer['action'][index] = action
+            self.buffer['reward'][index] = n_steps_reward
+            self.buffer['terminal'][index] = terminal
+            self.buffer['next_index'][index] = next_index
+            if new:
+                self.insert_transition(index)
+
+    def write_state(self, index, state):
+        if self.buffer['next_index'][index] >= 0:  # The slot still holds an old transition, which is gone from now on
+            self.buffer['next_index'][index] = -1
+            self.remove_transition(index)
+        self.buffer['state'][index] = state
+        self.filled_size = max(self.filled_size, index + 1)
+
+    def insert_transition(self, index):
+        self.current_size += 1
+
+    def remove_transition(self, index):
+        self.current_size -= 1
+
+    def get_n_steps_transition(self):
+        index, action = self.n_steps_deque[0][:2]  # The slot and action of the first transition in the deque
+        next_index, terminal = self.n_steps_deque[-1][3:5]  # The next_state slot and terminal of the last transition in the deque
+        n_steps_reward = 0
+        for i in reversed(range(self.n_steps)):  # Calculate the n-steps reward in reverse order
+            r, idx_, ter, d = self.n_steps_deque[i][2:]
+            n_steps_reward = r + self.gamma * (1 - d) * n_steps_reward
+            if d:  # If done=True, the episode ends at this transition, so its next_state slot and terminal are used
+                next_index, terminal = idx_, ter
+
+        return index, action, n_steps_reward, next_index, terminal
+
+    def sample_index(self):
+        index = np.random.randint(0, self.filled_size, size=self.batch_size)
+        invalid = self.buffer['next_index'][index] < 0
+        while invalid.any():  # Redraw the slots that hold no transition
+            index[invalid] = np.random.randint(0, self.filled_size, size=invalid.sum())
+            invalid = self.buffer['next_index'][index] < 0
+        return index
+
+    def get_batch(self, index):
+        gather_batch(self.buffer_tensors, index, self.gathered)
+        torch.index_select(self.buffer_tensors['state'], 0, self.gathered['next_index'], out=self.batch['next_state'])  # Follow the links to the next states
+        self.batch['action'].copy_(self.gathered['action'])  # Widen to the dtypes DQN.learn expects, in place
+        self.batch['terminal'].copy_(self.gathered['terminal'])
+        return self.batch
+
+    def sample(self, total_steps):
+        index = self.sample_index()
+        return self.get_batch(index), None, None
+
+
+class Compact_Prioritized_ReplayBuffer(Compact_ReplayBuffer):
+    def __init__(self, args):
+        super(Compact_Prioritized_ReplayBuffer, self).__init__(args)
+        self.max_train_steps = args.max_train_steps
+        self.alpha = args.alpha
+        self.beta_init = args.beta_init
+        self.beta = args.beta_init
+        self.sum_tree = SumTree(self.buffer_capacity, storage_dir=self.buffer_dir)
+
+    def load(self):
+        super(Compact_Prioritized_ReplayBuffer, self).load()
+        # Drop the priorities of slots that lost their transition after the last save()
+        stale = np.nonzero((self.buffer['next_index'] < 0) & (self.sum_tree.tree[self.buffer_capacity - 1:] > 0))[0]
+        if stale.size:
+            self.sum_tree.update_batch(data_index=stale, priority=np.zeros(stale.size))
+
+    def save(self):
+        if self.buffer_dir is not None:
+            arrays = list(self.buffer.values()) + [self.sum_tree.tree, self.sum_tree.max_tree, self.sum_tree.min_tree]
+            save_state(self.buffer_dir, 'replay_buffer', self.get_state(), arrays)
+
+    def insert_transition(self, index):
+        # For the first experience, initialize priority to 1.0; for new experiences, assign the current maximum priority
+        priority = 1.0 if self.current_size == 0 else self.sum_tree.priority_max
+        self.sum_tree.update(data_index=index, priority=priority)
+        self.current_size += 1
+
+    def remove_transition(self, index):
+        self.sum_tree.update(data_index=index, priority=0)  # A zero priority is never sampled
+        self.current_size -= 1
+
+    def sample(self, total_steps):
+        batch_index, IS_weight = self.sum_tree.get_batch_index(current_size=self.current_size, batch_size=self.batch_size, beta=self.beta)
+        self.beta = self.beta_init + (1 - self.beta_init) * (total_steps / self.max_train_steps)  # beta: beta_init->1.0
+        return self.get_batch(batch_index), batch_index, IS_weight
+
+    def update_batch_priorities(self, batch_index, td_errors):  # Update the priorities of the data at batch_index based on the given td_errors
+        priorities = (np.abs(td_errors) + 0.01) ** self.alpha
+        self.sum_tree.update_batch(data_index=batch_index, priority=priorities)
+
+
+class BatchPrefetcher(object):
+    """
+    Wraps a replay buffer and prepares the next 'prefetch_batches' batches on a background thread,
+    so sampling overlaps with the forward/backward pass of DQN.learn. Same interface as the wrapped buffer.
+    A batch may be drawn before the previous learning steps updated the priorities, so when it is consumed:
+    - its IS weights are recomputed from the current priorities;
+    - the slots that were overwritten since it was drawn get a zero IS weight, and their priorities are not updated.
+    An exception on the background thread is raised again by sample(), instead of leaving DQN.learn waiting for a batch.
+    """
+
+    def __init__(self, replay_buffer, prefetch_batches):
+        self.replay_buffer = replay_buffer
+        self.lock = threading.Lock()  # Guards the replay buffer (data and sum tree) between the two threads
+        self.ready = threading.Event()  # Set once there are enough transitions to sample a batch
+        self.stop = threading.Event()
+        self.batches = queue.Queue(maxsize=prefetch_batches)
+        # One batch being filled, prefetch_batches queued, one in use by DQN.learn
+        self.pool = [{key: value.clone() for key, value in replay_buffer.batch.items()} for _ in range(prefetch_batches + 2)]
+        self.pool_index = 0
+        self.version = 0  # Number of store_transition calls so far
+        self.stamp = np.zeros(replay_buffer.buffer_capacity, dtype=np.int64)  # Version at which each slot was last written
+        self.sampled_version = 0  # Version at which the batch DQN.learn is working on was drawn
+        self.total_steps = 0
+        self.error = None  # What stopped the background thread, if it failed
+        self.thread = threading.Thread(target=self.prefetch, daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):  # current_size, save(), ... come from the wrapped buffer
+        return getattr(self.replay_buffer, name)
+
+    def store_transition(self, *transition, **kwargs):
+        with self.lock:
+            count = self.replay_buffer.count
+            self.replay_buffer.store_transition(*transition, **kwargs)
+            # The slots a store can overwrite: the current one, and the next_state slots of the compact buffers
+            written = (self.replay_buffer.count - count) % self.replay_buffer.buffer_capacity
+            self.version += 1
+            self.stamp[(count + np.arange(written + 1)) % self.replay_buffer.buffer_capacity] = self.version
+            if self.replay_buffer.current_size >= self.replay_buffer.batch_size:
+                self.ready.set()
+
+    def prefetch(self):
+        try:
+            while not self.stop.is_set():
+                if not self.ready.wait(timeout=0.1):
+                    continue
+                with self.lock:
+                    batch, batch_index, IS_weight = self.replay_buffer.sample(self.total_steps)
+                    version = self.version
+                out = self.pool[self.pool_index]
+                self.pool_index = (self.pool_index + 1) % len(self.pool)
+                for key, value in batch.items():
+                    out[key].copy_(value)
+                self.put((out, batch_index, version))
+        except Exception as e:
+            self.error = e
+            self.put(None)  # Wakes sample() up, which raises self.error
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def sample(self, total_steps):
+        self.total_steps = total_steps  # Used for beta by the next batches drawn
+        item = self.batches.get()
+        if item is None:
+            self.batches.put(None)  # The thread is gone: every later sample() fails the same way
+            raise RuntimeError("Prefetching a batch failed") from self.error
+        batch, batch_index, version = item
+        if batch_index is None:  # Uniform sampling, nothing depends on the priorities
+            return batch, None, None
+        IS_weight = torch.zeros(len(batch_index), dtype=torch.float32)
+        with self.lock:
+            self.sampled_version = version
+            fresh = self.stamp[batch_index] <= version
+            IS_weight[torch.from_numpy(fresh)] = self.replay_buffer.sum_tree.get_IS_weight(batch_index[fresh], self.replay_buffer.current_size, self.replay_buffer.beta)
+        return batch, batch_index, IS_weight
+
+    def update_batch_priorities(self, batch_index, td_errors):
+        with self.lock:
+            # Slots written after the batch was drawn hold other transitions now, leave their priorities alone
+            fresh = self.stamp[batch_index] <= self.sampled_version
+            self.replay_buffer.update_batch_priorities(batch_index[fresh], td_errors[fresh])
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
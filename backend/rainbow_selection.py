@@ -1,6 +1,6 @@
 from env_uclb import UCLB
 from rainbow_replay_buffer import *
-from rainbow_agent import DQN
+from rainbow_policy import load_frozen_policy
 import argparse
 import random
 
@@ -39,15 +39,9 @@ class Runner:
         print("action_dim={}".format(self.args.action_dim))
         print("episode_limit={}".format(self.args.episode_limit))
 
-        if args.use_per and args.use_n_steps:
-            self.replay_buffer = N_Steps_Prioritized_ReplayBuffer(args)
-        elif args.use_per:
-            self.replay_buffer = Prioritized_ReplayBuffer(args)
-        elif args.use_n_steps:
-            self.replay_buffer = N_Steps_ReplayBuffer(args)
-        else:
-            self.replay_buffer = ReplayBuffer(args)
-        self.agent = DQN(args)
+        # The frozen policy exported by rainbow_export.py, no learning happens while selecting
+        self.policy = load_frozen_policy(args.policy_artifact, args.policy_checkpoint,
+                                         self.args.state_dim, self.args.action_dim, self.args.hidden_dim)
 
         self.algorithm = 'dqn'
         if args.use_double and args.use_dueling and args.use_noisy and args.use_per and args.use_n_steps:
@@ -69,45 +63,21 @@ class Runner:
         self.evaluate_num = 0  # Record the number of evaluations
         self.evaluate_rewards = []  # Record the rewards during the evaluating
         self.total_steps = 0  # Record the total steps during the training
-        if args.use_noisy:  # If choose to use Noisy net, then the epsilon is no looger needed
-            self.epsilon = 0
-        else:
-            self.epsilon = self.args.epsilon_init
-            self.epsilon_min = self.args.epsilon_min
-            self.epsilon_decay = (self.args.epsilon_init - self.args.epsilon_min) / self.args.epsilon_decay_steps
 
     def run(self, ):
         # self.evaluate_policy()
         while self.total_steps < self.args.max_train_steps:
             state = self.env.reset()
             done = False
-            episode_steps = 0
             while not done:
-                action = self.agent.choose_action(state, epsilon=self.epsilon)
+                action = int(self.policy.predict(state)[0])
                 print("action:",action)
                 server = NODE_SERVERS[action]
                 self.action_list.append(server)
                 next_state, reward, done = self.env.step(action)
                 self.total_steps += 1
-
-                if not self.args.use_noisy:  # Decay epsilon
-                    self.epsilon = self.epsilon - self.epsilon_decay if self.epsilon - self.epsilon_decay > self.epsilon_min else self.epsilon_min
-
-                # When dead or win or reaching the max_episode_steps, done will be Ture, we need to distinguish them;
-                # terminal means dead or win,there is no next state s';
-                # but when reaching the max_episode_steps,there is a next state s' actually.
-                if done and episode_steps != self.args.episode_limit:
-                    terminal = True
-                else:
-                    terminal = False
-
-                self.replay_buffer.store_transition(state, action, reward, next_state, terminal,
-                                                    done)  # Store the transition
                 state = next_state
 
-                if self.replay_buffer.current_size >= self.args.batch_size:
-                    self.agent.learn(self.replay_buffer, self.total_steps)
-
 if __name__ == '__main__':
 
     episode_length = 8  # Number of steps / episode
@@ -145,6 +115,8 @@ if __name__ == '__main__':
     parser.add_argument("--use_noisy", type=bool, default=True, help="Whether to use noisy network")
     parser.add_argument("--use_per", type=bool, default=True, help="Whether to use PER")
     parser.add_argument("--use_n_steps", type=bool, default=True, help="Whether to use n_steps Q-learning")
+    parser.add_argument("--policy_artifact", type=str, default="rainbow_policy_1_users.pt", help="Frozen policy saved by rainbow_export.py")
+    parser.add_argument("--policy_checkpoint", type=str, default="rainbow_dqn_net_1_users.pth", help="Checkpoint to export the frozen policy from when it is missing")
 
     args = parser.parse_args()
 
@@ -157,10 +129,6 @@ if __name__ == '__main__':
         env_index = 0
 
         runner = Runner(args=args, number=1, seed=seed)
-
-        # load the model
-        runner.agent.net.load_state_dict = torch.load(f'rainbow_dqn_net_1_users.pth')
-        runner.agent.target_net.load_state_dict = torch.load(f'rainbow_dqn_target_net_1_users.pth')
         runner.run()
 
 
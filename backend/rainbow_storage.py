@@ -0,0 +1,47 @@
+import os
+import json
+import numpy as np
+
+
+def open_array(storage_dir, name, shape, dtype, fill=0):
+    """
+    Allocates an array in RAM, or as a memory-mapped .npy file in storage_dir.
+    An existing file is reopened as it is, so its contents survive restarts.
+    """
+    if storage_dir is None:
+        return np.zeros(shape, dtype=dtype) if fill == 0 else np.full(shape, fill, dtype=dtype)
+
+    path = os.path.join(storage_dir, name + '.npy')
+    if os.path.exists(path):
+        array = np.lib.format.open_memmap(path, mode='r+')
+        if array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+            raise ValueError("{} holds a {} {} array, expected {} {}".format(path, array.shape, array.dtype, tuple(shape), np.dtype(dtype)))
+        return array
+
+    os.makedirs(storage_dir, exist_ok=True)
+    array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))  # New files are zero-filled
+    if fill != 0:
+        array[:] = fill
+    return array
+
+
+def load_state(storage_dir, name):
+    # Returns the scalar state saved next to the arrays, or None for a new storage_dir
+    if storage_dir is None:
+        return None
+    path = os.path.join(storage_dir, name + '.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_state(storage_dir, name, state, arrays):
+    # Flush the memory-mapped arrays first, so the saved state never runs ahead of the data it describes
+    for array in arrays:
+        if isinstance(array, np.memmap):
+            array.flush()
+    path = os.path.join(storage_dir, name + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)  # Atomic, a crash leaves either the old or the new state
@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+from rainbow_storage import open_array
 
 class SumTree(object):
     """
@@ -17,10 +18,15 @@ class SumTree(object):
     [0,1,2,3,4,5,6]
     """
 
-    def __init__(self, buffer_capacity):
+    def __init__(self, buffer_capacity, storage_dir=None):
         self.buffer_capacity = buffer_capacity  # Capacity of the buffer
         self.tree_capacity = 2 * buffer_capacity - 1  # Capacity of the sum tree
-        self.tree = np.zeros(self.tree_capacity)
+        # With a storage_dir, the trees are memory-mapped files in it and survive restarts
+        self.tree = open_array(storage_dir, 'sum_tree', (self.tree_capacity,), np.float64)
+        # Companion trees with the same layout, every parent holds the max / min of its children,
+        # so the global max and min priority can be read from the top in O(1)
+        self.max_tree = open_array(storage_dir, 'max_tree', (self.tree_capacity,), np.float64)
+        self.min_tree = open_array(storage_dir, 'min_tree', (self.tree_capacity,), np.float64, fill=np.inf)  # Empty (zero priority) leaves never take part in the min
 
     def update(self, data_index, priority):
         # data_index represents the index of the current data in the buffer
@@ -28,10 +34,34 @@ class SumTree(object):
         tree_index = data_index + self.buffer_capacity - 1  # Convert the buffer index to the sum tree index
         change = priority - self.tree[tree_index]  # The change in priority for the current data
         self.tree[tree_index] = priority  # Update the priority of the leaf node at the bottom of the tree
+        self.max_tree[tree_index] = priority
+        self.min_tree[tree_index] = priority if priority > 0 else np.inf
         # Then propagate the change through the tree
         while tree_index != 0:  # Update the priority of the parent nodes, propagate the change to the top
             tree_index = (tree_index - 1) // 2
             self.tree[tree_index] += change
+            child_left_idx = 2 * tree_index + 1
+            self.max_tree[tree_index] = max(self.max_tree[child_left_idx], self.max_tree[child_left_idx + 1])
+            self.min_tree[tree_index] = min(self.min_tree[child_left_idx], self.min_tree[child_left_idx + 1])
+
+    def update_batch(self, data_index, priority):
+        # Keep only the last write for each duplicated index, so the result does not depend on numpy's assignment order
+        data_index = np.asarray(data_index, dtype=np.int64)[::-1]
+        priority = np.asarray(priority, dtype=np.float64)[::-1]
+        data_index, last = np.unique(data_index, return_index=True)
+        tree_index = data_index + self.buffer_capacity - 1  # Convert the buffer indices to sum tree indices
+        priority = priority[last]
+        self.tree[tree_index] = priority  # Write all the leaf nodes at once
+        self.max_tree[tree_index] = priority
+        self.min_tree[tree_index] = np.where(priority > 0, priority, np.inf)
+        # Then rebuild the affected parent nodes level by level, until the top has been rebuilt
+        # (leaves may sit on two depths, so a node is rebuilt again whenever one of its children changes)
+        while tree_index.size:
+            tree_index = np.unique((tree_index[tree_index > 0] - 1) // 2)
+            child_left_idx = 2 * tree_index + 1
+            self.tree[tree_index] = self.tree[child_left_idx] + self.tree[child_left_idx + 1]
+            self.max_tree[tree_index] = np.maximum(self.max_tree[child_left_idx], self.max_tree[child_left_idx + 1])
+            self.min_tree[tree_index] = np.minimum(self.min_tree[child_left_idx], self.min_tree[child_left_idx + 1])
 
     def get_index(self, v):
         parent_idx = 0  # Start from the top of the tree
@@ -52,20 +82,34 @@ class SumTree(object):
         return data_index, self.tree[tree_index]  # Return the index of the sampled data in the buffer and its priority
 
     def get_batch_index(self, current_size, batch_size, beta):
-        batch_index = np.zeros(batch_size, dtype=np.int64)
-        IS_weight = torch.zeros(batch_size, dtype=torch.float32)
         segment = self.priority_sum / batch_size  # Divide the range [0, priority_sum] into batch_size segments, and sample a number from each segment
-        for i in range(batch_size):
-            a = segment * i
-            b = segment * (i + 1)
-            v = np.random.uniform(a, b)
-            index, priority = self.get_index(v)
-            batch_index[i] = index
-            prob = priority / self.priority_sum  # The probability of the current data being sampled
-            IS_weight[i] = (current_size * prob) ** (-beta)
-        IS_weight /= IS_weight.max()  # Normalize
-
-        return batch_index, IS_weight
+        a = segment * np.arange(batch_size)
+        v = np.random.uniform(a, a + segment)  # One stratified sample per segment, drawn in the same order as the scalar path
+
+        # Walk all samples down the tree together, one level per iteration
+        tree_index = np.zeros(batch_size, dtype=np.int64)
+        while True:
+            child_left_idx = 2 * tree_index + 1
+            active = child_left_idx < self.tree_capacity  # Samples that have not reached a leaf yet
+            if not active.any():
+                break
+            left = child_left_idx[active]
+            left_priority = self.tree[left]
+            go_left = v[active] <= left_priority
+            v[active] -= np.where(go_left, 0.0, left_priority)
+            tree_index[active] = np.where(go_left, left, left + 1)
+
+        batch_index = tree_index - self.buffer_capacity + 1  # Convert the tree index back to the buffer index
+
+        return batch_index, self.get_IS_weight(batch_index, current_size, beta)
+
+    def get_IS_weight(self, data_index, current_size, beta):
+        prob = self.tree[data_index + self.buffer_capacity - 1] / self.priority_sum  # The probability of each data being sampled
+        IS_weight = (current_size * prob) ** (-beta)
+        max_weight = (current_size * self.priority_min / self.priority_sum) ** (-beta)  # The weight of the least likely data in the whole buffer
+        IS_weight /= max_weight  # Normalize by the global max weight, so the weights no longer depend on which data this batch happened to draw
+
+        return torch.from_numpy(IS_weight.astype(np.float32))
 
     @property
     def priority_sum(self):
@@ -73,4 +117,8 @@ class SumTree(object):
 
     @property
     def priority_max(self):
-        return self.tree[self.buffer_capacity - 1:].max()  # The leaf nodes store the priority of each data point
+        return self.max_tree[0]  # The top of the max tree holds the largest priority of all leaves
+
+    @property
+    def priority_min(self):
+        return self.min_tree[0]  # The top of the min tree holds the smallest non-zero priority of all leaves
@@ -0,0 +1,87 @@
+import argparse
+import contextlib
+import copy
+import itertools
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+import numpy as np
+import torch
+from rainbow_train import Runner, get_parser, seed_torch
+
+ABLATION_FLAGS = ['use_double', 'use_dueling', 'use_noisy', 'use_per', 'use_n_steps']
+
+
+def init_worker(torch_threads):
+    # Pin every worker to a few torch threads, so the pool does not oversubscribe the cores
+    torch.set_num_threads(torch_threads)
+
+
+def run_one(args, seed, flags):
+    args = copy.deepcopy(args)  # Runner writes state_dim / action_dim into its args
+    for flag, value in flags.items():
+        setattr(args, flag, value)
+    np.random.seed(seed)
+    random.seed(seed)
+    seed_torch(seed)
+
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # The envs print a summary per episode
+        runner = Runner(args=args, number=1, seed=seed)
+        runner.run()
+    steps = args.max_train_steps
+    return {'algorithm': runner.algorithm,
+            'seed': seed,
+            'flags': [flags[flag] for flag in ABLATION_FLAGS],
+            'step_reward': np.array(runner.env.step_reward_list[:steps]),
+            'step_delay': np.array(runner.env.step_delay_list[:steps]),
+            'step_mad': np.array(runner.env.step_mad_list[:steps]),
+            'wall_time': time.time() - start,
+            }
+
+
+def run_sweep(args):
+    # The cross product of the seeds and of the on/off values of the swept flags; flags that are not swept keep their CLI value
+    flag_values = [[False, True] if flag in args.sweep_flags else [getattr(args, flag)] for flag in ABLATION_FLAGS]
+    tasks = [(seed, dict(zip(ABLATION_FLAGS, values))) for seed in args.seeds for values in itertools.product(*flag_values)]
+    print("sweep: {} runs on {} workers".format(len(tasks), args.num_workers))
+
+    results = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=args.num_workers, mp_context=mp.get_context('spawn'),
+                             initializer=init_worker, initargs=(args.torch_threads,)) as pool:
+        futures = [pool.submit(run_one, args, seed, flags) for seed, flags in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print("[{}/{}] {} seed {} done in {:.1f} s".format(len(results), len(tasks), result['algorithm'], result['seed'], result['wall_time']))
+
+    results.sort(key=lambda result: (result['algorithm'], result['seed']))
+    np.savez(args.sweep_output,
+             algorithm=np.array([result['algorithm'] for result in results]),
+             seed=np.array([result['seed'] for result in results]),
+             flag_names=np.array(ABLATION_FLAGS),
+             flags=np.array([result['flags'] for result in results]),
+             step_reward_matrix=np.stack([result['step_reward'] for result in results]),
+             step_delay_matrix=np.stack([result['step_delay'] for result in results]),
+             step_mad_matrix=np.stack([result['step_mad'] for result in results]),
+             wall_time=np.array([result['wall_time'] for result in results]))
+    print("sweep: {} runs in {:.1f} s, results saved to {}".format(len(results), time.time() - start, args.sweep_output))
+
+
+if __name__ == '__main__':
+    episode_length = 8  # Number of steps / episode
+    episode_number = 400  # Number of episode to train
+    steps = episode_number * episode_length  # Total step number
+
+    parser = get_parser(steps)
+    parser.add_argument("--seeds", type=int, nargs='+', default=[37], help="Seeds to run every flag combination with")
+    parser.add_argument("--sweep_flags", type=str, nargs='*', default=ABLATION_FLAGS, choices=ABLATION_FLAGS, help="Flags swept over False/True")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--torch_threads", type=int, default=1, help="Torch threads per worker")
+    parser.add_argument("--sweep_output", type=str, default="sweep_results.npz", help="Where to save the aggregated results")
+    args = parser.parse_args()
+
+    run_sweep(args)
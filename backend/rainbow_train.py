@@ -1,6 +1,7 @@
-from env_uclb import UCLB
+from env_uclb import UCLB, VecUCLB
 from rainbow_replay_buffer import *
 from rainbow_agent import DQN
+from rainbow_distributed import DistributedRunner
 import argparse
 import random
 
@@ -10,7 +11,7 @@ class Runner:
 
         self.number = number
         self.seed = seed
-        self.env = UCLB()
+        self.env = UCLB(args.user_num) if args.num_envs == 1 else VecUCLB(args.num_envs, args.user_num)
 
         print("env name:", self.env.name)
         np.random.seed(seed)
@@ -18,12 +19,21 @@ class Runner:
 
         self.args.state_dim = self.env.observation_space.shape[0]
         self.args.action_dim = self.env.action_space.n
+        self.args.user_num = self.env.user_num  # Branches of Branching_Dueling_Net
+        self.args.server_num = self.env.server_num
         self.args.episode_limit = self.env.slot_num  # Maximum number of steps per episode
         print("state_dim={}".format(self.args.state_dim))
         print("action_dim={}".format(self.args.action_dim))
         print("episode_limit={}".format(self.args.episode_limit))
 
-        if args.use_per and args.use_n_steps:
+        use_compact_buffer = args.use_compact_buffer or args.buffer_dir is not None  # Only the compact buffers can live in buffer_dir
+        if use_compact_buffer and self.args.action_dim > np.iinfo(np.int32).max:
+            raise ValueError("The compact buffers store actions as int32, {} joint actions do not fit".format(self.args.action_dim))
+        if use_compact_buffer and args.use_per:  # The compact buffers handle n_steps themselves
+            self.replay_buffer = Compact_Prioritized_ReplayBuffer(args)
+        elif use_compact_buffer:
+            self.replay_buffer = Compact_ReplayBuffer(args)
+        elif args.use_per and args.use_n_steps:
             self.replay_buffer = N_Steps_Prioritized_ReplayBuffer(args)
         elif args.use_per:
             self.replay_buffer = Prioritized_ReplayBuffer(args)
@@ -31,6 +41,11 @@ class Runner:
             self.replay_buffer = N_Steps_ReplayBuffer(args)
         else:
             self.replay_buffer = ReplayBuffer(args)
+        if args.buffer_dir is not None:  # Keep going with the experience saved by a previous run
+            self.replay_buffer.load()
+            print("replay buffer: {} transitions loaded from {}".format(self.replay_buffer.current_size, args.buffer_dir))
+        if args.prefetch_batches > 0:  # Sample on a background thread, overlapping with DQN.learn
+            self.replay_buffer = BatchPrefetcher(self.replay_buffer, args.prefetch_batches)
         self.agent = DQN(args)
 
         self.algorithm = 'dqn'
@@ -47,6 +62,8 @@ class Runner:
                 self.algorithm += '_per'
             if args.use_n_steps:
                 self.algorithm += "_n_steps"
+        if args.use_branching:
+            self.algorithm += '_branching'
 
         # self.writer = SummaryWriter(log_dir='runs/DQN/{}_env_{}_number_{}_seed_{}'.format(self.algorithm, env_name, number, seed))
 
@@ -61,6 +78,9 @@ class Runner:
             self.epsilon_decay = (self.args.epsilon_init - self.args.epsilon_min) / self.args.epsilon_decay_steps
 
     def run(self, ):
+        if self.args.num_envs > 1:
+            self.run_vec()
+            return
         # self.evaluate_policy()
         while self.total_steps < self.args.max_train_steps:
             state = self.env.reset()
@@ -88,9 +108,50 @@ class Runner:
                 if self.replay_buffer.current_size >= self.args.batch_size:
                     self.agent.learn(self.replay_buffer, self.total_steps)
 
+                if self.args.buffer_dir is not None and self.total_steps % self.args.buffer_save_freq == 0:
+                    self.replay_buffer.save()
+
                 # if self.total_steps % self.args.evaluate_freq == 0:
                 #     self.evaluate_policy()
 
+        if self.args.buffer_dir is not None:
+            self.replay_buffer.save()
+        if self.args.prefetch_batches > 0:
+            self.replay_buffer.close()
+
+    def run_vec(self, ):
+        # Collect with num_envs instances, one forward pass picks the actions of all of them.
+        # The replay buffers expect one sequential stream (n_steps deque, compact index linkage),
+        # so each instance's transitions are kept until its episode ends and then stored together.
+        states = self.env.reset()
+        episodes = [[] for _ in range(self.args.num_envs)]
+        while self.total_steps < self.args.max_train_steps:
+            actions = self.agent.choose_actions(states, epsilon=self.epsilon)
+            next_states, rewards, dones = self.env.step(actions)
+            self.total_steps += self.args.num_envs
+
+            if not self.args.use_noisy:  # Decay epsilon, once per transition
+                self.epsilon = max(self.epsilon - self.epsilon_decay * self.args.num_envs, self.epsilon_min)
+
+            for i in range(self.args.num_envs):
+                episodes[i].append((states[i], actions[i], rewards[i], next_states[i], dones[i], dones[i]))
+                if dones[i]:
+                    for transition in episodes[i]:
+                        self.replay_buffer.store_transition(*transition)
+                    episodes[i] = []
+            states = self.env.states
+
+            if self.replay_buffer.current_size >= self.args.batch_size:
+                for _ in range(self.args.num_envs):  # Keep one learning step per collected transition
+                    self.agent.learn(self.replay_buffer, self.total_steps)
+
+            if self.args.buffer_dir is not None and self.total_steps % self.args.buffer_save_freq < self.args.num_envs:
+                self.replay_buffer.save()
+
+        if self.args.buffer_dir is not None:
+            self.replay_buffer.save()
+        if self.args.prefetch_batches > 0:
+            self.replay_buffer.close()
 
     # def evaluate_policy(self, ):
     #     evaluate_reward = 0
@@ -112,24 +173,15 @@ class Runner:
     #     self.writer.add_scalar('step_rewards_{}'.format(self.env_name), evaluate_reward, global_step=self.total_steps)
 
 
-if __name__ == '__main__':
-    seed_list = [37]
+def seed_torch(seed):
+    torch.manual_seed(seed)
+    if torch.backends.cudnn.enabled:
+        torch.cuda.manual_seed(seed)
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
 
-    def seed_torch(seed):
-        torch.manual_seed(seed)
-        if torch.backends.cudnn.enabled:
-            torch.cuda.manual_seed(seed)
-            torch.backends.cudnn.benchmark = False
-            torch.backends.cudnn.deterministic = True
-
-    episode_length = 8  # Number of steps / episode
-    episode_number = 400  # Number of episode to train
-    steps = episode_number * episode_length  # Total step number
-
-    step_reward_matrix = np.zeros([len(seed_list), int(steps)])
-    step_delay_matrix = np.zeros([len(seed_list), int(steps)])
-    step_mad_matrix = np.zeros([len(seed_list), int(steps)])
 
+def get_parser(steps):
     parser = argparse.ArgumentParser("Hyperparameter Setting for DQN")
     parser.add_argument("--max_train_steps", type=int, default=int(steps), help=" Maximum number of training steps")
     parser.add_argument("--evaluate_freq", type=float, default=1e3, help="Evaluate the policy every 'evaluate_freq' steps")
@@ -154,11 +206,35 @@ if __name__ == '__main__':
 
     parser.add_argument("--use_double", type=bool, default=True, help="Whether to use double Q-learning")
     parser.add_argument("--use_dueling", type=bool, default=True, help="Whether to use dueling network")
+    parser.add_argument("--user_num", type=int, default=1, help="Number of users placing a chunk at every UCLB step")
+    parser.add_argument("--use_branching", type=bool, default=False, help="Whether to use one dueling advantage branch per user instead of one output per joint action")
     parser.add_argument("--use_noisy", type=bool, default=True, help="Whether to use noisy network")
     parser.add_argument("--use_per", type=bool, default=True, help="Whether to use PER")
     parser.add_argument("--use_n_steps", type=bool, default=True, help="Whether to use n_steps Q-learning")
+    parser.add_argument("--use_compact_buffer", type=bool, default=False, help="Whether to store float32 observations once, linking next_state by index")
+    parser.add_argument("--buffer_dir", type=str, default=None, help="Keep the (compact) replay buffer in memory-mapped files in this directory, and reopen it on restart")
+    parser.add_argument("--num_envs", type=int, default=1, help="Number of UCLB instances stepped together (VecUCLB) when greater than 1")
+    parser.add_argument("--num_actors", type=int, default=0, help="Number of actor processes collecting for one learner process (0: single process)")
+    parser.add_argument("--sync_freq", type=int, default=100, help="Learning steps between weight syncs to the actors, and actor steps between checks for new weights")
+    parser.add_argument("--actor_send_size", type=int, default=32, help="Transitions an actor sends to the learner at once")
+    parser.add_argument("--max_blocks_per_learn", type=int, default=0, help="Transition blocks the learner takes from the actors between learning steps (0: num_actors)")
+    parser.add_argument("--prefetch_batches", type=int, default=0, help="Batches sampled ahead on a background thread (0: sample synchronously, reproducible)")
+    parser.add_argument("--buffer_save_freq", type=int, default=int(1e4), help="Save the replay buffer state to buffer_dir every 'buffer_save_freq' steps")
+    return parser
+
+
+if __name__ == '__main__':
+    seed_list = [37]
+
+    episode_length = 8  # Number of steps / episode
+    episode_number = 400  # Number of episode to train
+    steps = episode_number * episode_length  # Total step number
 
-    args = parser.parse_args()
+    step_reward_matrix = np.zeros([len(seed_list), int(steps)])
+    step_delay_matrix = np.zeros([len(seed_list), int(steps)])
+    step_mad_matrix = np.zeros([len(seed_list), int(steps)])
+
+    args = get_parser(steps).parse_args()
 
     for k in range(len(seed_list)):
         seed = seed_list[k]
@@ -169,13 +245,16 @@ if __name__ == '__main__':
 
         env_index = 0
 
-        runner = Runner(args=args, number=1, seed=seed)
+        if args.num_actors > 0:  # Actor processes collect, this process learns
+            runner = DistributedRunner(args=args, number=1, seed=seed)
+        else:
+            runner = Runner(args=args, number=1, seed=seed)
         print("algorithm:", runner.algorithm)
         runner.run()
 
-        step_reward_matrix[k, :] = np.array(runner.env.step_reward_list)
-        step_delay_matrix[k, :] = np.array(runner.env.step_delay_list)
-        step_mad_matrix[k, :] = np.array(runner.env.step_mad_list)
+        step_reward_matrix[k, :] = np.array(runner.env.step_reward_list[:int(steps)])  # VecUCLB may run past the last step by up to num_envs - 1
+        step_delay_matrix[k, :] = np.array(runner.env.step_delay_list[:int(steps)])
+        step_mad_matrix[k, :] = np.array(runner.env.step_mad_list[:int(steps)])
 
 
     # save the model
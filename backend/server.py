@@ -1,9 +1,20 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 import os
-import json
-import requests
+import itertools
+import mimetypes
 import random
+import re
+from urllib.parse import quote
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rainbow_policy import PolicyServer, load_frozen_policy, rollout_plan
+from metadata_store import MetadataStore, parity_name
+from node_client import NodeClient, ChunkFetchError
+from node_stats import NodeStatsPoller
+from erasure import ReedSolomon
 
 # 节点服务器列表
 NODE_SERVERS = [
@@ -11,27 +22,113 @@ NODE_SERVERS = [
     "http://18.144.171.222:7001",
     "http://54.67.117.71:7001"
 ]
-with open('action_list.txt', 'r') as file:
-    loaded_action_list = file.read().splitlines()
-METADATA_FILE = "uploads/metadata.json"
-# 加载已有的 metadata（如果有的话）
-if os.path.exists(METADATA_FILE):
-    try:
-        with open(METADATA_FILE, "r") as f:
-            content = f.read().strip()  # 读取内容并去掉空白字符
-            file_metadata = json.loads(content) if content else {}  # 避免解析空文件
-    except json.JSONDecodeError:
-        file_metadata = {}  # 如果 JSON 解析失败，重新初始化
-else:
-    file_metadata = {}
-
-app = Flask(__name__, static_folder='../frontend', static_url_path='')
-CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
-
+POLICY_CHECKPOINT = "rainbow_dqn_net_1_users.pth"
+POLICY_INT8 = False  # 是否使用 int8 量化的策略，开启前先用 rainbow_quant_check.py 检查与浮点模型的一致率
+POLICY_DIR = "uploads"  # 冻结策略所在的目录：协调器的数据目录，启动时导出的策略不写进源码目录
+POLICY_ARTIFACT = os.path.join(POLICY_DIR, "rainbow_policy_1_users_int8.pt" if POLICY_INT8 else "rainbow_policy_1_users.pt")  # rainbow_export.py 导出的冻结策略，不存在时从 POLICY_CHECKPOINT 导出
+CHUNK_SIZE_MB = 1  # 与 UCLB 的 chunk_size 一致（Mb）
+CHUNK_SIZE_BYTES = 1024 * 1024  # 前端切片大小，/upload/complete 可用 chunkSize 覆盖
+MERGE_WORKERS = 8  # 合并时并发下载分片的线程数，也是每个节点的连接池大小
+# 副本数：策略选出的节点之外，再把每个分片放到负载最低的 REPLICATION_FACTOR - 1 个其他节点；/upload/plan 可用 replicationFactor 覆盖
+REPLICATION_FACTOR = 1
+HEDGE_PERCENTILE = 95  # 读副本分片时，某节点超过它最近读取耗时的这个百分位还没返回，就向下一个副本再发一次请求
+DOWNLOAD_READAHEAD = 4  # /download 预读的分片数，协调器最多同时缓存 DOWNLOAD_READAHEAD + 1 个分片
+# 纠删码存储：每 ERASURE_DATA_SHARDS 个分片一组，/upload/plan 时把组内的数据分片放到不同节点，上传完成时计算 ERASURE_PARITY_SHARDS 个
+# 校验分片放到组内其余的节点（共需 ERASURE_DATA_SHARDS + ERASURE_PARITY_SHARDS 个节点）；读取时向组内所有分片同时请求，
+# 任意 ERASURE_DATA_SHARDS 个到达即可还原，一个节点慢或宕机不影响读取。/upload/plan 可用 erasureCoding 覆盖，
+# 没有指定时按内容寻址或多副本的文件不用纠删码
+ERASURE_CODING = False
+ERASURE_DATA_SHARDS = 2
+ERASURE_PARITY_SHARDS = 1
+# 节点实时状态：后台每 NODE_STATS_TTL 秒轮询各节点的 /stats，放置时用节点报告的已存储字节、正在接收的字节和写入速率作为
+# server_load；超过 NODE_STATS_MAX_AGE 秒没有响应的节点沿用协调器自己的记账。剩余空间低于 NODE_MIN_FREE_BYTES 的节点不再放新分片
+LIVE_NODE_STATS = True
+NODE_STATS_TTL = 2.0
+NODE_STATS_MAX_AGE = 10.0
+NODE_MIN_FREE_BYTES = 1024 * 1024 * 1024
 UPLOAD_FOLDER = "uploads"
 CHUNK_FOLDER = "uploads/chunks"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(CHUNK_FOLDER, exist_ok=True)
+os.makedirs(POLICY_DIR, exist_ok=True)
+
+METADATA_DB = "uploads/metadata.db"
+METADATA_FILE = "uploads/metadata.json"  # 旧的 metadata 文件，首次启动时导入 METADATA_DB
+# metadata 存在 SQLite（WAL）中，内存索引负责读取，每个分片只写一行
+file_metadata = MetadataStore(METADATA_DB, legacy_json=METADATA_FILE)
+
+# 每个节点已分配的数据量（Mb），即 UCLB 状态中的 server_load，从已有 metadata 恢复；相同内容的分片只算一次
+def chunk_load(chunk_size):
+    # 一个分片在 UCLB 状态中的负载（Mb），按分片字节数换算；大小未知时按默认分片大小计
+    return CHUNK_SIZE_MB * (chunk_size or CHUNK_SIZE_BYTES) / CHUNK_SIZE_BYTES
+
+def stored_load(meta, chunk_index):
+    # 分片在节点上实际占用的负载：节点报告了存储大小（压缩后）时按它计，否则按分片大小计
+    return chunk_load(meta["stored_sizes"].get(chunk_index) or meta["chunk_size"])
+
+node_load = np.zeros(len(NODE_SERVERS))
+stored_blobs = set()
+for meta in file_metadata.values():
+    for chunk_index, node_server in meta["chunks"].items():
+        sha256 = meta["hashes"].get(chunk_index)
+        for copy in [node_server] + meta["replicas"].get(chunk_index, []):
+            if sha256 is not None:
+                if (copy, sha256) in stored_blobs:
+                    continue
+                stored_blobs.add((copy, sha256))
+            if copy in NODE_SERVERS:
+                node_load[NODE_SERVERS.index(copy)] += stored_load(meta, chunk_index)
+    for shards in meta["parity"].values():
+        for node_server, stored_size in shards:
+            if node_server in NODE_SERVERS:
+                node_load[NODE_SERVERS.index(node_server)] += chunk_load(stored_size or meta["chunk_size"])
+del stored_blobs
+node_load_lock = threading.Lock()
+# 删除文件时回收 blob 与规划时查找 blob 互斥，查到的 blob 不会在客户端依赖它时被删除
+blob_gc_lock = threading.Lock()
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+CHUNK_INDEX_PATTERN = re.compile(r"[0-9]+")  # JSON 对象的键是字符串，分片下标按十进制写
+
+# 每个节点一个 keep-alive 连接池，所有请求共用
+node_client = NodeClient(NODE_SERVERS, pool_size=MERGE_WORKERS, hedge_percentile=HEDGE_PERCENTILE)
+
+
+def node_load_snapshot():
+    with node_load_lock:
+        return node_load.copy()
+
+node_stats = NodeStatsPoller(node_client, NODE_SERVERS, ttl=NODE_STATS_TTL, max_age=NODE_STATS_MAX_AGE, baseline=node_load_snapshot)
+if LIVE_NODE_STATS:
+    node_stats.start()
+
+
+def live_node_load(load):
+    """
+    放置策略看到的 server_load（Mb）：有最新 /stats 的节点按它报告的已存储字节 + 正在接收的字节 + 按最近写入速率到下次轮询前还会写入的字节，
+    再加上这次轮询之后本协调器新分配的负载（load 与轮询时 node_load 之差，节点还没看到）；其他节点沿用记账的 load。
+    同时返回每个节点还能放下的负载（剩余空间减去 NODE_MIN_FREE_BYTES），没有最新 /stats 的节点不限
+    """
+    live = np.array(load, dtype=np.float64)
+    room = np.full(len(NODE_SERVERS), np.inf)
+    if not LIVE_NODE_STATS:
+        return live, room
+    for n, node_server in enumerate(NODE_SERVERS):
+        polled = node_stats.get(node_server)
+        if polled is None:
+            continue
+        stats, baseline, _ = polled
+        since_poll = load[n] - baseline[n]
+        live_bytes = stats["bytesStored"] + stats["inFlightBytes"] + stats["uploadBytesPerSec"] * NODE_STATS_TTL
+        live[n] = CHUNK_SIZE_MB * live_bytes / CHUNK_SIZE_BYTES + since_poll
+        room[n] = CHUNK_SIZE_MB * max(stats["diskFree"] - NODE_MIN_FREE_BYTES, 0) / CHUNK_SIZE_BYTES - since_poll
+    return live, room
+
+# 启动时加载一次冻结的 DRL 策略，并发的分配请求合并成一次前向计算
+policy = PolicyServer(load_frozen_policy(POLICY_ARTIFACT, POLICY_CHECKPOINT, state_dim=1 + len(NODE_SERVERS),
+                                        action_dim=len(NODE_SERVERS), quantize=POLICY_INT8))
+
+app = Flask(__name__, static_folder='../frontend', static_url_path='')
+CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 
 
 @app.route("/")
@@ -49,16 +146,12 @@ def upload_metadata():
     if not file_id or not file_name or total_chunks is None:
         return jsonify({"error": "Invalid metadata"}), 400
 
-    file_metadata[file_id] = {
-        "file_name": file_name,
-        "total_chunks": total_chunks,
-        "uploaded_chunks": [],
-        "chunks": {}
-    }
-
-    # ✅ 每次写入 metadata.json
-    with open(METADATA_FILE, "w") as f:
-        json.dump(file_metadata, f)
+    # 同一 file_id 重新开始时，旧分片释放的 blob 与分片按删除文件的方式回收
+    with blob_gc_lock:
+        metadata = file_metadata.get(file_id)
+        unreferenced = file_metadata.add_file(file_id, file_name, total_chunks)
+        if unreferenced:
+            delete_unreferenced(unreferenced, metadata["chunk_size"])
 
     return jsonify({"message": "Metadata received", "fileId": file_id})
 
@@ -75,118 +168,512 @@ def assign_chunk():
     # 随机选择一个节点服务器
     # node_server = random.choice(NODE_SERVERS)
 
-    # 基于DRL agent选择节点服务器
-    node_server = loaded_action_list[chunk_index]
-    
-    # 记录分片分配的节点服务器
     if file_id not in file_metadata:
         return jsonify({"error": "File ID not found in metadata"}), 400
-    file_metadata[file_id]["chunks"][chunk_index] = node_server
+    if file_metadata.get(file_id)["data_shards"] is not None:  # 逐个分配无法保证组内的分片在不同节点上
+        return jsonify({"error": "Erasure-coded files are placed by /upload/plan"}), 400
 
-    with open(METADATA_FILE, "w") as f:
-        json.dump(file_metadata, f)
+    # 基于DRL agent选择节点服务器：状态 = [剩余分片数, 各节点负载]
+    remain_chunks = file_metadata.get(file_id)["total_chunks"] - chunk_index
+    with node_load_lock:
+        state = np.concatenate([[remain_chunks], live_node_load(node_load)[0]])
+    try:
+        node_server = NODE_SERVERS[policy.decide(state)]
+    except Exception as e:
+        return jsonify({"error": f"Placement failed: {e}"}), 500
+
+    # 记录分片分配的节点服务器（重复分配同一分片时先撤销旧的负载）
+    try:
+        with node_load_lock:
+            old_server = file_metadata.assign_chunk(file_id, chunk_index, node_server)
+            if old_server in NODE_SERVERS:
+                node_load[NODE_SERVERS.index(old_server)] -= CHUNK_SIZE_MB
+            node_load[NODE_SERVERS.index(node_server)] += CHUNK_SIZE_MB
+    except KeyError:  # 分配期间文件已被合并删除
+        return jsonify({"error": "File ID not found in metadata"}), 400
 
     return jsonify({"node_server": node_server})
 
+### **Step 2（整文件）：一次请求得到所有分片的放置方案**
+@app.route("/upload/plan", methods=["POST"])
+def plan_upload():
+    data = request.json
+    file_id = data.get("fileId")
+    total_chunks = data.get("totalChunks")
+    chunk_size = data.get("chunkSize", CHUNK_SIZE_BYTES)
+    chunk_hashes = data.get("chunkHashes")  # 可选：每个分片的 sha256，按内容寻址，已存储的内容不再上传
+    replication = data.get("replicationFactor", REPLICATION_FACTOR)
+    erasure_coding = data.get("erasureCoding")
+
+    meta = file_metadata.get(file_id)
+    if meta is None:
+        return jsonify({"error": "File ID not found in metadata"}), 400
+    if total_chunks is not None and total_chunks != meta["total_chunks"]:
+        return jsonify({"error": "totalChunks does not match metadata"}), 400
+    total_chunks = meta["total_chunks"]
+    if chunk_hashes is not None and (not isinstance(chunk_hashes, list) or len(chunk_hashes) != total_chunks
+                                     or not all(isinstance(h, str) and SHA256_PATTERN.fullmatch(h) for h in chunk_hashes)):
+        return jsonify({"error": "chunkHashes must hold one lowercase hex sha256 per chunk"}), 400
+    if not isinstance(replication, int) or not 1 <= replication <= len(NODE_SERVERS):
+        return jsonify({"error": f"replicationFactor must be between 1 and {len(NODE_SERVERS)}"}), 400
+    # 纠删码在规划时决定（已规划的文件沿用原来的）：组内的 k 个数据分片和 m 个校验分片要放在不同节点上，
+    # 按内容寻址的分片跟着已有的 blob 走、副本另有节点，都无法保证，这样的文件不用纠删码
+    if meta["data_shards"] is None and not meta["chunks"]:
+        spreadable = not chunk_hashes and replication == 1 and ERASURE_DATA_SHARDS + ERASURE_PARITY_SHARDS <= len(NODE_SERVERS)
+        if erasure_coding and not spreadable:
+            return jsonify({"error": f"erasureCoding needs {ERASURE_DATA_SHARDS + ERASURE_PARITY_SHARDS} nodes and cannot be combined "
+                                     "with chunkHashes or replicationFactor"}), 400
+        erasure_coding = spreadable and (ERASURE_CODING if erasure_coding is None else bool(erasure_coding))
+    elif erasure_coding and meta["data_shards"] is None:
+        return jsonify({"error": "File was already placed without erasure coding"}), 400
+    else:
+        erasure_coding = meta["data_shards"] is not None
+    data_shards = ERASURE_DATA_SHARDS if erasure_coding else None
+
+    with blob_gc_lock:
+        # 已分配的分片保留原方案（重试时直接返回缓存），只为未分配的分片做一次策略 rollout
+        unassigned = [i for i in range(total_chunks) if i not in meta["chunks"]]
+        if unassigned:
+            hashes = {i: chunk_hashes[i] for i in unassigned} if chunk_hashes else {}
+            assignments = {}
+            replicas = {}
+            new_chunks = []  # 需要放置的新内容，每个 sha256 只放置第一个分片
+            first_chunk = {}
+            for i in unassigned:
+                sha256 = hashes.get(i)
+                location = file_metadata.blob_location(sha256) if sha256 is not None else None
+                if location is not None:
+                    # 内容已在或已规划到某个节点上（副本数沿用第一次规划时的）；还没上传完的内容由各自的客户端上传到同一个（些）节点
+                    assignments[i], replicas[i] = location
+                elif sha256 is None or sha256 not in first_chunk:
+                    first_chunk[sha256] = i
+                    new_chunks.append(i)
+            with node_load_lock:
+                load, room = live_node_load(node_load)
+            try:
+                actions, planned_load = rollout_plan(policy.policy, total_chunks, new_chunks, load,
+                                                     chunk_load=chunk_load(chunk_size), room=room, spread=data_shards)
+                assignments.update({i: NODE_SERVERS[a] for i, a in zip(new_chunks, actions)})
+                if replication > 1:
+                    # 副本放到策略所选节点之外负载最低的节点上（优先还有空间的），逐个计入负载
+                    room -= planned_load - load
+                    for i, a in zip(new_chunks, actions):
+                        others = sorted((n for n in range(len(NODE_SERVERS)) if n != a),
+                                        key=lambda n: (room[n] < chunk_load(chunk_size), planned_load[n]))[:replication - 1]
+                        replicas[i] = [NODE_SERVERS[n] for n in others]
+                        planned_load[others] += chunk_load(chunk_size)
+                        room[others] -= chunk_load(chunk_size)
+                for i in unassigned:  # 同一文件内重复的内容放到同一个（些）节点
+                    if i not in assignments:
+                        assignments[i] = assignments[first_chunk[hashes[i]]]
+                        if first_chunk[hashes[i]] in replicas:
+                            replicas[i] = replicas[first_chunk[hashes[i]]]
+                file_metadata.assign_chunks(file_id, assignments, hashes, chunk_size, replicas,
+                                            data_shards, ERASURE_PARITY_SHARDS if erasure_coding else None)
+            except KeyError:  # 规划期间文件已被删除
+                return jsonify({"error": "File ID not found in metadata"}), 400
+            except Exception as e:
+                return jsonify({"error": f"Placement failed: {e}"}), 500
+            with node_load_lock:
+                node_load[:] += planned_load - load  # 只加上本次方案的负载，规划期间其他请求的分配不受影响
+
+        # 内容已存储的分片直接确认；其余每个 sha256 只需上传一个分片
+        stored = [i for i, sha256 in meta["hashes"].items() if i not in meta["uploaded_chunks"] and file_metadata.find_blob(sha256) is not None]
+        if stored:
+            file_metadata.mark_uploaded_many(file_id, stored)
+    upload, pending_hashes = [], set()
+    for i in range(total_chunks):
+        sha256 = meta["hashes"].get(i)
+        if i in meta["uploaded_chunks"] or sha256 in pending_hashes:
+            continue
+        if sha256 is not None:
+            pending_hashes.add(sha256)
+        upload.append(i)
+
+    # 方案用节点下标表示，避免为每个分片重复节点地址；有副本时 replicas[i] 是分片 i 还要上传到的节点
+    node_servers = sorted(set(meta["chunks"].values()).union(*meta["replicas"].values()))
+    node_ids = {node_server: k for k, node_server in enumerate(node_servers)}
+    plan = [node_ids[meta["chunks"][i]] for i in range(total_chunks)]
+    erasure = {"dataShards": meta["data_shards"], "parityShards": meta["parity_shards"]} if meta["data_shards"] else None
+    response = {"fileId": file_id, "nodeServers": node_servers, "plan": plan, "cached": not unassigned,
+                "contentAddressed": bool(meta["hashes"]), "upload": upload, "erasureCoding": erasure}
+    if meta["replicas"]:
+        response["replicas"] = [[node_ids[node_server] for node_server in meta["replicas"].get(i, [])] for i in range(total_chunks)]
+    return jsonify(response)
+
 ### **Step 3: 处理文件分块上传**
 @app.route("/upload/update", methods=["POST"])
 def update_metadata():
     data = request.json
     file_id = data.get("fileId")
     chunk_index = data.get("chunkIndex")
-    print(chunk_index)
-    if not file_id or chunk_index is None:
+    chunk_indices = data.get("chunkIndices")  # 批量上传后一次确认多个分片
+    node_hashes = data.get("sha256", {})  # 节点返回的分片 sha256，按内容寻址时用来核对
+    stored_sizes = data.get("storedSize", {})  # 节点返回的分片实际存储大小（压缩后），用于负载统计
+    if not file_id or (chunk_index is None and not isinstance(chunk_indices, list)):
         return jsonify({"error": "Invalid request"}), 400
-
-    # 确保 metadata 文件存在
-    if not os.path.exists(METADATA_FILE):
-        return jsonify({"error": "metadata.json missing"}), 500
-
-    # 读取 metadata
-    try:
-        with open(METADATA_FILE, "r") as f:
-            content = f.read().strip()
-            file_metadata = json.loads(content) if content else {}
-    except Exception as e:
-        return jsonify({"error": f"Failed to read metadata: {e}"}), 500
+    if not isinstance(stored_sizes, dict) or not all(CHUNK_INDEX_PATTERN.fullmatch(i) and isinstance(size, int) and size >= 0
+                                                     for i, size in stored_sizes.items()):
+        return jsonify({"error": "storedSize must map chunk indices to byte counts"}), 400
+    if not isinstance(node_hashes, dict) or not all(CHUNK_INDEX_PATTERN.fullmatch(i) and isinstance(sha256, str) for i, sha256 in node_hashes.items()):
+        return jsonify({"error": "sha256 must map chunk indices to sha256 strings"}), 400
+    chunk_indices = chunk_indices if chunk_indices is not None else [chunk_index]
+    if not all(isinstance(i, int) and i >= 0 for i in chunk_indices):
+        return jsonify({"error": "Chunk indices must be non-negative integers"}), 400
+    stored_sizes = {int(i): size for i, size in stored_sizes.items()}
 
     # 确保 file_id 存在
-    if file_id not in file_metadata:
+    meta = file_metadata.get(file_id)
+    if meta is None:
         return jsonify({"error": "File ID not found"}), 400
+    mismatched = [int(i) for i, sha256 in node_hashes.items() if meta["hashes"].get(int(i), sha256) != sha256]
+    if mismatched:
+        return jsonify({"error": "Chunk content does not match chunkHashes", "chunks": mismatched}), 400
 
-    # 更新已上传的分片信息
-    if "uploaded_chunks" not in file_metadata[file_id]:
-        file_metadata[file_id]["uploaded_chunks"] = []
-    if chunk_index not in file_metadata[file_id]["uploaded_chunks"]:
-        file_metadata[file_id]["uploaded_chunks"].append(chunk_index)
-        print(file_metadata[file_id]["uploaded_chunks"])
-    # 写回 metadata
+    # 内容相同的分片只上传了一个，它的存储大小也是其余分片的
+    hash_sizes = {meta["hashes"][i]: size for i, size in stored_sizes.items() if i in meta["hashes"]}
+    stored_sizes.update({i: hash_sizes[meta["hashes"][i]] for i in chunk_indices if meta["hashes"].get(i) in hash_sizes})
+
+    # 更新已上传的分片信息（只写这些分片）
     try:
-        with open(METADATA_FILE, "w") as f:
-            json.dump(file_metadata, f, indent=4)
+        stored = file_metadata.mark_uploaded_many(file_id, chunk_indices, stored_sizes)
+    except KeyError:
+        return jsonify({"error": "File ID not found"}), 400
     except Exception as e:
         return jsonify({"error": f"Failed to write metadata: {e}"}), 500
+    # 分配时按分片大小计入了负载，换成节点实际存储的大小（每个副本都一样）
+    with node_load_lock:
+        for i in stored:
+            if i not in stored_sizes or i not in meta["chunks"]:  # 没有分配过节点的分片没有计入负载
+                continue
+            for node_server in file_metadata.locations(file_id, i):
+                if node_server in NODE_SERVERS:
+                    node_load[NODE_SERVERS.index(node_server)] += chunk_load(stored_sizes[i]) - chunk_load(meta["chunk_size"])
     return jsonify({"message": "Metadata updated"})
 
+### **纠删码：校验分片的计算、放置与 k-of-n 读取**
+def shard_length(metadata, chunk_index):
+    # 数据分片的字节数：最后一个分片可能较短；最后一组不足 k 个分片时，缺的分片长度为 0，按全 0 参与编码
+    return min(max(metadata["size"] - chunk_index * metadata["chunk_size"], 0), metadata["chunk_size"])
+
+def group_shards(file_id, metadata, group):
+    # 第 group 组的 k 个数据分片和 m 个校验分片：[(node_server, name, length), ...]，校验分片与组内第一个（最长的）数据分片等长
+    k = metadata["data_shards"]
+    shards = [(metadata["chunks"].get(i), file_metadata.chunk_name(file_id, i) if i < metadata["total_chunks"] else None, shard_length(metadata, i))
+              for i in range(group * k, group * k + k)]
+    shards += [(node_server, parity_name(file_id, group, j), shard_length(metadata, group * k))
+               for j, (node_server, _) in enumerate(metadata["parity"][group])]
+    return shards
+
+def read_group(file_id, metadata, group, start, end, on_read=None):
+    """
+    第 group 组各数据分片的 [start, end] 字节（超出分片长度的部分为 0），返回 (k, end - start + 1) 的数组。
+    同时向组内所有分片请求这段字节，任意 k 个到达就解码，不等慢的或宕机的节点。
+    on_read(node_server, bytes, start_time, end_time) 对每个用于解码的分片调用一次
+    """
+    k = metadata["data_shards"]
+    window = end - start + 1
+    shards = {}
+    reads = []
+    for shard_index, (node_server, name, length) in enumerate(group_shards(file_id, metadata, group)):
+        if length <= start:
+            shards[shard_index] = np.zeros(window, dtype=np.uint8)  # 这段全是补的 0，不用读
+        else:
+            reads.append((shard_index, (node_server, name, start, min(end, length - 1))))
+    read_start = time.perf_counter()
+    results = node_client.read_any([read for _, read in reads], k - len(shards))
+    read_end = time.perf_counter()
+    for position, data in results.items():
+        if on_read is not None:
+            on_read(reads[position][1][0], len(data), read_start, read_end)
+        shard = np.zeros(window, dtype=np.uint8)
+        shard[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        shards[reads[position][0]] = shard
+    return ReedSolomon(k, metadata["parity_shards"]).reconstruct(shards)
+
+def read_erasure_range(file_id, metadata, group, first, last, on_read=None):
+    # 文件的 [first, last] 字节，都在第 group 组内
+    chunk_size = metadata["chunk_size"]
+    k = metadata["data_shards"]
+    first_chunk, last_chunk = first // chunk_size, last // chunk_size
+    if first_chunk == last_chunk:
+        offset = first_chunk * chunk_size
+        return read_group(file_id, metadata, group, first - offset, last - offset, on_read)[first_chunk - group * k].tobytes()
+    # 跨分片时读整个分片，组内的数据分片按顺序拼起来就是文件在这一组的内容
+    data = read_group(file_id, metadata, group, 0, chunk_size - 1, on_read)[first_chunk - group * k:last_chunk - group * k + 1].reshape(-1)
+    return data[first - first_chunk * chunk_size:last - first_chunk * chunk_size + 1].tobytes()
+
+def place_parity(group_nodes, parity_shards, load):
+    # 校验分片放到组内数据分片不在的节点上，负载低的优先；每个分片都要在不同节点上，节点不够时报错
+    order = sorted((n for n in range(len(NODE_SERVERS)) if NODE_SERVERS[n] not in group_nodes), key=lambda n: load[n])
+    if len(order) < parity_shards:
+        raise ValueError(f"{parity_shards} parity shards need nodes outside their group, only {len(order)} left")
+    return order[:parity_shards]
+
+def encode_parity(file_id, metadata, data_shards, parity_shards):
+    """
+    为每组 data_shards 个分片计算 parity_shards 个校验分片并写到节点上，返回 {group_index: [(node_server, stored_size), ...]}。
+    分片数据要经过协调器读一遍；失败时删掉已写的校验分片，撤回它们的负载
+    """
+    code = ReedSolomon(data_shards, parity_shards)
+    total_chunks = metadata["total_chunks"]
+    placed = []  # [node 下标, 校验分片名, 计入的负载]
+    placed_lock = threading.Lock()
+
+    def encode_group(group):
+        chunk_indices = range(group * data_shards, min((group + 1) * data_shards, total_chunks))
+        length = shard_length(metadata, group * data_shards)
+        data = np.zeros((data_shards, length), dtype=np.uint8)
+        for j, chunk_index in enumerate(chunk_indices):
+            _, chunk = node_client.read_hedged(file_metadata.locations(file_id, chunk_index), file_metadata.chunk_name(file_id, chunk_index),
+                                               0, shard_length(metadata, chunk_index) - 1)
+            data[j, :len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+        parity = code.encode(data)
+
+        # 先按校验分片长度计入负载，同时编码的其他组据此避开这些节点
+        with node_load_lock:
+            nodes = place_parity({metadata["chunks"][i] for i in chunk_indices}, parity_shards, node_load)
+            entries = [[n, parity_name(file_id, group, j), chunk_load(length)] for j, n in enumerate(nodes)]
+            for n, _, load in entries:
+                node_load[n] += load
+        with placed_lock:
+            placed.extend(entries)
+
+        shards = []
+        for j, entry in enumerate(entries):
+            stored_size = node_client.put_chunk(NODE_SERVERS[entry[0]], entry[1], parity[j].tobytes())["storedSize"]
+            with node_load_lock:  # 换成节点实际存储的大小
+                node_load[entry[0]] += chunk_load(stored_size) - entry[2]
+                entry[2] = chunk_load(stored_size)
+            shards.append((NODE_SERVERS[entry[0]], stored_size))
+        return shards
+
+    try:
+        with ThreadPoolExecutor(max_workers=MERGE_WORKERS) as pool:
+            futures = [pool.submit(encode_group, group) for group in range(-(-total_chunks // data_shards))]
+            try:
+                return {group: future.result() for group, future in enumerate(futures)}
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    except BaseException:
+        for n, name, load in placed:  # 没有写入 metadata 的校验分片不会再被读取
+            node_client.delete_chunk(NODE_SERVERS[n], name)
+            with node_load_lock:
+                node_load[n] -= load
+        raise
+
+def merge_erasure_coded(file_id, metadata, path):
+    # 按组读取（每组任意 k 个分片到达即可），顺序写入合并后的文件；各节点的统计只算用于解码的分片，与 NodeClient.fetch_file 的格式相同
+    start = time.perf_counter()
+    group_size = metadata["data_shards"] * metadata["chunk_size"]
+    node_stats = {}
+    stats_lock = threading.Lock()
+
+    def record_read(node_server, size, read_start, read_end):
+        with stats_lock:
+            stats = node_stats.setdefault(node_server, {"chunks": 0, "bytes": 0, "start": read_start, "end": read_end})
+            stats["chunks"] += 1
+            stats["bytes"] += size
+            stats["start"] = min(stats["start"], read_start)
+            stats["end"] = max(stats["end"], read_end)
+
+    parts = [(file_id, metadata, group, group * group_size, min((group + 1) * group_size, metadata["size"]) - 1, record_read)
+             for group in range(-(-metadata["size"] // group_size))]
+    total_bytes = 0
+    try:
+        with open(path, "wb") as f:
+            for data in node_client.stream_chunks(parts, readahead=MERGE_WORKERS, read=read_erasure_range):
+                f.write(data)
+                total_bytes += len(data)
+    except BaseException:
+        os.remove(path)
+        raise
+    nodes = {node_server: {"chunks": stats["chunks"],
+                           "bytes": stats["bytes"],
+                           "throughput_MBps": stats["bytes"] / max(stats["end"] - stats["start"], 1e-9) / 1e6}
+             for node_server, stats in node_stats.items()}
+    return {"bytes": total_bytes, "wall_time": time.perf_counter() - start, "nodes": nodes}
+
+### **副本：依次或对冲读取分片的各个副本**
+def replicated_chunk_length(file_id, chunk_index):
+    # 依次询问分片所在的各节点，第一个回答的为准
+    for node_server in file_metadata.locations(file_id, chunk_index):
+        try:
+            return node_client.chunk_length(node_server, file_metadata.chunk_name(file_id, chunk_index))
+        except ChunkFetchError as e:
+            error = e
+    raise error
+
+def read_replicated(node_servers, name, start, end):
+    # 分片的 [start, end] 字节，只有一个副本时就是 read_chunk
+    return node_client.read_hedged(node_servers, name, start, end)[1]
+
 ### **Step 4: 合并分块**
 @app.route("/upload/complete", methods=["POST"])
 def complete_upload():
     file_id = request.json.get("fileId")
-
-    # 重新读取 metadata.json，确保数据是最新的
-    try:
-        with open(METADATA_FILE, "r") as f:
-            content = f.read().strip()
-            file_metadata = json.loads(content) if content else {}
-    except Exception as e:
-        return jsonify({"error": f"Failed to read metadata: {e}"}), 500
+    chunk_size = request.json.get("chunkSize", CHUNK_SIZE_BYTES)
+    merge = request.json.get("merge", False)  # 默认不在协调器上合并，文件通过 /download/<file_id> 从节点读取
 
     if file_id not in file_metadata:
         return jsonify({"error": "File ID not found"}), 400
 
-    metadata = file_metadata[file_id]
+    metadata = file_metadata.get(file_id)
+    if "erasureCoding" in request.json and bool(request.json["erasureCoding"]) != (metadata["data_shards"] is not None):
+        return jsonify({"error": "erasureCoding is chosen at /upload/plan"}), 400
     file_name = metadata["file_name"]
     total_chunks = metadata["total_chunks"]
-    uploaded_chunks = metadata.get("uploaded_chunks", [])[0]
-
-    print(f"✅ Metadata from file: {metadata}")  # 打印从文件中读取的 metadata
 
     # 确保所有块都已上传
-    print(total_chunks, uploaded_chunks)
-    missing_chunks = total_chunks - uploaded_chunks - 1
+    missing_chunks = file_metadata.missing_chunks(file_id)
     if missing_chunks:
-        return jsonify({"error": "Missing some chunks", "missing_chunks": list(missing_chunks)}), 400
+        return jsonify({"error": "Missing some chunks", "missing_chunks": missing_chunks}), 400
+
+    unassigned_chunks = [i for i in range(total_chunks) if i not in metadata["chunks"]]
+    if unassigned_chunks:
+        return jsonify({"error": "Some chunks were never assigned", "unassigned_chunks": unassigned_chunks}), 400
+
+    # 记录分片大小和文件大小（最后一个分片可能较短），metadata 保留给 /download 使用；
+    # 已完成的文件（重试、之后再合并）沿用记录的大小，最后一个分片所在节点不可用时纠删码文件仍可合并
+    last_chunk = total_chunks - 1
+    try:
+        if metadata["size"] is not None and metadata["chunk_size"] == chunk_size:
+            size = metadata["size"]
+        else:
+            size = last_chunk * chunk_size + replicated_chunk_length(file_id, last_chunk) if total_chunks else 0
+            file_metadata.complete_file(file_id, chunk_size, size)
+    except ChunkFetchError as e:
+        return jsonify({"error": str(e)}), 500
+    except Exception as e:
+        return jsonify({"error": f"Failed to update metadata: {e}"}), 500
+
+    # 纠删码：计算并写入校验分片（重试时已编码的文件不再重复）；写入之前文件按数据分片读取
+    if metadata["data_shards"] is not None and not metadata["parity"] and size:
+        try:
+            parity = encode_parity(file_id, metadata, metadata["data_shards"], metadata["parity_shards"])
+            file_metadata.set_parity(file_id, parity)
+        except Exception as e:  # 包括读分片、写校验分片失败的 ChunkFetchError
+            return jsonify({"error": f"Erasure coding failed: {e}"}), 500
+    erasure = {"dataShards": metadata["data_shards"], "parityShards": metadata["parity_shards"]} if metadata["parity"] else None
 
-    # 合并文件
+    if not merge:
+        return jsonify({"message": "File upload complete", "fileName": file_name, "bytes": size,
+                        "downloadUrl": f"/download/{file_id}", "erasureCoding": erasure})
+
+    # 合并文件：并发从各节点下载分片，按偏移写入最终文件
     final_path = os.path.join(UPLOAD_FOLDER, file_name)
     try:
-        with open(final_path, "wb") as final_file:
-            for i in range(total_chunks):
-                # 获取分片存储的节点服务器
-                chunks = {int(k): v for k, v in file_metadata[file_id]["chunks"].items()}
-                node_server = chunks[i]
-                # node_server = file_metadata[file_id]["chunks"][i]
-                # 从节点服务器下载分片
-                chunk_url = f"{node_server}/uploads/chunks/{file_id}_chunk_{i}"
-                response = requests.get(chunk_url)
-                if response.status_code != 200:
-                    return jsonify({"error": f"Failed to fetch chunk {i} from {node_server}"}), 500
-                final_file.write(response.content)
+        if erasure is not None:
+            stats = merge_erasure_coded(file_id, metadata, final_path)
+        else:
+            locations = [(file_metadata.locations(file_id, i), file_metadata.chunk_name(file_id, i)) for i in range(total_chunks)]
+            stats = node_client.fetch_file(locations, final_path, chunk_size, max_workers=MERGE_WORKERS)
+    except ChunkFetchError as e:
+        return jsonify({"error": str(e)}), 500
     except Exception as e:
         import traceback
         error_message = traceback.format_exc()  # 获取详细的异常信息
         print(f"File merge failed: {error_message}")  # 打印到日志或控制台
         return jsonify({"error": f"File merge failed: {str(e)}"}), 500
 
-    # 删除 metadata 记录
-    del file_metadata[file_id]
+    print(f"Merged {file_name}: {stats['bytes']} bytes in {stats['wall_time']:.3f} s")
+    return jsonify({"message": "File upload complete", "fileName": file_name, "downloadUrl": f"/download/{file_id}",
+                    "bytes": stats["bytes"], "wallTime": stats["wall_time"], "nodes": stats["nodes"], "erasureCoding": erasure})
+
+
+def parse_range(range_header, size):
+    # 解析单个 "bytes=start-end" 区间，返回 (start, end)（含 end）；None 表示返回整个文件，False 表示区间无效
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None  # 多区间等不支持的写法按 RFC 7233 忽略
+    if match.group(1) == "":  # bytes=-N：最后 N 个字节
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+### **下载文件：按分片顺序从节点服务器流式读取，不在协调器上合并**
+@app.route("/download/<file_id>", methods=["GET"])
+def download_file(file_id):
+    metadata = file_metadata.get(file_id)
+    if metadata is None or metadata["size"] is None:
+        return jsonify({"error": "File not found or upload not complete"}), 404
+
+    size = metadata["size"]
+    chunk_size = metadata["chunk_size"]
+    headers = {"Accept-Ranges": "bytes",
+               "Content-Disposition": f"attachment; filename*=UTF-8''{quote(metadata['file_name'])}"}
+    status = 200
+    start, end = 0, size - 1
+    if request.headers.get("Range") and size:
+        byte_range = parse_range(request.headers["Range"], size)
+        if byte_range is False:
+            return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+
+    if metadata["parity"]:
+        # 纠删码文件按组读取：区间 [start, end] 与每组的交集，组内任意 k 个分片到达即可
+        group_size = metadata["data_shards"] * chunk_size
+        parts = [(file_id, metadata, group, max(start, group * group_size), min(end, (group + 1) * group_size - 1))
+                 for group in range(start // group_size, end // group_size + 1)]
+        read = read_erasure_range
+    else:
+        # 区间 [start, end] 对应的分片（所在的各节点）及各分片内的字节范围
+        parts = [(file_metadata.locations(file_id, i), file_metadata.chunk_name(file_id, i), max(start - i * chunk_size, 0), min(end - i * chunk_size, chunk_size - 1))
+                 for i in range(start // chunk_size, end // chunk_size + 1)] if size else []
+        read = read_replicated
+    mimetype = mimetypes.guess_type(metadata["file_name"])[0] or "application/octet-stream"
+    chunks = node_client.stream_chunks(parts, readahead=DOWNLOAD_READAHEAD, read=read)
+    # 先读到第一段再发响应头，读不到时返回错误而不是在 200 之后中断
     try:
-        with open(METADATA_FILE, "w") as f:
-            json.dump(file_metadata, f, indent=4)
-    except Exception as e:
-        return jsonify({"error": f"Failed to update metadata: {e}"}), 500
+        first = next(chunks, b"")
+    except ChunkFetchError as e:
+        return jsonify({"error": str(e)}), 500
+    return Response(itertools.chain([first], chunks), status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+### **删除文件：按引用计数回收节点上不再被引用的分片**
+def delete_unreferenced(unreferenced, chunk_size):
+    # 从节点上删除不再被引用的分片 [(node_server, name, stored_size), ...] 并撤回它们的负载，返回删除失败的分片名；调用方持有 blob_gc_lock
+    failed = [name for node_server, name, _ in unreferenced if not node_client.delete_chunk(node_server, name)]
+    with node_load_lock:
+        for node_server, name, stored_size in unreferenced:
+            if node_server in NODE_SERVERS:
+                node_load[NODE_SERVERS.index(node_server)] -= chunk_load(stored_size or chunk_size)
+    return failed
+
+@app.route("/files/<file_id>", methods=["DELETE"])
+def delete_file(file_id):
+    with blob_gc_lock:
+        metadata = file_metadata.get(file_id)
+        unreferenced = file_metadata.delete_file(file_id)
+        if unreferenced is None:
+            return jsonify({"error": "File ID not found"}), 404
+        failed = delete_unreferenced(unreferenced, metadata["chunk_size"])
+    return jsonify({"message": "File deleted", "deletedChunks": len(unreferenced) - len(failed), "failedChunks": failed})
 
-    return jsonify({"message": "File upload complete", "fileName": file_name})
+# 各节点最近一次 /stats、它的时效，以及放置策略当前看到的负载与协调器记账的负载
+@app.route("/nodes/stats", methods=["GET"])
+def nodes_stats():
+    with node_load_lock:
+        load = node_load.copy()
+        live, room = live_node_load(load)
+    nodes = []
+    for n, node_server in enumerate(NODE_SERVERS):
+        polled = node_stats.get(node_server)
+        nodes.append({"nodeServer": node_server, "stats": polled[0] if polled else None,
+                      "age": time.monotonic() - polled[2] if polled else None,
+                      "load": float(live[n]), "bookkeepingLoad": float(load[n]),
+                      "room": float(room[n]) if np.isfinite(room[n]) else None})
+    return jsonify({"nodes": nodes})
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=7001)
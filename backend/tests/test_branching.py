@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import pytest
+import torch
+from env_uclb import UCLB
+from rainbow_agent import DQN
+from rainbow_export import export_policy
+from rainbow_network import Branching_Dueling_Net
+from rainbow_policy import FrozenPolicy, load_policy_net
+from rainbow_replay_buffer import N_Steps_Prioritized_ReplayBuffer
+from rainbow_train import get_parser
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.chdir(BACKEND_DIR)  # UCLB loads its channel data from here
+    return UCLB(user_num=2)
+
+
+def branching_args(env):
+    args = get_parser(1000).parse_args([])
+    args.use_branching = True
+    args.batch_size = 16
+    args.state_dim = env.observation_space.shape[0]
+    args.action_dim = env.action_space.n
+    args.user_num = env.user_num
+    args.server_num = env.server_num
+    return args
+
+
+def test_joint_actions_invert_decode_action(env):
+    net = Branching_Dueling_Net(branching_args(env))
+    q = torch.zeros(env.server_num ** env.user_num, env.user_num, env.server_num)
+    selections = np.array([[a, b] for b in range(env.server_num) for a in range(env.server_num)])
+    q[torch.arange(len(q))[:, None], torch.arange(env.user_num), torch.from_numpy(selections)] = 1.0
+    actions = net.joint_actions(q)
+    assert sorted(actions.tolist()) == list(range(env.action_space.n))
+    for action, selection in zip(actions.tolist(), selections):
+        assert (env.decode_action(action) - 1 == selection).all()
+    assert (net.branch_actions(actions.unsqueeze(-1)).numpy() == selections).all()
+
+
+def test_learn_with_two_users(env):
+    args = branching_args(env)
+    agent = DQN(args)
+    replay_buffer = N_Steps_Prioritized_ReplayBuffer(args)
+    state = env.reset()
+    for _ in range(3 * args.batch_size):
+        action = agent.choose_action(state, epsilon=0.5)
+        next_state, reward, done = env.step(action)
+        replay_buffer.store_transition(state, action, reward, next_state, done, done)
+        state = env.reset() if done else next_state
+    before = [param.detach().clone() for param in agent.net.parameters()]
+    agent.learn(replay_buffer, total_steps=1)
+    assert any(not torch.equal(a, b) for a, b in zip(before, agent.net.parameters()))
+
+
+def test_branching_checkpoint_loads_and_freezes(env, tmp_path):
+    args = branching_args(env)
+    agent = DQN(args)
+    torch.save(agent.net.state_dict(), tmp_path / 'net.pth')
+    net = load_policy_net(tmp_path / 'net.pth', args.state_dim, args.action_dim)
+    assert isinstance(net, Branching_Dueling_Net)
+
+    policy = FrozenPolicy(export_policy(net, str(tmp_path / 'policy.pt'), args.state_dim, args.action_dim))
+    states = np.random.rand(8, args.state_dim).astype(np.float32) * 10
+    agent.net.eval()
+    with torch.no_grad():
+        expected = agent.greedy_actions(agent.net(torch.from_numpy(states))).numpy()
+    assert (policy.predict(states) == expected).all()
@@ -0,0 +1,35 @@
+import os
+import pytest
+from rainbow_distributed import DistributedRunner, check_actors
+from rainbow_train import get_parser
+
+
+class FakeActor(object):
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+def test_check_actors_raises_when_the_actors_die():
+    check_actors([FakeActor(None), FakeActor(0)])
+    with pytest.raises(RuntimeError, match="exited with code"):
+        check_actors([FakeActor(None), FakeActor(1)])
+    with pytest.raises(RuntimeError, match="All actor processes exited"):
+        check_actors([FakeActor(0), FakeActor(0)])
+
+
+def test_learner_stops_after_max_train_steps(monkeypatch):
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # UCLB loads its channel data from here
+    args = get_parser(400).parse_args([])
+    args.num_actors = 2
+    args.batch_size = 32
+    runner = DistributedRunner(args=args, number=1, seed=0)
+    runner.run()
+
+    # The last drain takes at most num_actors blocks, each logging up to n_steps - 1 steps more than it holds transitions
+    assert args.max_train_steps <= runner.total_steps < args.max_train_steps + args.num_actors * (args.actor_send_size + args.n_steps)
+    assert runner.total_steps == len(runner.env.step_reward_list)
+    assert runner.replay_buffer.current_size == runner.blocks * args.actor_send_size
+    assert runner.learn_steps > 0
@@ -0,0 +1,46 @@
+from metadata_store import MetadataStore, chunk_name
+
+SHA = "a" * 64
+
+
+def test_reset_releases_the_old_blob_references(tmp_path):
+    store = MetadataStore(str(tmp_path / "metadata.db"))
+    store.add_file("f", "f.bin", 2)
+    store.assign_chunks("f", {0: "n1", 1: "n2"}, hashes={0: SHA}, chunk_size=4)
+    store.mark_uploaded_many("f", [0, 1], {0: 3, 1: 4})
+
+    unreferenced = store.add_file("f", "f.bin", 1)
+    assert sorted(unreferenced) == [("n1", chunk_name("f", 0, SHA), 3), ("n2", chunk_name("f", 1), 4)]
+    assert store.find_blob(SHA) is None
+    assert MetadataStore(str(tmp_path / "metadata.db")).find_blob(SHA) is None
+    assert store.delete_file("f") == []
+
+
+def test_concurrent_plans_share_the_reserved_blob(tmp_path):
+    store = MetadataStore(str(tmp_path / "metadata.db"))
+    for file_id in ("f", "g"):
+        store.add_file(file_id, file_id + ".bin", 1)
+    store.assign_chunks("f", {0: "n1"}, hashes={0: SHA}, chunk_size=4, replicas={0: ["n2"]})
+    assert store.find_blob(SHA) is None
+    assert store.blob_location(SHA) == ("n1", ["n2"])
+    node_server, replicas = store.blob_location(SHA)
+    store.assign_chunks("g", {0: node_server}, hashes={0: SHA}, chunk_size=4, replicas={0: replicas})
+
+    # A restart before either upload is confirmed keeps the reservation
+    store = MetadataStore(str(tmp_path / "metadata.db"))
+    assert store.blob_location(SHA) == ("n1", ["n2"])
+    assert store.mark_uploaded_many("g", [0], {0: 3}) == [0]
+    assert store.mark_uploaded_many("f", [0], {0: 3}) == []
+    assert store.find_blob(SHA) == "n1"
+
+    assert store.delete_file("g") == []
+    assert store.delete_file("f") == [("n1", chunk_name("f", 0, SHA), 3), ("n2", chunk_name("f", 0, SHA), 3)]
+    assert store.blob_location(SHA) is None
+
+
+def test_deleting_a_planned_file_drops_its_reservation(tmp_path):
+    store = MetadataStore(str(tmp_path / "metadata.db"))
+    store.add_file("f", "f.bin", 1)
+    store.assign_chunks("f", {0: "n1"}, hashes={0: SHA}, chunk_size=4)
+    assert store.delete_file("f") == [("n1", chunk_name("f", 0, SHA), None)]
+    assert store.blob_location(SHA) is None
@@ -0,0 +1,20 @@
+import numpy as np
+from rainbow_policy import rollout_plan
+
+
+class FirstNodePolicy(object):
+    # Sends every chunk to node 0, like the shipped checkpoint does
+    def predict(self, state):
+        return np.zeros(1, dtype=np.int64)
+
+
+def test_spread_puts_each_group_on_distinct_nodes():
+    actions, load = rollout_plan(FirstNodePolicy(), 5, range(5), np.zeros(3), chunk_load=1.0, spread=2)
+    assert [set(actions[i:i + 2]) for i in (0, 2)] == [{0, 1}, {0, 2}]
+    assert actions[4] == 0
+    assert load.tolist() == [3, 1, 1]
+
+
+def test_chunks_stay_with_the_policy_when_no_node_has_room():
+    actions, _ = rollout_plan(FirstNodePolicy(), 2, range(2), np.zeros(3), chunk_load=1.0, room=np.zeros(3))
+    assert actions.tolist() == [0, 0]
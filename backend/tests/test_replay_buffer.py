@@ -0,0 +1,79 @@
+import argparse
+import numpy as np
+import pytest
+from rainbow_replay_buffer import BatchPrefetcher, Compact_Prioritized_ReplayBuffer, Compact_ReplayBuffer, ReplayBuffer
+
+
+def buffer_args(buffer_dir, n_steps=3):
+    return argparse.Namespace(gamma=0.99, batch_size=4, buffer_capacity=64, state_dim=4, buffer_dir=str(buffer_dir),
+                              use_n_steps=n_steps > 1, n_steps=n_steps, max_train_steps=1000, alpha=0.6, beta_init=0.4)
+
+
+def store_steps(buffer, steps, episode_length=8, start=0):
+    for t in range(start, start + steps):
+        done = (t + 1) % episode_length == 0
+        buffer.store_transition(np.full(4, t), t % 3, 1.0, np.full(4, t + 1), done, done)
+
+
+@pytest.mark.parametrize('buffer_class', [Compact_ReplayBuffer, Compact_Prioritized_ReplayBuffer])
+@pytest.mark.parametrize('n_steps', [1, 3])
+def test_reload_after_unsaved_writes_counts_each_transition_once(tmp_path, buffer_class, n_steps):
+    buffer = buffer_class(buffer_args(tmp_path, n_steps))
+    store_steps(buffer, 21)
+    buffer.save()
+    store_steps(buffer, 5, start=21)  # Written to the memory-mapped arrays, but not saved
+
+    reloaded = buffer_class(buffer_args(tmp_path, n_steps))
+    reloaded.load()
+    assert reloaded.current_size == (reloaded.buffer['next_index'] >= 0).sum()
+    assert len(reloaded.n_steps_deque) == 0
+
+    store_steps(reloaded, 30)
+    assert reloaded.current_size == (reloaded.buffer['next_index'] >= 0).sum()
+    if buffer_class is Compact_Prioritized_ReplayBuffer:
+        priorities = reloaded.sum_tree.tree[reloaded.buffer_capacity - 1:]
+        assert ((priorities > 0) == (reloaded.buffer['next_index'] >= 0)).all()
+
+
+def test_reload_keeps_the_last_next_state(tmp_path):
+    buffer = Compact_ReplayBuffer(buffer_args(tmp_path, n_steps=1))
+    store_steps(buffer, 5)
+    buffer.save()
+    reloaded = Compact_ReplayBuffer(buffer_args(tmp_path, n_steps=1))
+    reloaded.load()
+    store_steps(reloaded, 3, start=100)
+    last = 4  # The transition stored from step 4 links to the slot holding the state of step 5
+    assert (reloaded.buffer['state'][reloaded.buffer['next_index'][last]] == 5).all()
+
+
+@pytest.mark.parametrize('buffer_class', [Compact_ReplayBuffer, Compact_Prioritized_ReplayBuffer])
+@pytest.mark.parametrize('n_steps', [1, 3])
+def test_reload_after_unsaved_writes_samples_no_stale_next_state(tmp_path, buffer_class, n_steps):
+    buffer = buffer_class(buffer_args(tmp_path, n_steps))
+    store_steps(buffer, 21)  # Saved mid-episode
+    buffer.save()
+    store_steps(buffer, 1, start=21)  # Links the slots at the boundary, but is not saved
+
+    reloaded = buffer_class(buffer_args(tmp_path, n_steps))
+    reloaded.load()
+    store_steps(reloaded, 6, start=100)  # The next episode overwrites the slots after 'count'
+    for _ in range(50):
+        batch = reloaded.sample(0)[0]
+        state, next_state = batch['state'][:, 0], batch['next_state'][:, 0]
+        assert ((state >= 100) == (next_state >= 100)).all()  # Never a next_state from another episode
+        assert ((next_state - state >= 1) & (next_state - state <= n_steps)).all()
+
+
+def test_prefetcher_raises_the_sampling_error():
+    buffer = ReplayBuffer(argparse.Namespace(gamma=0.99, batch_size=4, buffer_capacity=64, state_dim=4))
+    prefetcher = BatchPrefetcher(buffer, prefetch_batches=2)
+
+    def broken_sample(total_steps):
+        raise IndexError("broken")
+    buffer.sample = broken_sample
+    store_steps(prefetcher, 8)
+    for _ in range(2):
+        with pytest.raises(RuntimeError) as error:
+            prefetcher.sample(0)
+        assert isinstance(error.value.__cause__, IndexError)
+    prefetcher.close()
@@ -1,19 +1,212 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file, Response
 from flask_cors import CORS
 import os
+import json
+import shutil
+import struct
+import hashlib
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from functools import wraps
+from werkzeug.wsgi import LimitedStream
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+# 在 nginx 之后运行时设置 USE_X_SENDFILE=1，由 nginx 直接发送分片文件
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
 
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+CHUNK_META_SUFFIX = ".meta.json"  # 每个分片旁边的元数据文件：sha256 和大小
+READ_SIZE = 64 * 1024
+FRAME_HEADER = struct.Struct(">IQ")  # 批量上传中每个分片的帧头：分片序号（uint32）、分片字节数（uint64），大端
+BLOB_PREFIX = "blob_"  # 按内容寻址的分片文件名：blob_<sha256>，与协调器 metadata_store.BLOB_PREFIX 一致
+# 分片压缩：zlib 压缩级别（1-9，0 表示不压缩），用分片开头 PROBE_SIZE 字节试压缩，压缩率好于 PROBE_RATIO 才压缩，否则原样存储（"store"）
+COMPRESSION_LEVEL = int(os.environ.get("CHUNK_COMPRESSION_LEVEL", "6"))
+PROBE_SIZE = 1024
+PROBE_RATIO = 0.9
+# /stats：最近 STATS_WINDOW 秒的平均上传、下载速率；已存储字节数在写入、删除时增量更新，每 STATS_RESCAN_INTERVAL 秒重新扫描目录校正
+# （多个 worker 进程时每个进程只看到自己的写入，靠重新扫描对齐）
+STATS_WINDOW = 10
+STATS_RESCAN_INTERVAL = 60
+stats_lock = threading.Lock()
+stats = {"bytes_stored": 0, "chunks": 0, "scanned_at": None, "in_flight": 0, "in_flight_bytes": 0}
+transfers = {"upload": deque(), "download": deque()}  # (时间, 字节数)
 
 @app.route("/")
 def home():
     return jsonify({"message": "Flask backend is running!"})
 
+
+def resolve_chunk_path(filename):
+    # 分片文件的绝对路径，拒绝跳出 UPLOAD_FOLDER 的文件名以及元数据、临时文件
+    if os.path.basename(filename) != filename or filename.startswith(".") or filename.endswith((CHUNK_META_SUFFIX, ".tmp")):
+        return None
+    return os.path.join(app.root_path, UPLOAD_FOLDER, filename)
+
+
+def record_transfer(direction, size):
+    now = time.monotonic()
+    with stats_lock:
+        events = transfers[direction]
+        events.append((now, size))
+        while events and events[0][0] < now - STATS_WINDOW:
+            events.popleft()
+
+
+def record_stored(size, chunks):
+    # 分片写入、覆盖、删除后已存储字节数与分片数的变化
+    with stats_lock:
+        stats["bytes_stored"] += size
+        stats["chunks"] += chunks
+
+
+def track_upload(view):
+    # 统计正在接收的上传请求数及其请求体字节数（Content-Length），协调器据此把还没写完的数据也算进节点负载
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        size = request.content_length or 0
+        with stats_lock:
+            stats["in_flight"] += 1
+            stats["in_flight_bytes"] += size
+        try:
+            return view(*args, **kwargs)
+        finally:
+            with stats_lock:
+                stats["in_flight"] -= 1
+                stats["in_flight_bytes"] -= size
+    return wrapper
+
+
+def scan_uploads():
+    # 分片文件数与实际占用的字节数（不含元数据和临时文件）
+    bytes_stored = chunks = 0
+    with os.scandir(os.path.join(app.root_path, UPLOAD_FOLDER)) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name.endswith(CHUNK_META_SUFFIX) or not entry.is_file():
+                continue
+            bytes_stored += entry.stat().st_size
+            chunks += 1
+    return bytes_stored, chunks
+
+
+def choose_codec(data):
+    # 试压缩分片开头的数据，压缩不动的数据（已压缩的文件、随机数据）原样存储
+    probe = data[:PROBE_SIZE]
+    if COMPRESSION_LEVEL <= 0 or not probe or len(zlib.compress(probe, COMPRESSION_LEVEL)) > len(probe) * PROBE_RATIO:
+        return "store"
+    return "zlib"
+
+
+def write_chunk(stream, path=None):
+    # 边读边写边计算 sha256（原始内容的），写完后原子替换，读者不会看到写了一半的分片
+    # path 为 None 时按内容寻址：文件名由 sha256 决定，相同内容只存一份
+    # 分片按 choose_codec 选择的编码写盘，size 是原始大小，stored_size 是实际占用的字节数
+    tmp_path = tmp_chunk_path(path)
+    sha256 = hashlib.sha256()
+    size = 0
+    stored_size = 0
+    codec = None
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                data = stream.read(READ_SIZE)
+                if codec is None:
+                    codec = choose_codec(data)
+                    compressor = zlib.compressobj(COMPRESSION_LEVEL) if codec == "zlib" else None
+                if not data:
+                    break
+                sha256.update(data)
+                size += len(data)
+                if compressor is not None:
+                    data = compressor.compress(data)
+                f.write(data)
+                stored_size += len(data)
+            if compressor is not None:
+                data = compressor.flush()
+                f.write(data)
+                stored_size += len(data)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    record_transfer("upload", size)
+    # inode 是分片文件替换后的 inode，读取时用它确认元数据与分片文件是同一次写入的
+    meta = {"sha256": sha256.hexdigest(), "size": size, "codec": codec, "stored_size": stored_size, "inode": os.stat(tmp_path).st_ino}
+    if path is None:
+        path = resolve_chunk_path(BLOB_PREFIX + meta["sha256"])
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return dict(read_chunk_meta(path), name=os.path.basename(path))  # 已有的 blob 按它存储时的编码计
+    replaced = os.path.getsize(path) if os.path.isfile(path) else None
+    # 先替换分片文件再替换元数据：中间读到的旧元数据 inode 对不上，按分片内容推断编码
+    os.replace(tmp_path, path)
+    write_chunk_meta(path, meta)
+    record_stored(stored_size - (replaced or 0), int(replaced is None))
+    return dict(meta, name=os.path.basename(path))
+
+
+def tmp_chunk_path(path=None, suffix=""):
+    # 写入中的临时文件：.<分片文件名>.<随机串><suffix>.tmp，按内容寻址的分片写完才知道文件名，用 .<随机串>.tmp
+    prefix = f".{os.path.basename(path)}." if path is not None else "."
+    return os.path.join(app.root_path, UPLOAD_FOLDER, f"{prefix}{uuid.uuid4().hex}{suffix}.tmp")
+
+
+def chunk_write_in_flight(path):
+    # 是否有对这个分片文件（或它的元数据）正在进行的写入
+    prefix = f".{os.path.basename(path)}."
+    with os.scandir(os.path.dirname(path)) as entries:
+        return any(entry.name.startswith(prefix) and entry.name.endswith(".tmp") for entry in entries)
+
+
+def write_chunk_meta(path, meta):
+    # 元数据也写临时文件再原子替换，读者不会读到写了一半的 JSON
+    tmp_path = tmp_chunk_path(path, ".meta")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path + CHUNK_META_SUFFIX)
+
+
+def read_chunk_meta(path):
+    # 元数据的 inode 和大小与分片文件对得上才用（旧版本的元数据没有 inode，只比较大小）；
+    # 对不上的（正在被覆盖写入，或旧分片没有元数据）按分片内容推断，没有对这个分片的写入正在进行时才补写元数据
+    try:
+        with open(path + CHUNK_META_SUFFIX, "r") as f:
+            meta = json.load(f)
+        stat = os.stat(path)
+        if meta.get("inode", stat.st_ino) == stat.st_ino and meta.get("stored_size", meta["size"]) == stat.st_size:
+            meta.setdefault("codec", "store")
+            meta.setdefault("stored_size", meta["size"])
+            return meta
+    except (OSError, ValueError, KeyError):
+        pass
+    meta = infer_chunk_meta(path)
+    if not chunk_write_in_flight(path):
+        write_chunk_meta(path, meta)
+    return meta
+
+
+def infer_chunk_meta(path):
+    # 能完整解压的按 zlib 计，否则按原样存储计；blob 的文件名就是原始内容的 sha256，以它为准
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        stored = f.read()
+    try:
+        data = zlib.decompress(stored)
+        codec = "zlib"
+    except zlib.error:
+        data, codec = stored, "store"
+    sha256 = hashlib.sha256(data).hexdigest()
+    name = os.path.basename(path)
+    if codec == "zlib" and name.startswith(BLOB_PREFIX) and sha256 != name[len(BLOB_PREFIX):]:
+        data, codec, sha256 = stored, "store", hashlib.sha256(stored).hexdigest()
+    return {"sha256": sha256, "size": len(data), "codec": codec, "stored_size": len(stored), "inode": stat.st_ino}
+
 # 接收文件分片
 @app.route("/upload/chunk", methods=["POST"])
+@track_upload
 def upload_chunk():
     file_id = request.form.get("fileId")
     chunk_index = request.form.get("chunkIndex")
@@ -23,28 +216,133 @@ def upload_chunk():
         return jsonify({"error": "Missing chunk data"}), 400
 
     chunk_filename = f"{file_id}_chunk_{chunk_index}"
-    chunk_path = os.path.join(UPLOAD_FOLDER, chunk_filename)
+    chunk_path = resolve_chunk_path(chunk_filename)
+    if chunk_path is None:
+        return jsonify({"error": "Invalid chunk name"}), 400
 
     try:
-        chunk.save(chunk_path)
+        meta = write_chunk(chunk.stream, chunk_path)
         # 将分片存储到 HDFS（这里假设 HDFS 已经配置好）
         # 例如：使用 Hadoop 的 Python API 或调用 HDFS 命令
         # 这里仅模拟存储
-        print(f"Storing chunk {chunk_index} to HDFS...")
+        app.logger.debug(f"Storing chunk {chunk_index} to HDFS...")
     except Exception as e:
         return jsonify({"error": f"Failed to save chunk: {e}"}), 500
 
-    return jsonify({"message": f"Chunk {chunk_index} uploaded"})
+    return jsonify({"message": f"Chunk {chunk_index} uploaded", "sha256": meta["sha256"], "size": meta["size"],
+                    "storedSize": meta["stored_size"]})
 
-from flask import send_from_directory
+# 批量接收分片：请求体是连续的帧，每帧 = 帧头 + 分片数据，边解析边写盘，一次返回所有分片的确认
+# contentAddressed=1 时分片按内容存为 blob_<sha256>，已有的内容不再重复存储
+@app.route("/upload/chunks", methods=["POST"])
+@track_upload
+def upload_chunks():
+    file_id = request.args.get("fileId")
+    content_addressed = request.args.get("contentAddressed") == "1"
+    if not file_id:
+        return jsonify({"error": "Missing fileId"}), 400
+
+    stream = request.stream
+    uploaded = {}
+    try:
+        while True:
+            header = stream.read(FRAME_HEADER.size)
+            if not header:
+                break
+            if len(header) != FRAME_HEADER.size:
+                raise ValueError("Truncated frame header")
+            chunk_index, size = FRAME_HEADER.unpack(header)
+            chunk_path = None if content_addressed else resolve_chunk_path(f"{file_id}_chunk_{chunk_index}")
+            if chunk_path is None and not content_addressed:
+                raise ValueError("Invalid chunk name")
+            uploaded[chunk_index] = write_chunk(LimitedStream(stream, size), chunk_path)  # 数据不足 size 字节时抛出 ClientDisconnected
+    except Exception as e:
+        # 已写完的分片仍然有效，告诉客户端哪些成功了
+        return jsonify({"error": f"Failed to save chunks: {e}", "uploaded": list(uploaded)}), 400
+
+    app.logger.debug(f"Stored {len(uploaded)} chunks of {file_id}")
+    return jsonify({"message": f"{len(uploaded)} chunks uploaded", "uploaded": list(uploaded),
+                    "sha256": {i: meta["sha256"] for i, meta in uploaded.items()},
+                    "storedSize": {i: meta["stored_size"] for i, meta in uploaded.items()}})
+
+# 按文件名写入分片（协调器写纠删码的校验分片时调用），请求体就是分片内容
+@app.route("/uploads/chunks/<filename>", methods=["PUT"])
+@track_upload
+def put_chunk(filename):
+    path = resolve_chunk_path(filename)
+    if path is None:
+        return jsonify({"error": "Invalid chunk name"}), 400
+    try:
+        meta = write_chunk(request.stream, path)
+    except Exception as e:
+        return jsonify({"error": f"Failed to save chunk: {e}"}), 500
+    return jsonify({"message": f"{filename} stored", "sha256": meta["sha256"], "size": meta["size"], "storedSize": meta["stored_size"]})
+
+# 删除分片（协调器在文件删除、且按内容寻址的分片不再被引用时调用）
+@app.route("/uploads/chunks/<filename>", methods=["DELETE"])
+def delete_chunk(filename):
+    path = resolve_chunk_path(filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "File not found"}), 404
+    size = os.path.getsize(path)
+    os.remove(path)
+    if os.path.exists(path + CHUNK_META_SUFFIX):
+        os.remove(path + CHUNK_META_SUFFIX)
+    record_stored(-size, -1)
+    return jsonify({"message": f"{filename} deleted"})
 
 # 提供分片文件下载
+# 支持 Range（206）、If-None-Match / If-Range（ETag 为分片原始内容的 sha256）；
+# 重新上传的分片会换新的 ETag。在 gunicorn 等提供 wsgi.file_wrapper 的服务器下整块读取走 sendfile 零拷贝
+# 压缩存储的分片：客户端接受 deflate 且读取整块时直接发送压缩数据（Content-Encoding: deflate，仍走 sendfile）；
+# 否则在内存中解压后返回，Range 按原始内容的字节计算
 @app.route("/uploads/chunks/<filename>", methods=["GET"])
 def download_chunk(filename):
-    try:
-        return send_from_directory(UPLOAD_FOLDER, filename)
-    except FileNotFoundError:
+    path = resolve_chunk_path(filename)
+    if path is None or not os.path.isfile(path):
         return jsonify({"error": "File not found"}), 404
+    meta = read_chunk_meta(path)
+    if meta["codec"] == "store":
+        return record_download(send_file(path, mimetype="application/octet-stream", etag=meta["sha256"], conditional=True))
+
+    if request.range is None and request.accept_encodings["deflate"]:
+        # 压缩后的表示是另一个实体，ETag 要与原始内容的区分开
+        response = send_file(path, mimetype="application/octet-stream", etag=meta["sha256"] + ".deflate", conditional=True)
+        response.headers["Content-Encoding"] = "deflate"
+    else:
+        with open(path, "rb") as f:
+            data = zlib.decompress(f.read())
+        response = Response(data, mimetype="application/octet-stream")
+        response.set_etag(meta["sha256"])
+        response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+    response.vary.add("Accept-Encoding")
+    return record_download(response)
+
+
+def record_download(response):
+    if request.method == "GET":
+        record_transfer("download", response.content_length or 0)
+    return response
+
+# 节点实时状态，协调器定期轮询（NODE_STATS_TTL）作为放置策略的 server_load 特征
+@app.route("/stats", methods=["GET"])
+def node_stats():
+    with stats_lock:
+        rescan = stats["scanned_at"] is None or time.monotonic() - stats["scanned_at"] > STATS_RESCAN_INTERVAL
+    if rescan:
+        # 扫描期间完成的写入可能被计两次或漏计，下次重新扫描时校正
+        bytes_stored, chunks = scan_uploads()
+        with stats_lock:
+            stats.update(bytes_stored=bytes_stored, chunks=chunks, scanned_at=time.monotonic())
+    disk = shutil.disk_usage(os.path.join(app.root_path, UPLOAD_FOLDER))
+    now = time.monotonic()
+    with stats_lock:
+        rates = {direction: sum(size for t, size in events if t >= now - STATS_WINDOW) / STATS_WINDOW
+                 for direction, events in transfers.items()}
+        return jsonify({"bytesStored": stats["bytes_stored"], "chunks": stats["chunks"],
+                        "inFlightUploads": stats["in_flight"], "inFlightBytes": stats["in_flight_bytes"],
+                        "uploadBytesPerSec": rates["upload"], "downloadBytesPerSec": rates["download"],
+                        "diskFree": disk.free, "diskTotal": disk.total})
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=7001)